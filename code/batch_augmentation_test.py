@@ -0,0 +1,92 @@
+# batch_augmentation_test.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Checks BatchImageAugmentation (models/batch_augmentation.py) against
+# tflearn's per-image ImageAugmentation:
+#   - flips and padded crops make the same random draws as tflearn's
+#     _random_flip_leftright / _random_crop, so under the same random.seed
+#     the augmented batches are identical
+#   - rotations are its documented approximation of tflearn's (bilinear,
+#     angles rounded to rotation_step): at every precomputed angle they match
+#     scipy.ndimage.rotate(image, angle, reshape=False, order=1)
+#===============================================================================
+# USAGE:
+# python batch_augmentation_test.py   (or: python -m pytest batch_augmentation_test.py)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import sys
+import random
+
+import numpy as np
+
+sys.path.append("../") # so we can import models.
+
+# Largest allowed difference to scipy, in pixel values of a 0..255 image (float32 rounding of the weights).
+ROTATION_TOLERANCE = 1e-3
+
+
+def random_images(n_images=64, height=32, width=32, n_channels=3, seed=0):
+    return np.random.RandomState(seed).uniform(0, 255, size=(n_images, height, width, n_channels)).astype(np.float32)
+
+
+def test_flip_matches_tflearn(seed=0):
+    from tflearn.data_augmentation import ImageAugmentation
+    from models.batch_augmentation import BatchImageAugmentation
+
+    images = random_images()
+    random.seed(seed)
+    expected = np.asarray(ImageAugmentation()._random_flip_leftright(images.copy()))
+    random.seed(seed)
+    flipped = BatchImageAugmentation()._random_flip_leftright(images.copy())
+    assert 0 < np.sum(np.any(flipped != images, axis=(1, 2, 3))) < len(images), "expected a mix of flipped images"
+    assert np.array_equal(flipped, expected)
+
+
+def test_crop_matches_tflearn(seed=0):
+    from tflearn.data_augmentation import ImageAugmentation
+    from models.batch_augmentation import BatchImageAugmentation
+
+    images = random_images()
+    for crop_shape, padding in [((32, 32), 4), ((24, 24), None)]:
+        random.seed(seed)
+        expected = np.asarray(ImageAugmentation()._random_crop(images.copy(), crop_shape, padding))
+        random.seed(seed)
+        cropped = BatchImageAugmentation()._random_crop(images.copy(), crop_shape, padding)
+        assert cropped.shape == expected.shape, "shape {} != {}".format(cropped.shape, expected.shape)
+        assert np.array_equal(cropped, expected), "crop_shape {}, padding {}".format(crop_shape, padding)
+
+
+def test_rotation_matches_scipy(max_angle=25., seed=0):
+    from scipy import ndimage
+    from models.batch_augmentation import BatchImageAugmentation
+
+    image = random_images(n_images=1, seed=seed)[0]
+    augmentation = BatchImageAugmentation()
+    angles, _, _ = augmentation.get_rotation_grids(image.shape[0], image.shape[1], max_angle)
+    rotated = augmentation.rotate_images(np.repeat(image[None], len(angles), axis=0), np.arange(len(angles)),
+                                         max_angle)
+    for angle, rotated_image in zip(angles, rotated):
+        expected = ndimage.rotate(image, angle, reshape=False, order=1)
+        max_diff = np.abs(rotated_image - expected).max()
+        assert max_diff < ROTATION_TOLERANCE, "angle {}: max difference to scipy {}".format(angle, max_diff)
+
+
+def test_rotation_angles_are_rounded(max_angle=25.):
+    from models.batch_augmentation import BatchImageAugmentation
+
+    augmentation = BatchImageAugmentation()
+    angles, _, _ = augmentation.get_rotation_grids(32, 32, max_angle)
+    drawn_angles = np.array([-max_angle, -3.4, -0.6, 0., 0.4, 12.5001, max_angle])
+    rounded = angles[augmentation.nearest_angle_ids(angles, drawn_angles)]
+    assert np.array_equal(rounded, [-25., -3., -1., 0., 0., 13., 25.]), rounded
+
+
+if __name__ == '__main__':
+    test_flip_matches_tflearn()
+    test_crop_matches_tflearn()
+    test_rotation_matches_scipy()
+    test_rotation_angles_are_rounded()
+    print("ok")
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+# benchmark.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Benchmark suite for data loading, training steps and inference, run against
+# a synthetic CIFAR-shaped fixture (no downloads). The fixture is written to a
+# temporary directory laid out like the repo (<tmp>/code, <tmp>/data/...) and
+# the benchmarks run with <tmp>/code as working directory, so all the relative
+# '../data/...' paths (raw CIFAR, dataset cache, feature sets, checkpoints)
+# resolve inside the fixture and the real data directory is never touched.
+# The fixture's dataset cache is cleared before every dataset of the data
+# suite and before the pyramid suite, so their cold / cache build runs never
+# read entries built by an earlier run.
+#
+# Suites:
+#   data:    load_data time for each dataset in DATASET_TO_N_CLASSES (cold, cache build, cached, uint8_mmap)
+#   pyramid: load_cifar_pyramid split time (cold, cache build, cached, uint8_mmap)
+#   train:   training step images/sec per network type in ALL_MODEL_DICTS
+#   predict: model.predict latency / throughput per network type at several batch sizes
+#
+# Results are written as JSON (with the git commit they were measured at), so
+# runs can be compared across commits.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# python benchmark.py [-s data,pyramid,train,predict] [-o results.json] [-n <n_train>] [-b 1,16,128,512]
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import subprocess
+import cPickle as pickle
+
+import numpy as np
+
+from constants import *
+
+
+ALL_SUITES = ['data', 'pyramid', 'train', 'predict']
+DEFAULT_N_TRAIN = 50000
+DEFAULT_N_TEST = 10000
+DEFAULT_PREDICT_BATCH_SIZES = [1, 16, 128, 512]
+TRAIN_BATCH_SIZE = 128
+N_WARMUP_STEPS = 2
+N_TIMED_STEPS = 10
+COARSE_TO_FINE_MAP_FILE = 'coarse_to_fine_map.pickle'
+
+
+#===============================================================================
+# Synthetic fixture
+
+def make_synthetic_cifar(fixture_dir, n_train=DEFAULT_N_TRAIN, n_test=DEFAULT_N_TEST, seed=0):
+    """
+    Writes random CIFAR-10 and CIFAR-100 python-format batches to <fixture_dir>/data, using the label names of
+    coarse_to_fine_map.pickle so the pyramid split sees the real label hierarchy, and copies the map to
+    <fixture_dir>/code.
+    """
+    code_dir = os.path.join(fixture_dir, 'code')
+    cifar10_dir = os.path.join(fixture_dir, 'data', 'cifar-10-batches-py')
+    cifar100_dir = os.path.join(fixture_dir, 'data', 'cifar-100-python')
+    for directory in (code_dir, cifar10_dir, cifar100_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    shutil.copyfile(COARSE_TO_FINE_MAP_FILE, os.path.join(code_dir, COARSE_TO_FINE_MAP_FILE))
+
+    with open(COARSE_TO_FINE_MAP_FILE, 'rb') as f:
+        coarse_to_fine_map = pickle.load(f)
+    coarse_label_names = sorted(coarse_to_fine_map.keys())
+    fine_label_names = sorted(fine for fines in coarse_to_fine_map.values() for fine in fines)
+    fine_to_coarse = np.zeros(len(fine_label_names), dtype=int)
+    for coarse, fines in coarse_to_fine_map.items():
+        for fine in fines:
+            fine_to_coarse[fine_label_names.index(fine)] = coarse_label_names.index(coarse)
+
+    rng = np.random.RandomState(seed)
+
+    def random_images(n):
+        return rng.randint(0, 256, size=(n, 32 * 32 * 3)).astype(np.uint8)
+
+    def dump(obj, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+    for name, batch_label, n in (('train', 'training batch 1 of 1', n_train), ('test', 'testing batch 1 of 1', n_test)):
+        fine_labels = rng.randint(len(fine_label_names), size=n)
+        dump({'batch_label': batch_label, 'data': random_images(n), 'fine_labels': list(fine_labels),
+              'coarse_labels': list(fine_to_coarse[fine_labels])}, os.path.join(cifar100_dir, name))
+    dump({'fine_label_names': fine_label_names, 'coarse_label_names': coarse_label_names},
+         os.path.join(cifar100_dir, 'meta'))
+
+    batch_sizes = [len(b) for b in np.array_split(np.arange(n_train), 5)]
+    for b, n in enumerate(batch_sizes):
+        dump({'batch_label': 'training batch %d of 5' % (b + 1, ), 'data': random_images(n),
+              'labels': list(rng.randint(10, size=n))}, os.path.join(cifar10_dir, 'data_batch_%d' % (b + 1, )))
+    dump({'batch_label': 'testing batch 1 of 1', 'data': random_images(n_test),
+          'labels': list(rng.randint(10, size=n_test))}, os.path.join(cifar10_dir, 'test_batch'))
+    dump({'label_names': ['class_%d' % i for i in range(10)]}, os.path.join(cifar10_dir, 'batches.meta'))
+    return code_dir
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return time.time() - start, result
+
+
+#===============================================================================
+# Suites
+
+def benchmark_data_loading():
+    from data_utils import load_data
+    from dataset_cache import clear_dataset_cache
+
+    results = []
+    for dataset in sorted(DATASET_TO_N_CLASSES):
+        clear_dataset_cache()
+        runs = [('cold', dict(use_cache=False)), ('cache_build', dict(use_cache=True)),
+                ('cached', dict(use_cache=True)), ('uint8_mmap', dict(use_cache=True, storage='uint8_mmap'))]
+        for run_name, kwargs in runs:
+            seconds, arrays = timed(load_data, dataset, **kwargs)
+            results.append({'dataset': dataset, 'run': run_name, 'seconds': seconds, 'n_train': len(arrays[0])})
+            print("data | {} | {}: {:.3f}s".format(dataset, run_name, seconds))
+    return results
+
+
+def benchmark_pyramid_split():
+    from data_utils import load_cifar_pyramid
+    from dataset_cache import clear_dataset_cache
+
+    clear_dataset_cache()
+    results = []
+    runs = [('cold', dict(use_cache=False)), ('cache_build', dict(use_cache=True)), ('cached', dict(use_cache=True)),
+            ('uint8_mmap', dict(use_cache=True, storage='uint8_mmap'))]
+    for run_name, kwargs in runs:
+        seconds, arrays = timed(load_cifar_pyramid, **kwargs)
+        results.append({'run': run_name, 'seconds': seconds, 'n_train_joint': len(arrays[0]),
+                        'n_train_gate': len(arrays[2]), 'n_test': len(arrays[5])})
+        print("pyramid | {}: {:.3f}s".format(run_name, seconds))
+    return results
+
+
+def get_benchmark_model_ids():
+    # One model_id per network type.
+    model_ids = {}
+    for model_id in sorted(ALL_MODEL_DICTS):
+        model_ids.setdefault(ALL_MODEL_DICTS[model_id]['network_type'], model_id)
+    return [model_ids[network_type] for network_type in sorted(model_ids)]
+
+
+def _load_benchmark_model(model_id, is_training):
+    from model_utils import load_model, get_model_output_kwargs
+
+    return load_model(model_id, is_training=is_training, **get_model_output_kwargs(model_id))
+
+
+def _random_feed(placeholder, batch_size, rng):
+    shape = [batch_size] + placeholder.get_shape().as_list()[1:]
+    return rng.rand(*shape).astype(np.float32)
+
+
+def _run_for_model(model_id, benchmark_fn):
+    # Each model gets its own graph. load_network exits on unknown network types, so catch that too.
+    import tensorflow as tf
+
+    network_type = ALL_MODEL_DICTS[model_id]['network_type']
+    try:
+        with tf.Graph().as_default():
+            return benchmark_fn(model_id)
+    except (Exception, SystemExit) as e:
+        print("Skipping {} ({}): {!r}".format(model_id, network_type, e))
+        return [{'model_id': model_id, 'network_type': network_type, 'error': repr(e)}]
+
+
+def _benchmark_train_step(model_id, batch_size=TRAIN_BATCH_SIZE, seed=0):
+    import tflearn
+
+    model = _load_benchmark_model(model_id, is_training=True)
+    rng = np.random.RandomState(seed)
+    train_ops = model.trainer.train_ops
+    feed_dict = {model.inputs[0]: _random_feed(model.inputs[0], batch_size, rng)}
+    for target_placeholder in model.targets:
+        feed_dict[target_placeholder] = _random_feed(target_placeholder, batch_size, rng)
+
+    tflearn.is_training(True, session=model.session)
+    fetches = [train_op.apply_grad for train_op in train_ops]
+    for _ in range(N_WARMUP_STEPS):
+        model.session.run(fetches, feed_dict=feed_dict)
+    seconds, _ = timed(lambda: [model.session.run(fetches, feed_dict=feed_dict) for _ in range(N_TIMED_STEPS)])
+
+    network_type = ALL_MODEL_DICTS[model_id]['network_type']
+    images_per_second = N_TIMED_STEPS * batch_size / seconds
+    print("train | {}: {:.1f} images/s".format(network_type, images_per_second))
+    return [{'model_id': model_id, 'network_type': network_type, 'batch_size': batch_size,
+             'step_seconds': seconds / N_TIMED_STEPS, 'images_per_second': images_per_second}]
+
+
+def _benchmark_predict(model_id, batch_sizes=DEFAULT_PREDICT_BATCH_SIZES, seed=0):
+    model = _load_benchmark_model(model_id, is_training=False)
+    rng = np.random.RandomState(seed)
+    network_type = ALL_MODEL_DICTS[model_id]['network_type']
+
+    results = []
+    for batch_size in batch_sizes:
+        X_batch = _random_feed(model.inputs[0], batch_size, rng)
+        for _ in range(N_WARMUP_STEPS):
+            model.predict(X_batch)
+        latencies = []
+        for _ in range(N_TIMED_STEPS):
+            seconds, _ = timed(model.predict, X_batch)
+            latencies.append(seconds)
+        latencies = np.array(latencies)
+        results.append({'model_id': model_id, 'network_type': network_type, 'batch_size': batch_size,
+                        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+                        'latency_p90_ms': 1000 * float(np.percentile(latencies, 90)),
+                        'images_per_second': batch_size * len(latencies) / float(latencies.sum())})
+        print("predict | {} | batch {}: p50 {:.2f}ms, {:.1f} images/s".format(
+            network_type, batch_size, results[-1]['latency_p50_ms'], results[-1]['images_per_second']))
+    return results
+
+
+def benchmark_train_steps():
+    results = []
+    for model_id in get_benchmark_model_ids():
+        results.extend(_run_for_model(model_id, _benchmark_train_step))
+    return results
+
+
+def benchmark_predict(batch_sizes=DEFAULT_PREDICT_BATCH_SIZES):
+    results = []
+    for model_id in get_benchmark_model_ids():
+        results.extend(_run_for_model(model_id, lambda m: _benchmark_predict(m, batch_sizes=batch_sizes)))
+    return results
+
+
+#===============================================================================
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(suites=ALL_SUITES, n_train=DEFAULT_N_TRAIN, n_test=DEFAULT_N_TEST,
+                   predict_batch_sizes=DEFAULT_PREDICT_BATCH_SIZES, fixture_dir=None):
+    """
+    Returns a JSON-serializable dict with the config, git commit and per-suite results.
+    """
+    report = {'timestamp': datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S"), 'git_commit': get_git_commit(),
+              'config': {'suites': list(suites), 'n_train': n_train, 'n_test': n_test,
+                         'predict_batch_sizes': list(predict_batch_sizes), 'train_batch_size': TRAIN_BATCH_SIZE,
+                         'n_timed_steps': N_TIMED_STEPS},
+              'results': {}}
+
+    remove_fixture = fixture_dir is None
+    fixture_dir = fixture_dir or tempfile.mkdtemp(prefix='cifar_benchmark_')
+    original_dir = os.getcwd()
+    try:
+        code_dir = make_synthetic_cifar(fixture_dir, n_train=n_train, n_test=n_test)
+        os.chdir(code_dir)
+        suite_fns = {'data': benchmark_data_loading, 'pyramid': benchmark_pyramid_split,
+                     'train': benchmark_train_steps, 'predict': lambda: benchmark_predict(predict_batch_sizes)}
+        for suite in suites:
+            report['results'][suite] = suite_fns[suite]()
+    finally:
+        os.chdir(original_dir)
+        if remove_fixture:
+            shutil.rmtree(fixture_dir)
+    return report
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python benchmark.py [-s <suites, e.g. data,pyramid,train,predict>] [-o <output_json>] "
+              "[-n <n_train>] [-b <predict batch sizes, e.g. 1,16,128>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:o:n:b:", ["help", "suites", "output", "n_train", "batch_sizes"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    suites, output_file, n_train, batch_sizes = ALL_SUITES, None, DEFAULT_N_TRAIN, DEFAULT_PREDICT_BATCH_SIZES
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-s", "--suites"):
+            suites = a.split(',')
+            assert all(suite in ALL_SUITES for suite in suites), "Suites must be in {}".format(ALL_SUITES)
+        elif o in ("-o", "--output"):
+            output_file = a
+        elif o in ("-n", "--n_train"):
+            n_train = int(a)
+        elif o in ("-b", "--batch_sizes"):
+            batch_sizes = [int(b) for b in a.split(',')]
+        else:
+            assert False, "unhandled option"
+
+    if output_file is None:
+        output_file = '../benchmarks/benchmark_{}.json'.format(datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S"))
+    return suites, output_file, n_train, batch_sizes
+
+
+def main():
+    suites, output_file, n_train, batch_sizes = read_commandline_args()
+    report = run_benchmarks(suites, n_train=n_train, n_test=min(DEFAULT_N_TEST, n_train),
+                            predict_batch_sizes=batch_sizes)
+    output_dir = os.path.dirname(output_file)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Benchmark results written to {}".format(output_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+# data_parallel.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Synchronous data-parallel training on one CPU host. n_replicas worker
+# processes each build the model (model_utils.load_model) and, for every global
+# batch, compute the gradients on their shard of it. The gradients are
+# averaged by an allreduce over shared memory:
+#   - every replica writes its (sample weighted) flat gradient to its row of a
+#     shared buffer in /dev/shm
+#   - every replica sums 1 / n_replicas of the columns over all rows and writes
+#     the average of its chunk (reduce-scatter)
+#   - every replica applies the full averaged gradient with the model's own
+#     optimizer
+# so all replicas take identical steps and stay in sync. Replica 0 broadcasts
+# its weights at the start and after every epoch, runs the validation and
+# writes the checkpoints with the model's saver, so they can be restored with
+# load_model as before.
+#
+# The global batch keeps the size of single process training (128 by default)
+# and is split over the replicas, so the optimization is the same as with
+# model.fit. Every replica gets cpu_count / n_replicas TF threads.
+# TensorFlow is only imported in the replicas, after the fork.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from data_parallel import fit_data_parallel
+# fit_data_parallel({'model_id': 'simple_cnn', 'n_classes': 10, 'is_training': True}, X, Y, n_epoch=200, n_replicas=8)
+#
+# or through pipeline.py: python pipeline.py -t train -m <model_id> -r <n_replicas>
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys
+import time
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+from multiprocessing import Process, Condition, Value
+
+import numpy as np
+
+from dataset_view import split_views
+from input_pipeline import BatchPrefetcher, get_training_transform_fns, _run_validation
+
+
+BARRIER_TIMEOUT = 1800.  # seconds a replica waits for the others before giving up
+
+
+class ProcessBarrier(object):
+    # Reusable barrier for forked processes (multiprocessing has none in python 2).
+    def __init__(self, n_processes):
+        self.n_processes = n_processes
+        self.condition = Condition()
+        self.count = Value('i', 0, lock=False)
+        self.generation = Value('i', 0, lock=False)
+
+    def wait(self, timeout=BARRIER_TIMEOUT):
+        with self.condition:
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.n_processes:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+                return
+            deadline = time.time() + timeout
+            while generation == self.generation.value:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out after {}s waiting for the other replicas".format(timeout))
+                self.condition.wait(remaining)
+
+
+class _SharedBuffers(object):
+    # Float32 arrays in a file under shm_dir, mapped by every replica.
+    def __init__(self, shm_dir, n_replicas, n_params, create):
+        mode = 'w+' if create else 'r+'
+        # Row r < n_replicas: gradient of replica r. Last row: averaged gradient, or the weights when broadcasting.
+        self.grads = np.memmap(os.path.join(shm_dir, 'grads'), dtype=np.float32, mode=mode,
+                               shape=(n_replicas + 1, n_params))
+        # Per replica: summed loss and number of samples of its shard.
+        self.stats = np.memmap(os.path.join(shm_dir, 'stats'), dtype=np.float64, mode=mode, shape=(n_replicas, 2))
+
+
+class _Replica(object):
+    def __init__(self, rank, n_replicas, model_kwargs, n_threads):
+        import tensorflow as tf
+        import tflearn
+        from model_utils import load_model
+
+        self.rank, self.n_replicas = rank, n_replicas
+        tflearn.init_graph(num_cores=n_threads)
+        self.model = load_model(**model_kwargs)
+        self.session = self.model.session
+        self.train_op = self.model.trainer.train_ops[0]
+        self.input_placeholder, self.target_placeholder = self.model.inputs[0], self.model.targets[0]
+
+        with self.session.graph.as_default():
+            self.variables = list(self.train_op.train_vars)
+            grads = tf.gradients(self.train_op.loss, self.variables)
+            self.grads = [tf.convert_to_tensor(grad) if grad is not None else tf.zeros_like(var)
+                          for grad, var in zip(grads, self.variables)]
+            # The averaged gradients are fed back into the model's optimizer, so its slots (e.g. adam's moments)
+            # and the training step counter are the ones the checkpoints save.
+            self.grad_placeholders = [tf.placeholder(tf.float32, var.get_shape()) for var in self.variables]
+            self.apply_averaged_grads = self.train_op.optimizer.apply_gradients(
+                zip(self.grad_placeholders, self.variables), global_step=self.train_op.training_steps)
+            self.weight_placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                                        for var in self.variables]
+            self.assign_weights = tf.group(*[tf.assign(var, placeholder) for var, placeholder
+                                             in zip(self.variables, self.weight_placeholders)])
+
+        sizes = [int(np.prod(var.get_shape().as_list())) for var in self.variables]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.shapes = [var.get_shape().as_list() for var in self.variables]
+        self.n_params = int(self.offsets[-1])
+        # Columns this replica reduces in the reduce-scatter.
+        bounds = np.linspace(0, self.n_params, n_replicas + 1).astype(np.int64)
+        self.chunk = slice(bounds[rank], bounds[rank + 1])
+
+    def _unflatten(self, flat):
+        return [flat[self.offsets[i]:self.offsets[i + 1]].reshape(shape) for i, shape in enumerate(self.shapes)]
+
+    def broadcast_weights(self, buffers, barrier):
+        # Replica 0's weights to every replica.
+        if self.rank == 0:
+            for i, value in enumerate(self.session.run(self.variables)):
+                buffers.grads[-1, self.offsets[i]:self.offsets[i + 1]] = value.ravel()
+        barrier.wait()
+        if self.rank != 0:
+            self.session.run(self.assign_weights, feed_dict=dict(zip(self.weight_placeholders,
+                                                                     self._unflatten(buffers.grads[-1]))))
+        barrier.wait()
+
+    def step(self, X_shard, Y_shard, buffers, barrier):
+        n_samples = len(X_shard)
+        if n_samples > 0:
+            values = self.session.run(self.grads + [self.train_op.loss],
+                                      feed_dict={self.input_placeholder: X_shard, self.target_placeholder: Y_shard})
+            for i, grad in enumerate(values[:-1]):
+                buffers.grads[self.rank, self.offsets[i]:self.offsets[i + 1]] = grad.ravel() * n_samples
+            buffers.stats[self.rank] = (values[-1] * n_samples, n_samples)
+        else:
+            buffers.grads[self.rank] = 0.
+            buffers.stats[self.rank] = (0., 0.)
+        barrier.wait()
+
+        total_samples = buffers.stats[:, 1].sum()
+        buffers.grads[-1, self.chunk] = buffers.grads[:-1, self.chunk].sum(axis=0) / total_samples
+        barrier.wait()
+
+        self.session.run(self.apply_averaged_grads, feed_dict=dict(zip(self.grad_placeholders,
+                                                                       self._unflatten(buffers.grads[-1]))))
+        loss = buffers.stats[:, 0].sum() / total_samples
+        # Nobody may overwrite the averaged gradient or the stats before everyone has read them.
+        barrier.wait()
+        return loss
+
+
+def _run_replica(rank, n_replicas, model_kwargs, n_threads, shm_dir, barrier, X, Y, X_val, Y_val, n_epoch,
+                 batch_size, shuffle, snapshot_step, seed):
+    import tflearn
+
+    try:
+        replica = _Replica(rank, n_replicas, model_kwargs, n_threads)
+        if rank == 0:
+            _SharedBuffers(shm_dir, n_replicas, replica.n_params, create=True)
+        barrier.wait()
+        buffers = _SharedBuffers(shm_dir, n_replicas, replica.n_params, create=False)
+
+        # Same featurewise statistics in every replica, different augmentations. Validation batches only get the
+        # preprocessing.
+        transform_fn, val_transform_fn = get_training_transform_fns(replica.model, X, seed=seed)
+        np.random.seed(seed + 1 + rank)
+        # Every replica draws the same global batches and takes its own shard of each.
+        batch_random_state = np.random.RandomState(seed)
+        val_prefetcher = None
+        if rank == 0 and X_val is not None:
+            val_prefetcher = BatchPrefetcher(X_val, Y_val, batch_size=batch_size, shuffle=False,
+                                             transform_fn=val_transform_fn, n_workers=1)
+
+        replica.broadcast_weights(buffers, barrier)
+        model, step = replica.model, 0
+        for epoch in xrange(n_epoch):
+            epoch_start = time.time()
+            losses = []
+            tflearn.is_training(True, session=replica.session)
+            index_array = batch_random_state.permutation(len(X)) if shuffle else np.arange(len(X))
+            for start in xrange(0, len(X), batch_size):
+                shard_indices = np.sort(index_array[start:start + batch_size][rank::n_replicas])
+                X_shard, Y_shard = np.asarray(X[shard_indices]), np.asarray(Y[shard_indices])
+                if transform_fn is not None and len(X_shard):
+                    X_shard = transform_fn(X_shard)
+                losses.append(replica.step(X_shard, Y_shard, buffers, barrier))
+                step += 1
+                if rank == 0 and snapshot_step and step % snapshot_step == 0:
+                    model.trainer.save(model.trainer.checkpoint_path, global_step=step)
+
+            replica.broadcast_weights(buffers, barrier)
+            if rank == 0:
+                message = "Epoch {} | step {} | loss: {:.5f} | {:.1f}s | {} replicas".format(
+                    epoch + 1, step, np.mean(losses), time.time() - epoch_start, n_replicas)
+                if val_prefetcher is not None:
+                    val_values = _run_validation(model, replica.train_op, val_prefetcher)
+                    message += " | val_loss: {:.5f}".format(val_values[0])
+                    if len(val_values) > 1:
+                        message += " | val_acc: {:.4f}".format(val_values[1])
+                print(message)
+                sys.stdout.flush()
+                if model.trainer.checkpoint_path:
+                    model.trainer.save(model.trainer.checkpoint_path, global_step=step)
+            barrier.wait()
+        if val_prefetcher is not None:
+            val_prefetcher.close()
+    except Exception:
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+
+
+def fit_data_parallel(model_kwargs, X, Y, n_epoch=10, batch_size=128, validation_set=None, shuffle=True,
+                      snapshot_step=None, n_replicas=2, seed=None):
+    """
+    Trains the model load_model(**model_kwargs) builds, with n_replicas synchronous data-parallel processes.
+
+    Args:
+        model_kwargs: keyword arguments of model_utils.load_model, with is_training=True
+        validation_set: None, a float (fraction of X, Y held out from the end, like tflearn) or a tuple (X_val, Y_val)
+        batch_size: global batch size, split over the replicas
+        snapshot_step: save a checkpoint every snapshot_step training steps (and always at the end of each epoch)
+    """
+    assert n_replicas > 0 and batch_size >= n_replicas
+    X_val, Y_val = None, None
+    if isinstance(validation_set, float):
+        (X, Y), (X_val, Y_val) = split_views([X, Y], validation_set)
+    elif validation_set is not None:
+        X_val, Y_val = validation_set
+
+    seed = np.random.randint(2 ** 31 - n_replicas - 1) if seed is None else seed
+    n_threads = max(1, multiprocessing.cpu_count() // n_replicas)
+    shm_dir = tempfile.mkdtemp(prefix='data_parallel_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    barrier = ProcessBarrier(n_replicas)
+    print("Training with {} data-parallel replicas, {} threads each, global batch size {}".format(
+        n_replicas, n_threads, batch_size))
+    # X, Y are inherited by the forked replicas (cheap for memory-mapped stores).
+    replicas = [Process(target=_run_replica, args=(rank, n_replicas, model_kwargs, n_threads, shm_dir, barrier, X, Y,
+                                                   X_val, Y_val, n_epoch, batch_size, shuffle, snapshot_step, seed))
+                for rank in xrange(n_replicas)]
+    try:
+        for replica in replicas:
+            replica.start()
+        while any(replica.is_alive() for replica in replicas):
+            if any(replica.exitcode for replica in replicas):
+                raise Exception("A data-parallel replica failed, see its traceback above")
+            time.sleep(1.)
+        if any(replica.exitcode for replica in replicas):
+            raise Exception("A data-parallel replica failed, see its traceback above")
+    finally:
+        for replica in replicas:
+            if replica.is_alive():
+                replica.terminate()
+            replica.join()
+        shutil.rmtree(shm_dir, ignore_errors=True)
@@ -10,29 +10,25 @@
 # USAGE: from data_utils import *
 #
 
-import os, struct
+# Only numpy-level dependencies here: data_utils is imported by every entry point (pipeline.py -h included), so
+# tensorflow / tflearn, sklearn and the plotting libraries are imported by the modules that actually use them.
+import os, sys, struct
 import numpy as np
-from tflearn.data_utils import shuffle
 
 from array import array as pyarray
 from numpy import append, array, int8, uint8, zeros, int32, float32
 
 import cPickle as pickle
-from scipy.misc import imread
-
-from sklearn.manifold import TSNE
-from tflearn.data_utils import to_categorical, pad_sequences
-from sklearn.metrics import accuracy_score
-import matplotlib.pyplot as plt
-from matplotlib import style
-
-import pandas as pd
-import seaborn as sns
-from sklearn.decomposition import PCA
 
 from collections import defaultdict
 
 from constants import *
+from dataset_cache import load_or_build_cached_arrays
+from image_store import NormalizedImages
+from dataset_view import view_rows, seeded_permutation, split_views
+from label_hierarchy import LabelHierarchy, ROLE_JOINT, ROLE_GATE, ROLE_TEST_ONLY
+from dataset_stats import compute_dataset_stats
+from feature_sets import get_feature_set_dir, feature_set_exists, load_feature_set
 
 
 CIFAR10_DIR = '../data/cifar-10-batches-py'
@@ -41,113 +37,110 @@ CIFAR100_DIR = '../data/cifar-100-python'
 
 EPSILON = 1e-8
 
+# Seed of the shuffles in load_data, so every run sees the same order (and the same fine_only split).
+DATASET_SHUFFLE_SEED = 0
+
+# 'memory': float64 arrays (memory-mapped from the dataset cache when use_cache=True)
+# 'uint8_mmap': images stay uint8 in a memory-mapped file and are normalized to float32 per batch (see image_store.py)
+STORAGE_TYPES = ['memory', 'uint8_mmap']
+
+PYRAMID_ARRAY_NAMES = ['X_train_joint', 'y_train_joint', 'X_train_gate', 'y_train_gate', 'fine_or_coarse_train_gate',
+                       'X_test', 'y_test', 'fine_or_coarse_test']
+
+# Arrays returned by load_data_pyramid for each return_subset, in order.
+PYRAMID_SUBSET_ARRAY_NAMES = {
+    'all': PYRAMID_ARRAY_NAMES,
+    'joint_only': ['X_train_joint', 'y_train_joint'],
+    'gate_only': ['X_train_gate', 'y_train_gate', 'fine_or_coarse_train_gate'],
+    'test_only': ['X_test', 'y_test', 'fine_or_coarse_test']
+}
 
-def load_data(dataset='cifar10', num_training=50000, num_test=10000, normalize=True):
+
+def load_data(dataset='cifar10', num_training=50000, num_test=10000, normalize=True, use_cache=True, storage='memory',
+              seed=DATASET_SHUFFLE_SEED):
+    # X and X_test are index views over the loaded arrays (see dataset_view.py), shuffling doesn't copy them.
     print("Attempting to load dataset {} ...".format(dataset))
     X, Y, X_test, Y_test = None, None, None, None
     n_classes = 0
     if dataset == 'cifar10':
         X, Y, X_val, Y_val, X_test, Y_test = load_cifar(num_training=num_training, num_validation=0, num_test=num_test,
-                                                    dataset='cifar10', normalize=normalize)
+                                                    dataset='cifar10', normalize=normalize, use_cache=use_cache,
+                                                    storage=storage)
     elif dataset == 'cifar100_coarse':
         X, Y, X_val, Y_val, X_test, Y_test = load_cifar(num_training=num_training, num_validation=0, num_test=num_test,
-                                                        dataset='cifar100', normalize=normalize)
+                                                        dataset='cifar100', normalize=normalize, use_cache=use_cache,
+                                                        storage=storage)
         Y = Y[:,1]
         Y_test = Y_test[:,1]
 
     elif dataset == 'cifar100_fine':
         X, Y, X_val, Y_val, X_test, Y_test = load_cifar(num_training=num_training, num_validation=0, num_test=num_test,
-                                                        dataset='cifar100', normalize=normalize)
+                                                        dataset='cifar100', normalize=normalize, use_cache=use_cache,
+                                                        storage=storage)
         Y = Y[:, 0]
         Y_test = Y_test[:, 0]
     elif dataset == 'cifar100_joint_fine_only':
-        X_train_joint, y_train_joint = load_data_pyramid(dataset="cifar100_joint", return_subset='joint_only', normalize=normalize)
+        X_train_joint, y_train_joint = load_data_pyramid(dataset="cifar100_joint", return_subset='joint_only', normalize=normalize,
+                                                         use_cache=use_cache, storage=storage)
         all_X = X_train_joint
         all_Y = y_train_joint[:, 0]  # extract only FINE... no coarse
-        all_X, all_Y = shuffle(all_X, all_Y)
-
-        testSplitIndex = int(len(all_X) * 0.85)
-        X = all_X[:testSplitIndex]
-        Y = all_Y[:testSplitIndex]
-        X_test = all_X[testSplitIndex:]
-        Y_test = all_Y[testSplitIndex:]
+        all_X, all_Y = shuffle_data(all_X, all_Y, seed=seed)
+        (X, Y), (X_test, Y_test) = split_views([all_X, all_Y], 0.15)
     else:
         print ("Dataset {} not found. ".format(dataset))
         sys.exit()
     n_classes = DATASET_TO_N_CLASSES[dataset]
-    X, Y = shuffle(X, Y)
+    X, Y = shuffle_data(X, Y, seed=seed)
     Y = to_categorical(Y, n_classes)
-    X_test, Y_test = shuffle(X_test, Y_test)
+    X_test, Y_test = shuffle_data(X_test, Y_test, seed=seed)
     Y_test = to_categorical(Y_test, n_classes)
     return X, Y, X_test, Y_test
 
 
-def load_cifar100_prefeaturized():
-    dataset_name = "cifar100_joint_prefeaturized"
-    return pickle.load(open("../data/feature_sets/cifar100_joint_prefeaturized"))
+def load_cifar100_prefeaturized(array_names=PYRAMID_ARRAY_NAMES):
+    """
+    Returns a dict name -> array with only the requested arrays of the prefeaturized pyramid dataset, memory-mapped
+    from the feature set written by feature_extractor.py (see feature_sets.py).
+    """
+    feature_set_dir = get_feature_set_dir("cifar100_joint")
+    if feature_set_exists(feature_set_dir):
+        return load_feature_set(feature_set_dir, array_names)
+    # Legacy format: one pickled list of all eight arrays.
+    dataset_contents = pickle.load(open("../data/feature_sets/cifar100_joint_prefeaturized"))
+    return dict((name, np.asarray(array)) for name, array in zip(PYRAMID_ARRAY_NAMES, dataset_contents)
+                if name in array_names)
 
 
-def load_data_pyramid(dataset='cifar100_joint', return_subset='all', normalize=True):
+def load_data_pyramid(dataset='cifar100_joint', return_subset='all', normalize=True, use_cache=True, storage='memory'):
+    array_names = PYRAMID_SUBSET_ARRAY_NAMES[return_subset]
     if dataset == 'cifar100_joint':
-        X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, X_test, y_test, \
-        fine_or_coarse_test = load_cifar_pyramid(normalize=normalize)
+        arrays = dict(zip(PYRAMID_ARRAY_NAMES, load_cifar_pyramid(normalize=normalize, use_cache=use_cache,
+                                                                  storage=storage)))
     elif dataset == 'cifar100_joint_prefeaturized':
-        X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, X_test, y_test, \
-        fine_or_coarse_test = load_cifar100_prefeaturized()
+        arrays = load_cifar100_prefeaturized(array_names)
     else:
         raise Exception("Dataset {} not found. ".format(dataset))
 
-    if return_subset == 'all':
-        return X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, X_test, y_test, fine_or_coarse_test
-    elif return_subset == 'joint_only':
-        return X_train_joint, y_train_joint
-    elif return_subset == 'gate_only':
-        return X_train_gate, y_train_gate, fine_or_coarse_train_gate
-    elif return_subset == 'test_only':
-        return X_test, y_test, fine_or_coarse_test
+    return tuple(arrays[name] for name in array_names)
 
 
-def load_pyramid_test_subset(test_subset="seen_fine", normalize=True):
+def load_pyramid_test_subset(test_subset="seen_fine", normalize=True, use_cache=True, storage='memory'):
     # test_subset: "seen_fine" (A), "seen_coarse" (B), "unseen" (C)
-    coarse_to_fine_map = load_coarse_to_fine_map()
-    X_test, y_test, fine_or_coarse_test = load_data_pyramid(dataset='cifar100_joint', return_subset='test_only', normalize=normalize)
-    fine_label_names, coarse_label_names = load_cifar100_label_names(label_type='all')
-
-    fine_labels_seen_fine = set()
-    fine_labels_seen_coarse = set()
-    fine_labels_unseen = set()
-
-    for coarse_label, fine_labels in coarse_to_fine_map.iteritems():
-        fine_labels_seen_fine.update(set(fine_labels[:2]))
-        fine_labels_seen_coarse.update(set(fine_labels[2:4]))
-        fine_labels_unseen.update(set(fine_labels[4:5]))
+    X_test, y_test, fine_or_coarse_test = load_data_pyramid(dataset='cifar100_joint', return_subset='test_only', normalize=normalize,
+                                                            use_cache=use_cache, storage=storage)
 
+    # seen_fine: first 2 fine labels per coarse class, seen_coarse: the next 2, unseen: the 5th (see label_hierarchy.py).
     # Subset of test set with fine labels that have been used during training
     # For this subset, the model should ideally always predict the fine label
-    X_test_A, y_test_A, fine_or_coarse_A = [], [], []
-    X_test_B, y_test_B, fine_or_coarse_B = [], [], []
-    X_test_C, y_test_C, fine_or_coarse_C = [], [], []
-
     # a 0  in coarse_or_fine indicates it should predict fine, a 1 indicate it should predict coarse.
+    test_roles = load_cifar100_label_hierarchy(use_cache=use_cache).fine_role[y_test[:, 0]]
+    indices_A = np.flatnonzero(test_roles == ROLE_JOINT)
+    indices_B = np.flatnonzero(test_roles == ROLE_GATE)
+    indices_C = np.flatnonzero(test_roles == ROLE_TEST_ONLY)
 
-    for i in xrange(X_test.shape[0]):
-        fine_label = fine_label_names[y_test[i, 0]]
-        if fine_label in fine_labels_seen_fine:
-            X_test_A.append(X_test[i])
-            y_test_A.append(y_test[i])
-            fine_or_coarse_A.append(fine_or_coarse_test[i])
-        elif fine_label in fine_labels_seen_coarse:
-            X_test_B.append(X_test[i])
-            y_test_B.append(y_test[i])
-            fine_or_coarse_B.append(fine_or_coarse_test[i])
-        elif fine_label in fine_labels_unseen:
-            X_test_C.append(X_test[i])
-            y_test_C.append(y_test[i])
-            fine_or_coarse_C.append(fine_or_coarse_test[i])
-
-    X_test_A, y_test_A, fine_or_coarse_A = np.array(X_test_A), np.array(y_test_A), np.array(fine_or_coarse_A)
-    X_test_B, y_test_B, fine_or_coarse_B = np.array(X_test_B), np.array(y_test_B), np.array(fine_or_coarse_B)
-    X_test_C, y_test_C, fine_or_coarse_C = np.array(X_test_C), np.array(y_test_C), np.array(fine_or_coarse_C)
+    X_test_A, y_test_A, fine_or_coarse_A = select_rows(X_test, indices_A), y_test[indices_A], fine_or_coarse_test[indices_A]
+    X_test_B, y_test_B, fine_or_coarse_B = select_rows(X_test, indices_B), y_test[indices_B], fine_or_coarse_test[indices_B]
+    X_test_C, y_test_C, fine_or_coarse_C = select_rows(X_test, indices_C), y_test[indices_C], fine_or_coarse_test[indices_C]
 
     if test_subset == "seen_fine":
         return X_test_A, y_test_A, fine_or_coarse_A
@@ -175,7 +168,8 @@ def change_to_array(M, H, W):
     return X, y
 
 
-def load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='cifar10', normalize=True):
+def load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='cifar10', normalize=True,
+               use_cache=True, storage='memory'):
     """
     WARNING: Needs to be run from code directory, otherwise relative path
     will not work.
@@ -189,10 +183,53 @@ def load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='ci
     Hence:
     y_fine = y[:,0]
     y_coarse = y[:,1]
+
+    Normalized train/test arrays are cached on disk (see dataset_cache.py) and returned memory-mapped and
+    read-only. Pass use_cache=False to rebuild them from the raw batches in memory.
+
+    With storage='uint8_mmap', X_train, X_val and X_test are NormalizedImages views over uint8 images, which are
+    normalized to float32 one batch at a time when indexed.
     """
     # Load the raw CIFAR-10 data
     print (dataset)
     assert (dataset in ['cifar10', 'cifar100']), "dataset has to be either cifar10 or cifar100. "
+    assert (storage in STORAGE_TYPES), "storage has to be one of {}. ".format(STORAGE_TYPES)
+    if storage == 'uint8_mmap':
+        # uint8 images do not depend on normalize, the stats are applied lazily.
+        arrays, metadata = load_or_build_cached_arrays(dataset + '_uint8', False, ['X_train', 'y_train', 'X_test', 'y_test'],
+                                                       lambda: _build_cifar_uint8(dataset),
+                                                       source_files=_cifar_source_files(dataset), use_cache=use_cache)
+    else:
+        arrays, metadata = load_or_build_cached_arrays(dataset, normalize, ['X_train', 'y_train', 'X_test', 'y_test'],
+                                                       lambda: _build_cifar(dataset, normalize),
+                                                       source_files=_cifar_source_files(dataset), use_cache=use_cache)
+    X_train, y_train, X_test, y_test = arrays['X_train'], arrays['y_train'], arrays['X_test'], arrays['y_test']
+    if storage == 'uint8_mmap':
+        mean, scale = (metadata['mean'], metadata['std'] + EPSILON) if normalize else (0., 1.)
+        X_train, X_test = NormalizedImages(X_train, mean, scale), NormalizedImages(X_test, mean, scale)
+
+    print ("mean: {}".format(metadata['mean']))
+    print ("std dev: {}".format(metadata['std']))
+
+    # Subsample the data (slices, so cached arrays stay memory-mapped)
+    X_val = X_train[num_training:num_training + num_validation]
+    y_val = y_train[num_training:num_training + num_validation]
+    X_train = X_train[:num_training]
+    y_train = y_train[:num_training]
+    X_test = X_test[:num_test]
+    y_test = y_test[:num_test]
+
+    return X_train, y_train, X_val, y_val, X_test, y_test
+
+
+def _cifar_source_files(dataset):
+    if dataset == 'cifar10':
+        return [os.path.join(CIFAR10_DIR, 'data_batch_%d' % (b, )) for b in range(1, 6)] + \
+               [os.path.join(CIFAR10_DIR, 'test_batch')]
+    return [os.path.join(CIFAR100_DIR, 'train'), os.path.join(CIFAR100_DIR, 'test')]
+
+
+def _build_cifar(dataset, normalize):
     if dataset == 'cifar10':
         X_train, y_train, X_test, y_test = _load_cifar10(CIFAR10_DIR)
     elif dataset == 'cifar100':
@@ -200,11 +237,10 @@ def load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='ci
         y_train = np.stack((y_fine_train, y_coarse_train)).swapaxes(0,1)
         y_test = np.stack((y_fine_test, y_coarse_test)).swapaxes(0,1)
 
-    mean_image = np.mean(X_train)
-    std_deviation = np.mean(np.std(X_train, axis=0))
+    # One streaming pass over X_train, without float64 temporaries of its size (see dataset_stats.py).
+    stats = compute_dataset_stats(X_train)
+    mean_image, std_deviation = stats['mean'], stats['std']
 
-    print ("mean: {}".format(mean_image))
-    print ("std dev: {}".format(std_deviation))
     if normalize:
         print ("Normalizing data")
         X_train -= mean_image
@@ -212,96 +248,113 @@ def load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='ci
         X_train /= (std_deviation + EPSILON)
         X_test /= (std_deviation + EPSILON)
 
-    # Subsample the data
-    mask = range(num_training, num_training + num_validation)
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = range(num_training)
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = range(num_test)
-    X_test = X_test[mask]
-    y_test = y_test[mask]
+    arrays = {'X_train': X_train, 'y_train': y_train, 'X_test': X_test, 'y_test': y_test}
+    return arrays, stats
+
+
+def _build_cifar_uint8(dataset):
+    if dataset == 'cifar10':
+        X_train, y_train, X_test, y_test = _load_cifar10(CIFAR10_DIR, dtype=np.uint8)
+    elif dataset == 'cifar100':
+        X_train, y_fine_train, y_coarse_train, X_test, y_fine_test, y_coarse_test = _load_cifar100(CIFAR100_DIR,
+                                                                                                   dtype=np.uint8)
+        y_train = np.stack((y_fine_train, y_coarse_train)).swapaxes(0,1)
+        y_test = np.stack((y_fine_test, y_coarse_test)).swapaxes(0,1)
+
+    arrays = {'X_train': X_train, 'y_train': y_train, 'X_test': X_test, 'y_test': y_test}
+    return arrays, compute_dataset_stats(X_train)
+
+
+def load_cifar_stats(dataset='cifar10', use_cache=True):
+    """
+    Statistics of the raw cifar10 / cifar100 training images (see dataset_stats.compute_dataset_stats), stored with
+    the uint8 dataset cache entry, which is built if needed.
+    """
+    assert (dataset in ['cifar10', 'cifar100']), "dataset has to be either cifar10 or cifar100. "
+    _, metadata = load_or_build_cached_arrays(dataset + '_uint8', False, ['X_train'],
+                                              lambda: _build_cifar_uint8(dataset),
+                                              source_files=_cifar_source_files(dataset), use_cache=use_cache)
+    return metadata
+
+
+def select_rows(X, indices):
+    # Like X[indices], but returns an index view over X's backing array instead of gathering a copy.
+    return view_rows(X, indices)
 
-    return X_train, y_train, X_val, y_val, X_test, y_test
 
+def shuffle_data(X, Y, seed=None):
+    # Like tflearn's shuffle(X, Y), but X only gets a permuted index view (see select_rows). The labels are gathered.
+    permutation = seeded_permutation(len(X), seed)
+    return select_rows(X, permutation), np.asarray(Y)[permutation]
 
-def get_cifar_fine_labels_split(coarse_to_fine_map):
-    fine_labels_joint = set()
-    fine_labels_gate = set()
-    fine_labels_only_test = set()
 
-    for coarse_label, fine_labels in coarse_to_fine_map.iteritems():
-        fine_labels_joint.update(set(fine_labels[:2]))
-        fine_labels_gate.update(set(fine_labels[:4]))
-        fine_labels_only_test.update(set(fine_labels[4]))
+def to_categorical(y, nb_classes):
+    # Same as tflearn.data_utils.to_categorical, without importing tensorflow.
+    y = np.asarray(y, dtype='int32')
+    Y = np.zeros((len(y), nb_classes))
+    Y[np.arange(len(y)), y] = 1.
+    return Y
+
+
+def get_cifar_fine_labels_split(label_hierarchy):
+    """
+    Returns the fine label ids of the joint (first 2 fine labels of each coarse class, trained on at the fine level),
+    gate (first 4, used to train the gate) and only test (5th, never seen during training) parts of the split.
+    """
+    return (np.flatnonzero(label_hierarchy.joint_mask()), np.flatnonzero(label_hierarchy.gate_mask()),
+            np.flatnonzero(label_hierarchy.only_test_mask()))
 
-    return fine_labels_joint, fine_labels_gate, fine_labels_only_test
 
+def load_cifar_pyramid(normalize=True, use_cache=True, storage='memory'):
+    if storage == 'uint8_mmap':
+        # Subsets are index views over the shared uint8 store, so there is nothing worth caching.
+        arrays, _ = _build_cifar_pyramid(normalize, use_cache, storage=storage)
+        return tuple(arrays[name] for name in PYRAMID_ARRAY_NAMES)
 
-def load_cifar_pyramid(normalize=True):
+    # The split depends on the label hierarchy, which is derived from the labels of the source files.
+    source_files = _cifar_source_files('cifar100') + [os.path.join(CIFAR100_DIR, 'meta')]
+    arrays, metadata = load_or_build_cached_arrays('cifar100_joint', normalize, PYRAMID_ARRAY_NAMES,
+                                                   lambda: _build_cifar_pyramid(normalize, use_cache),
+                                                   source_files=source_files, use_cache=use_cache)
+    return tuple(arrays[name] for name in PYRAMID_ARRAY_NAMES)
+
+
+def _build_cifar_pyramid(normalize, use_cache, storage='memory'):
     X_train, y_train, X_val, y_val, X_test, y_test = \
-        load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='cifar100', normalize=normalize)
+        load_cifar(num_training=50000, num_validation=0, num_test=10000, dataset='cifar100', normalize=normalize,
+                   use_cache=use_cache, storage=storage)
 
-    coarse_to_fine_map = load_coarse_to_fine_map()
-    #
-    fine_label_names, coarse_label_names = load_cifar100_label_names(label_type='all')
-    fine_labels_joint = set()
-    fine_labels_gate = set()
-    fine_labels_only_test = set()
-
-    for coarse_label, fine_labels in coarse_to_fine_map.iteritems():
-        fine_labels_joint.update(set(fine_labels[:2]))
-        fine_labels_gate.update(set(fine_labels[:4]))
-        fine_labels_only_test.update(set(fine_labels[4]))
-
-    X_train_joint, y_train_joint = [], []
-
-    X_train_gate, y_train_gate = [], []
-
-    fine_or_coarse_train_gate = [] # a 0 indicates it should predict fine, a 1 indicate it should predict coarse.
-
-    for i in xrange(X_train.shape[0]):
-        fine_label = fine_label_names[y_train[i, 0]]
-        if fine_label in fine_labels_joint:
-            X_train_joint.append(X_train[i])
-            y_train_joint.append(y_train[i])
-        if fine_label in fine_labels_gate:
-            X_train_gate.append(X_train[i])
-            y_train_gate.append(y_train[i])
-            if fine_label in fine_labels_joint:
-                fine_or_coarse_train_gate.append(0)
-            else:
-                fine_or_coarse_train_gate.append(1)
-
-    X_train_joint = np.array(X_train_joint)
-    y_train_joint = np.array(y_train_joint) # shape (num_samples, 2)
-
-    X_train_gate = np.array(X_train_gate)
-    y_train_gate = np.array(y_train_gate) # shape (num_samples, 2)
-    fine_or_coarse_train_gate = np.array(fine_or_coarse_train_gate)
-    # print fine_or_coarse_train_gate.shape
-    fine_or_coarse_test = []
-
-    for i in xrange(X_test.shape[0]):
-        fine_label = fine_label_names[y_test[i,0]]
-        if fine_label in fine_labels_joint: # if label of current sample is one of the fine classes we trained on.
-            fine_or_coarse_test.append(0)
-        else:
-            fine_or_coarse_test.append(1)
-
-    fine_or_coarse_test = np.array(fine_or_coarse_test)
-
-    return X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, X_test, y_test, fine_or_coarse_test
-
-
-def _load_cifar100(ROOT):
-    Xtr, Y_fine_tr, Y_coarse_tr = _load_cifar100_batch(os.path.join(ROOT, 'train'))
-    Xte, Y_fine_te, Y_coarse_te  = _load_cifar100_batch(os.path.join(ROOT, 'test'))
+    label_hierarchy = load_cifar100_label_hierarchy(use_cache=use_cache)
+    joint_mask, gate_mask = label_hierarchy.joint_mask(), label_hierarchy.gate_mask()
+
+    # One lookup per sample into the per-fine-label masks, then a single gather per subset.
+    is_joint_train = joint_mask[y_train[:, 0]]
+    joint_indices = np.flatnonzero(is_joint_train)
+    gate_indices = np.flatnonzero(gate_mask[y_train[:, 0]])
+
+    X_train_joint = select_rows(X_train, joint_indices)
+    y_train_joint = y_train[joint_indices] # shape (num_samples, 2)
+
+    X_train_gate = select_rows(X_train, gate_indices)
+    y_train_gate = y_train[gate_indices] # shape (num_samples, 2)
+
+    # a 0 indicates it should predict fine, a 1 indicate it should predict coarse.
+    fine_or_coarse_train_gate = np.logical_not(is_joint_train[gate_indices]).astype(int)
+    # 0 if label of current sample is one of the fine classes we trained on.
+    fine_or_coarse_test = np.logical_not(joint_mask[y_test[:, 0]]).astype(int)
+
+    arrays = dict(zip(PYRAMID_ARRAY_NAMES, [X_train_joint, y_train_joint, X_train_gate, y_train_gate,
+                                            fine_or_coarse_train_gate, X_test, y_test, fine_or_coarse_test]))
+    return arrays, {}
+
+
+def _load_cifar100(ROOT, dtype="float"):
+    Xtr, Y_fine_tr, Y_coarse_tr = _load_cifar100_batch(os.path.join(ROOT, 'train'), dtype=dtype)
+    Xte, Y_fine_te, Y_coarse_te  = _load_cifar100_batch(os.path.join(ROOT, 'test'), dtype=dtype)
     return Xtr, Y_fine_tr, Y_coarse_tr, Xte, Y_fine_te, Y_coarse_te
 
 
-def _load_cifar100_batch(filename):
+def _load_cifar100_batch(filename, dtype="float"):
     with open(filename, 'rb') as f:
         datadict = pickle.load(f)
         batch_label = datadict['batch_label']
@@ -310,35 +363,29 @@ def _load_cifar100_batch(filename):
         Y_fine = datadict['fine_labels']
         Y_coarse = datadict['coarse_labels']
 
-        num_samples = 0
-        if batch_label == 'training batch 1 of 1':
-            num_samples = 50000
-
-        elif batch_label == 'testing batch 1 of 1':
-            num_samples = 10000
-        X = X.reshape(num_samples, 3, 32, 32).transpose(0, 2, 3, 1).astype("float")
+        X = X.reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1).astype(dtype)
         Y_fine = np.array(Y_fine)
         Y_coarse = np.array(Y_coarse)
         return X, Y_fine, Y_coarse
 
 
-def _load_cifar10(ROOT):
+def _load_cifar10(ROOT, dtype="float"):
     """ load all of cifar, adapted from CS231N assignment 1 """
     xs = []
     ys = []
     for b in range(1,6):
         f = os.path.join(ROOT, 'data_batch_%d' % (b, ))
-        X, Y = _load_cifar10_batch(f)
+        X, Y = _load_cifar10_batch(f, dtype=dtype)
         xs.append(X)
         ys.append(Y)
     Xtr = np.concatenate(xs)
     Ytr = np.concatenate(ys)
     del X, Y
-    Xte, Yte = _load_cifar10_batch(os.path.join(ROOT, 'test_batch'))
+    Xte, Yte = _load_cifar10_batch(os.path.join(ROOT, 'test_batch'), dtype=dtype)
     return Xtr, Ytr, Xte, Yte
 
 
-def _load_cifar10_batch(filename):
+def _load_cifar10_batch(filename, dtype="float"):
     """ load single batch of cifar, adapted from CS231N assignment 1"""
     with open(filename, 'rb') as f:
         datadict = pickle.load(f)
@@ -346,7 +393,7 @@ def _load_cifar10_batch(filename):
         print ("loading cifar batch {}".format(batch_label))
         X = datadict['data']
         Y = datadict['labels']
-        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+        X = X.reshape(-1, 3, 32, 32).transpose(0,2,3,1).astype(dtype)
         Y = np.array(Y)
         return X, Y
 
@@ -379,29 +426,48 @@ def load_cifar100_label_names(label_type='all'):
             return coarse_label_names
 
 
-def load_coarse_to_fine_map():
-    coarse_to_fine_map = pickle.load(open('coarse_to_fine_map.pickle', 'rb+'))
-    return coarse_to_fine_map
+_label_hierarchies = {}
 
 
-def create_coarse_to_fine_map():
-    coarse_to_fine_map = defaultdict(set)
-    X_train, y_train, X_val, y_val, X_test, y_test = load_cifar(dataset='cifar100')
+def _build_cifar100_label_hierarchy():
+    # Only the labels of the training batch are needed, the images are neither reshaped nor normalized.
+    with open(os.path.join(CIFAR100_DIR, 'train'), 'rb') as f:
+        datadict = pickle.load(f)
     fine_label_names, coarse_label_names = load_cifar100_label_names(label_type='all')
+    label_hierarchy = LabelHierarchy.from_labels(datadict['fine_labels'], datadict['coarse_labels'], fine_label_names,
+                                                 coarse_label_names)
+    return {'fine_to_coarse': label_hierarchy.fine_to_coarse}, {'fine_label_names': fine_label_names,
+                                                                'coarse_label_names': coarse_label_names}
+
 
-    fine_y_train = y_train[:, 0]
-    coarse_y_train = y_train[:, 1]
+def load_cifar100_label_hierarchy(use_cache=True):
+    """
+    LabelHierarchy of CIFAR-100 (see label_hierarchy.py), derived from the raw training labels once, then served from
+    the dataset cache and kept in memory.
+    """
+    if use_cache and 'cifar100' in _label_hierarchies:
+        return _label_hierarchies['cifar100']
+    arrays, metadata = load_or_build_cached_arrays('cifar100_label_hierarchy', False, ['fine_to_coarse'],
+                                                   _build_cifar100_label_hierarchy,
+                                                   source_files=[os.path.join(CIFAR100_DIR, 'train'),
+                                                                 os.path.join(CIFAR100_DIR, 'meta')],
+                                                   use_cache=use_cache)
+    label_hierarchy = LabelHierarchy(np.array(arrays['fine_to_coarse']), metadata['fine_label_names'],
+                                     metadata['coarse_label_names'])
+    if use_cache:
+        _label_hierarchies['cifar100'] = label_hierarchy
+    return label_hierarchy
 
-    for i in xrange(y_train.shape[0]):
-        coarse_label = coarse_label_names[coarse_y_train[i]]
-        fine_label = fine_label_names[fine_y_train[i]]
 
-        if fine_label not in coarse_to_fine_map[coarse_label]:
-            coarse_to_fine_map[coarse_label].add(fine_label)
+def load_coarse_to_fine_map():
+    coarse_to_fine_map = pickle.load(open('coarse_to_fine_map.pickle', 'rb+'))
+    return coarse_to_fine_map
 
-    for k in coarse_to_fine_map:
-        coarse_to_fine_map[k] = sorted(list(coarse_to_fine_map[k]))
 
+def create_coarse_to_fine_map():
+    # Derived from the label hierarchy, so the images are not loaded. The dataset cache is keyed by this map's
+    # checksum, so it isn't used here.
+    coarse_to_fine_map = defaultdict(set, load_cifar100_label_hierarchy(use_cache=False).to_coarse_to_fine_map())
     print coarse_to_fine_map
     pickle.dump(coarse_to_fine_map, open('coarse_to_fine_map.pickle', 'wb+'))
     return coarse_to_fine_map
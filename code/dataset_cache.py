@@ -0,0 +1,205 @@
+# dataset_cache.py
+#
+#===============================================================================
+# DESCRIPTION:
+# On-disk cache for preprocessed (normalized, split) datasets.
+# Each cache entry is a directory of .npy files (one per array) plus a
+# manifest.json. Entries are keyed by dataset name, normalize flag and the
+# checksum of coarse_to_fine_map.pickle, and are invalidated when the sha1 of
+# a raw source file changes. Arrays are returned memory-mapped, so loading a
+# cached dataset only touches the pages that are actually read.
+#
+# The manifest records the sha1 of every array file. They are verified the
+# first time an entry is loaded and again whenever the manifest's or an array
+# file's mtime changes (the mtimes of the last successful verification are
+# kept in verified.json), so an edited or corrupted entry is rebuilt.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from dataset_cache import load_or_build_cached_arrays
+#
+# arrays, metadata = load_or_build_cached_arrays('cifar100', normalize, ['X_train', 'y_train'],
+#                                                build_fn, source_files=[...])
+#===============================================================================
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from utils import *
+
+
+DATASET_CACHE_DIR = '../data/cache'
+COARSE_TO_FINE_MAP_FILE = 'coarse_to_fine_map.pickle'
+
+# Bump whenever the preprocessing producing cached arrays changes, so stale entries are rebuilt.
+CACHE_VERSION = 3
+MANIFEST_NAME = 'manifest.json'
+VERIFIED_NAME = 'verified.json'
+
+
+def file_checksum(filename, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(filename):
+    # Cheap fingerprint for large raw files: (size, mtime). Content checksums are reserved for small inputs.
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def make_cache_key(dataset, normalize, coarse_to_fine_map_file=COARSE_TO_FINE_MAP_FILE):
+    key_dict = {'version': CACHE_VERSION, 'dataset': dataset, 'normalize': bool(normalize),
+                'coarse_to_fine_map': file_checksum(coarse_to_fine_map_file)}
+    key_hash = hashlib.sha1(json.dumps(key_dict, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return "{}_{}_{}".format(dataset, 'normalized' if normalize else 'raw', key_hash), key_dict
+
+
+def get_cache_entry_dir(cache_key, cache_dir=DATASET_CACHE_DIR):
+    return os.path.join(cache_dir, cache_key)
+
+
+def _read_manifest(entry_dir):
+    manifest_file = os.path.join(entry_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+# (abspath, size, mtime) -> sha1, so a process hashes every source file once.
+_source_checksums = {}
+
+
+def source_checksum(filename):
+    stat = os.stat(filename)
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if memo_key not in _source_checksums:
+        _source_checksums[memo_key] = file_checksum(filename)
+    return _source_checksums[memo_key]
+
+
+def _source_checksums_of(source_files):
+    return dict((os.path.abspath(f), source_checksum(f)) for f in source_files)
+
+
+def _verification_stamp(entry_dir, array_name):
+    # mtimes that, when unchanged since the last verification, let load_cached_arrays skip hashing array_name.
+    return [os.path.getmtime(os.path.join(entry_dir, MANIFEST_NAME)),
+            os.path.getmtime(os.path.join(entry_dir, array_name + '.npy'))]
+
+
+def _read_verified(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, VERIFIED_NAME), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_verified(entry_dir, verified):
+    tmp_file = os.path.join(entry_dir, "{}.tmp{}".format(VERIFIED_NAME, os.getpid()))
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(verified, f, sort_keys=True)
+        os.rename(tmp_file, os.path.join(entry_dir, VERIFIED_NAME))
+    except (IOError, OSError):
+        pass  # read-only cache, the arrays are verified again next time
+
+
+def load_cached_arrays(cache_key, array_names, source_files=(), cache_dir=DATASET_CACHE_DIR, mmap_mode='r',
+                       verify_checksums=None):
+    """
+    Returns (arrays, metadata) for a valid cache entry, or (None, None) if the entry is missing or stale.
+    arrays is a dict array_name -> np.ndarray (memory-mapped if mmap_mode is not None).
+    verify_checksums: True to always check the sha1 of the arrays, False never, None (default) only when the
+        manifest or array file changed since the last successful check.
+    """
+    entry_dir = get_cache_entry_dir(cache_key, cache_dir)
+    manifest = _read_manifest(entry_dir)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return None, None
+    if manifest.get('sources') != _source_checksums_of(source_files):
+        print ("Dataset cache entry {} is stale, rebuilding.".format(cache_key))
+        return None, None
+
+    verified, newly_verified = _read_verified(entry_dir), False
+    arrays = {}
+    for name in array_names:
+        array_info = manifest['arrays'].get(name)
+        array_file = os.path.join(entry_dir, name + '.npy')
+        if array_info is None or not os.path.isfile(array_file) or os.path.getsize(array_file) != array_info['nbytes']:
+            return None, None
+        stamp = _verification_stamp(entry_dir, name)
+        if verify_checksums or (verify_checksums is None and verified.get(name) != stamp):
+            if file_checksum(array_file) != array_info['sha1']:
+                print ("Checksum mismatch for {} in dataset cache entry {}.".format(name, cache_key))
+                return None, None
+            newly_verified = newly_verified or verified.get(name) != stamp
+            verified[name] = stamp
+        arrays[name] = np.load(array_file, mmap_mode=mmap_mode)
+    if newly_verified:
+        _write_verified(entry_dir, verified)
+    return arrays, manifest.get('metadata', {})
+
+
+def save_cached_arrays(cache_key, arrays, source_files=(), metadata=None, key_dict=None, cache_dir=DATASET_CACHE_DIR):
+    """
+    arrays: dict array_name -> np.ndarray (or dataset_view.DatasetView, gathered once here)
+    Writes to a temporary directory first and renames it into place, so readers never see a partial entry.
+    """
+    entry_dir = get_cache_entry_dir(cache_key, cache_dir)
+    tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+    check_if_path_exists_or_create(tmp_dir + '/')
+
+    manifest = {'version': CACHE_VERSION, 'key': key_dict or {}, 'sources': _source_checksums_of(source_files),
+                'metadata': metadata or {}, 'arrays': {}}
+    for name, array in arrays.items():
+        array_file = os.path.join(tmp_dir, name + '.npy')
+        array = np.asarray(array)
+        np.save(array_file, array)
+        manifest['arrays'][name] = {'shape': list(array.shape), 'dtype': str(array.dtype),
+                                    'nbytes': os.path.getsize(array_file), 'sha1': file_checksum(array_file)}
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+
+
+def load_or_build_cached_arrays(dataset, normalize, array_names, build_fn, source_files=(), use_cache=True,
+                                cache_dir=DATASET_CACHE_DIR):
+    """
+    build_fn: function returning (arrays, metadata), where arrays is a dict containing every name in array_names
+    Returns (arrays, metadata); arrays are memory-mapped read-only when served from the cache.
+    """
+    if not use_cache:
+        return build_fn()
+
+    cache_key, key_dict = make_cache_key(dataset, normalize)
+    arrays, metadata = load_cached_arrays(cache_key, array_names, source_files, cache_dir=cache_dir)
+    if arrays is not None:
+        print ("Loaded {} from dataset cache {}".format(dataset, get_cache_entry_dir(cache_key, cache_dir)))
+        return arrays, metadata
+
+    arrays, metadata = build_fn()
+    save_cached_arrays(cache_key, arrays, source_files, metadata=metadata, key_dict=key_dict, cache_dir=cache_dir)
+    print ("Saved {} to dataset cache {}".format(dataset, get_cache_entry_dir(cache_key, cache_dir)))
+    return load_cached_arrays(cache_key, array_names, source_files, cache_dir=cache_dir)
+
+
+def clear_dataset_cache(cache_dir=DATASET_CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
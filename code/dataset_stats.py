@@ -0,0 +1,112 @@
+# dataset_stats.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Dataset statistics in one streaming pass over the images, chunk by chunk,
+# without a full float copy of the dataset.
+# Per-pixel means and sums of squared deviations are accumulated with
+# Welford's update, merged per chunk (Chan et al.), which unlike sum / sum of
+# squares doesn't lose precision to cancellation. From them:
+#   mean, std:        what load_cifar normalizes with (global mean, and the
+#                     mean over pixels of the per-pixel std across images)
+#   global_std:       std over all values (tflearn's featurewise std)
+#   channel_mean/std: per-channel mean and std (tflearn's per_channel option)
+#
+# The statistics are computed when a dataset cache entry is built and stored
+# in its manifest (see dataset_cache.py), so they are computed once per
+# dataset. get_featurewise_stats serves them to the models with featurewise
+# preprocessing, in the space of the normalized data the models are fed, so
+# tflearn doesn't recompute them from X in fit (or per data parallel replica).
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from dataset_stats import compute_dataset_stats, get_featurewise_stats
+#
+# stats = compute_dataset_stats(X_train_uint8)
+# featurewise_stats = get_featurewise_stats('cifar100_fine')  # {'mean': ..., 'std': ...}
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+STATS_CHUNK_SIZE = 1000
+# load_cifar divides by (std + EPSILON), see data_utils.EPSILON.
+NORMALIZATION_EPSILON = 1e-8
+
+
+def accumulate_pixel_moments(images, chunk_size=STATS_CHUNK_SIZE):
+    """
+    One pass over images (n, ...) in float64 chunks of chunk_size rows.
+    Returns n and the per-pixel mean and sum of squared deviations from the mean (M2), both of shape images.shape[1:].
+    """
+    n = 0
+    pixel_mean = np.zeros(images.shape[1:], dtype=np.float64)
+    pixel_m2 = np.zeros(images.shape[1:], dtype=np.float64)
+    for start in range(0, images.shape[0], chunk_size):
+        chunk = np.array(images[start:start + chunk_size], dtype=np.float64)  # a copy, it is centered in place
+        n_chunk = chunk.shape[0]
+        chunk_mean = chunk.mean(axis=0)
+        chunk -= chunk_mean
+        chunk_m2 = np.einsum('i...,i...->...', chunk, chunk)
+
+        delta = chunk_mean - pixel_mean
+        n_total = n + n_chunk
+        pixel_mean += delta * (n_chunk / n_total)
+        pixel_m2 += chunk_m2 + np.square(delta) * (n * n_chunk / n_total)
+        n = n_total
+    return n, pixel_mean, pixel_m2
+
+
+def compute_dataset_stats(images, chunk_size=STATS_CHUNK_SIZE):
+    """
+    images: (n, H, W, C) array (uint8 or float, possibly memory-mapped).
+    Returns a dict of plain floats / lists: n_images, mean, std, global_std, channel_mean, channel_std (see above).
+    """
+    n, pixel_mean, pixel_m2 = accumulate_pixel_moments(images, chunk_size)
+    assert n > 0, "Can't compute statistics of an empty dataset"
+    pixel_var = pixel_m2 / n
+
+    mean = pixel_mean.mean()
+    # The variance over all values is the mean per-pixel variance plus the variance of the per-pixel means.
+    global_var = np.mean(pixel_var + np.square(pixel_mean - mean))
+    pixel_axes = tuple(range(pixel_mean.ndim - 1))
+    channel_mean = pixel_mean.mean(axis=pixel_axes)
+    channel_var = np.mean(pixel_var + np.square(pixel_mean - channel_mean), axis=pixel_axes)
+    return {'n_images': int(n), 'mean': float(mean), 'std': float(np.mean(np.sqrt(pixel_var))),
+            'global_std': float(np.sqrt(global_var)), 'channel_mean': channel_mean.tolist(),
+            'channel_std': np.sqrt(channel_var).tolist()}
+
+
+def normalized_stats(stats):
+    # Statistics of the data after load_cifar's normalization, (x - mean) / (std + EPSILON).
+    scale = stats['std'] + NORMALIZATION_EPSILON
+    return dict(stats, mean=0., std=stats['std'] / scale, global_std=stats['global_std'] / scale,
+                channel_mean=((np.asarray(stats['channel_mean']) - stats['mean']) / scale).tolist(),
+                channel_std=(np.asarray(stats['channel_std']) / scale).tolist())
+
+
+def get_stats_source(dataset):
+    # Image dataset whose training set dataset is drawn from (all cifar100 variants share cifar100's statistics).
+    if dataset == 'cifar10':
+        return 'cifar10'
+    if dataset.startswith('cifar100') and dataset != 'cifar100_joint_prefeaturized':
+        return 'cifar100'
+    raise Exception("No image statistics for dataset {}".format(dataset))
+
+
+def get_featurewise_stats(dataset, per_channel=False, normalize=True):
+    """
+    Mean and std for tflearn's add_featurewise_zero_center / add_featurewise_stdnorm, for models fed dataset (as
+    loaded by load_data / load_data_pyramid with the given normalize flag). Scalars, or per-channel lists.
+    """
+    from data_utils import load_cifar_stats
+
+    stats = load_cifar_stats(get_stats_source(dataset))
+    if normalize:
+        stats = normalized_stats(stats)
+    if per_channel:
+        return {'mean': stats['channel_mean'], 'std': stats['channel_std']}
+    return {'mean': stats['mean'], 'std': stats['global_std']}
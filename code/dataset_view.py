@@ -0,0 +1,139 @@
+# dataset_view.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Index views over a shared backing array (an in-memory or memory-mapped
+# dataset array). Shuffles, train / validation / test splits and pyramid
+# subsets are represented as integer index arrays into the one backing array
+# instead of copies of it; rows are only gathered when a batch is fed.
+#
+# Indexing semantics (same as image_store.NormalizedImages, which is a
+# DatasetView that also normalizes the rows it gathers):
+#   view[i]             -> one row
+#   view[[i, j, ...]]   -> gathered batch (this is how tflearn's data flow and
+#                          the BatchPrefetcher gather batches)
+#   view[start:stop]    -> lazy view, no data is read
+#   view.subset(idx)    -> lazy view over the given rows
+#   np.asarray(view)    -> materializes everything (avoid for large sets)
+#
+# Permutations are drawn from np.random.RandomState(seed), so a given seed
+# always gives the same shuffle (seed=None draws a fresh one).
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from dataset_view import DatasetView, view_rows, shuffle_views, split_views
+#
+# X, Y = shuffle_views([X, Y], seed=0)
+# (X, Y), (X_val, Y_val) = split_views([X, Y], 0.1)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+class DatasetView(object):
+    def __init__(self, data, indices=None):
+        """
+        Args:
+            data: backing array of shape (n_rows, ...), usually memory-mapped
+            indices: optional integer array selecting (and ordering) rows of data
+        """
+        self.data = data
+        self.indices = None if indices is None else np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        if self.indices is None:
+            return self.data.shape[0]
+        return self.indices.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.data.shape[1:])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def _absolute_rows(self, rows):
+        # Maps rows of this view to rows of the backing array.
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.indices is None:
+            return rows
+        return self.indices[rows]
+
+    def _new_view(self, data, indices):
+        # Subclasses keep their own parameters on their views.
+        return DatasetView(data, indices=indices)
+
+    def _transform(self, raw):
+        # Applied to every row or batch read from the backing array.
+        return raw
+
+    def subset(self, rows):
+        # Lazy view over the given rows (relative to this view), nothing is read from the backing array.
+        return self._new_view(self.data, self._absolute_rows(rows))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if self.indices is None and (key.step is None or key.step == 1):
+                return self._new_view(self.data[key], None)
+            return self.subset(key)
+        if isinstance(key, (int, np.integer)):
+            row = key if self.indices is None else self.indices[key]
+            return self._transform(self.data[row])
+
+        rows = self._absolute_rows(key)
+        # Gathering sorted rows is much friendlier to a memory-mapped file, so sort and undo the permutation.
+        order = np.argsort(rows, kind='mergesort')
+        batch = np.empty((len(rows),) + tuple(self.data.shape[1:]), dtype=self.dtype)
+        batch[order] = self._transform(self.data[rows[order]])
+        return batch
+
+    def __array__(self, dtype=None):
+        batch = self[np.arange(len(self))]
+        if dtype is not None:
+            return batch.astype(dtype)
+        return batch
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def seeded_permutation(n, seed=None):
+    # Reproducible for a given seed, a fresh permutation for seed=None.
+    return np.random.RandomState(seed).permutation(n)
+
+
+def view_rows(X, rows):
+    # Like X[rows], but returns an index view (sharing X's backing array) instead of gathering a copy.
+    if isinstance(X, DatasetView):
+        return X.subset(rows)
+    if isinstance(rows, slice):
+        return X[rows]  # basic slicing is already a view
+    return DatasetView(X, indices=rows)
+
+
+def shuffle_views(arrays, seed=None):
+    # Views of all arrays with the same rows, in the same random order.
+    permutation = seeded_permutation(len(arrays[0]), seed)
+    return [view_rows(array, permutation) for array in arrays]
+
+
+def split_views(arrays, fraction):
+    """
+    Holds out the last fraction of the rows of all arrays (like tflearn's validation_set=fraction).
+    Returns (first views, held out views).
+    """
+    assert 0. < fraction < 1., "fraction has to be in (0, 1)"
+    split = int(len(arrays[0]) * (1 - fraction))
+    return ([view_rows(array, slice(0, split)) for array in arrays],
+            [view_rows(array, slice(split, None)) for array in arrays])
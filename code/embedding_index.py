@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+
+# embedding_index.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Approximate nearest neighbour search over the 512-d hidden representations
+# (get_hidden_reps=True) of our CNNs, in numpy only.
+#
+# IVFPQIndex is an inverted file with product quantized residuals:
+#   - a k-means coarse quantizer splits the embeddings into n_lists lists
+#   - the residual of every embedding to its list centroid is split into
+#     n_subquantizers sub-vectors, each encoded as the uint8 id of its nearest
+#     codeword (k-means with 256 codewords per sub-vector), so a 512-d float32
+#     embedding (2048 bytes) is stored in n_subquantizers bytes
+#   - a query scans the n_probe lists closest to it and ranks their entries by
+#     the distance to the decoded residuals, read off per-query lookup tables
+#     (asymmetric distance computation)
+# Queries are answered in batches: the (query, list) pairs of a batch are
+# grouped by list, so each list's codes are scanned once per batch.
+#
+# The index is saved as a directory of .npy files and loaded memory-mapped.
+# brute_force_search is the exact reference, recall_at_k compares the two.
+# class_centroids / nearest_centroids answer "nearest (coarse) class centroid"
+# queries exactly (there are only 20 or 100 centroids).
+# Passing the original embeddings (e.g. the memory-mapped hidden rep cache
+# entry) to search re-ranks a refine_factor * k shortlist by exact distance.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# Build an index over the cifar100 training embeddings of a model and report
+# recall and query time against exact search on the test embeddings:
+# python embedding_index.py -m <model_id> [-l <n_lists>] [-s <n_subquantizers>] [-p <n_probe,n_probe,...>] [-k <k>]
+#
+# from embedding_index import IVFPQIndex
+# index = IVFPQIndex.build(hidden_reps_train)
+# distances, ids = index.search(hidden_reps_test[:100], k=10, n_probe=8)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+
+import numpy as np
+
+from constants import *
+from utils import *
+
+
+EMBEDDING_INDEX_DIR = '../embedding_indexes/'
+EMBEDDING_INDEX_VERSION = 1
+DEFAULT_N_LISTS = 256
+DEFAULT_N_SUBQUANTIZERS = 16
+DEFAULT_N_PROBE = 8
+N_CODEWORDS = 256
+KMEANS_ITERATIONS = 20
+KMEANS_TRAIN_SIZE = 65536
+CHUNK_ROWS = 4096
+DEFAULT_REFINE_FACTOR = 10
+RERANK_CHUNK_ROWS = 256
+INDEX_ARRAY_NAMES = ['coarse_centroids', 'codebooks', 'codes', 'ids', 'list_offsets']
+
+
+def squared_distances(X, C, C_sqnorms=None):
+    # (len(X), len(C)) squared euclidean distances, as ||x||^2 - 2 x.c + ||c||^2.
+    if C_sqnorms is None:
+        C_sqnorms = np.einsum('ij,ij->i', C, C)
+    distances = np.dot(X, C.T)
+    distances *= -2
+    distances += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+    distances += C_sqnorms
+    return np.maximum(distances, 0, out=distances)
+
+
+def assign_to_nearest(X, C, chunk_rows=CHUNK_ROWS):
+    # Index of the nearest row of C for every row of X.
+    C_sqnorms = np.einsum('ij,ij->i', C, C)
+    return np.concatenate([np.argmin(squared_distances(np.asarray(X[start:start + chunk_rows], dtype=np.float32), C,
+                                                       C_sqnorms), axis=1)
+                           for start in xrange(0, len(X), chunk_rows)] or [np.zeros((0,), dtype=np.int64)])
+
+
+def kmeans(X, n_clusters, n_iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Lloyd's k-means on the rows of X (float32), initialized with random rows. Empty clusters are re-seeded with
+    random rows. Returns the (n_clusters, d) centroids.
+    """
+    rng = np.random.RandomState(seed)
+    assert len(X) >= n_clusters, "Need at least {} rows for {} clusters, got {}".format(n_clusters, n_clusters, len(X))
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in xrange(n_iterations):
+        assignments = assign_to_nearest(X, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        order = np.argsort(assignments, kind='mergesort')
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        centroids[non_empty] = np.add.reduceat(X[order], starts, axis=0) / counts[non_empty, np.newaxis]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = X[rng.choice(len(X), len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQIndex(object):
+    def __init__(self, coarse_centroids, codebooks, codes, ids, list_offsets):
+        """
+        coarse_centroids: (n_lists, d) float32
+        codebooks: (n_subquantizers, N_CODEWORDS, d // n_subquantizers) float32
+        codes: (n, n_subquantizers) uint8, grouped by list
+        ids: (n,) int64, row of every code in the embeddings the index was built from
+        list_offsets: (n_lists + 1,) int64, the codes of list l are codes[list_offsets[l]:list_offsets[l + 1]]
+        """
+        self.coarse_centroids = coarse_centroids
+        self.codebooks = codebooks
+        self.codes = codes
+        self.ids = ids
+        self.list_offsets = list_offsets
+        self.coarse_sqnorms = np.einsum('ij,ij->i', coarse_centroids, coarse_centroids)
+        self.codebook_sqnorms = np.einsum('mcd,mcd->mc', codebooks, codebooks)
+
+    @property
+    def n_lists(self):
+        return len(self.coarse_centroids)
+
+    @property
+    def n_subquantizers(self):
+        return len(self.codebooks)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in INDEX_ARRAY_NAMES)
+
+    @classmethod
+    def build(cls, X, n_lists=DEFAULT_N_LISTS, n_subquantizers=DEFAULT_N_SUBQUANTIZERS, train_size=KMEANS_TRAIN_SIZE,
+              seed=0):
+        """
+        X: (n, d) embeddings. The quantizers are trained on (at most) train_size random rows, then all rows are
+        encoded.
+        """
+        n, d = np.shape(X)
+        assert d % n_subquantizers == 0, "Embedding size {} is not divisible by {} subquantizers".format(
+            d, n_subquantizers)
+        rng = np.random.RandomState(seed)
+        train_rows = np.sort(rng.choice(n, min(n, train_size), replace=False))
+        X_train = np.asarray(X[train_rows], dtype=np.float32)
+
+        coarse_centroids = kmeans(X_train, n_lists, seed=seed)
+        train_residuals = X_train - coarse_centroids[assign_to_nearest(X_train, coarse_centroids)]
+        d_sub = d // n_subquantizers
+        codebooks = np.stack([kmeans(np.ascontiguousarray(train_residuals[:, j * d_sub:(j + 1) * d_sub]), N_CODEWORDS,
+                                     seed=seed + j)
+                              for j in xrange(n_subquantizers)])
+
+        index = cls(coarse_centroids, codebooks, np.zeros((0, n_subquantizers), dtype=np.uint8),
+                    np.zeros((0,), dtype=np.int64), np.zeros(n_lists + 1, dtype=np.int64))
+        list_assignments, codes = [], []
+        for start in xrange(0, n, CHUNK_ROWS):
+            X_chunk = np.asarray(X[start:start + CHUNK_ROWS], dtype=np.float32)
+            chunk_lists = assign_to_nearest(X_chunk, coarse_centroids)
+            list_assignments.append(chunk_lists)
+            codes.append(index.encode(X_chunk - coarse_centroids[chunk_lists]))
+        list_assignments = np.concatenate(list_assignments)
+
+        order = np.argsort(list_assignments, kind='mergesort')
+        index.codes = np.concatenate(codes)[order]
+        index.ids = order.astype(np.int64)
+        index.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(list_assignments, minlength=n_lists))))
+        return index
+
+    def encode(self, residuals):
+        # (n, n_subquantizers) uint8 codeword ids of the residuals.
+        d_sub = self.codebooks.shape[2]
+        return np.stack([assign_to_nearest(residuals[:, j * d_sub:(j + 1) * d_sub], self.codebooks[j])
+                         for j in xrange(self.n_subquantizers)], axis=1).astype(np.uint8)
+
+    def _distance_tables(self, residuals):
+        # (n, n_subquantizers, N_CODEWORDS) squared distances of each residual sub-vector to each codeword.
+        n_subquantizers, _, d_sub = self.codebooks.shape
+        sub_vectors = residuals.reshape(len(residuals), n_subquantizers, d_sub).transpose(1, 0, 2)
+        tables = np.matmul(sub_vectors, self.codebooks.transpose(0, 2, 1)).transpose(1, 0, 2)
+        tables *= -2
+        tables += np.einsum('mnd,mnd->nm', sub_vectors, sub_vectors)[:, :, np.newaxis]
+        tables += self.codebook_sqnorms
+        return tables
+
+    def search(self, Q, k=10, n_probe=DEFAULT_N_PROBE, embeddings=None, refine_factor=DEFAULT_REFINE_FACTOR):
+        """
+        Q: (n_queries, d) queries.
+        embeddings: optional, the (memory-mapped) embeddings the index was built from. If given, the refine_factor * k
+        nearest neighbours by quantized distance are re-ranked by their exact distance.
+        Returns the squared distances (approximate, or exact if re-ranked) and the ids of the k nearest neighbours of
+        every query, both of shape (n_queries, k), nearest first. Missing neighbours (fewer than k entries in the
+        probed lists) have id -1.
+        """
+        Q = np.asarray(Q, dtype=np.float32)
+        if embeddings is not None:
+            _, candidate_ids = self.search(Q, k=k * refine_factor, n_probe=n_probe)
+            return rerank(embeddings, Q, candidate_ids, k)
+        n_queries, n_probe = len(Q), min(n_probe, self.n_lists)
+        coarse_distances = squared_distances(Q, self.coarse_centroids, self.coarse_sqnorms)
+        if n_probe < self.n_lists:
+            probes = np.argpartition(coarse_distances, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.tile(np.arange(self.n_lists), (n_queries, 1))
+
+        candidate_distances = np.full((n_queries, n_probe, k), np.inf, dtype=np.float32)
+        candidate_ids = np.full((n_queries, n_probe, k), -1, dtype=np.int64)
+        # Group the (query, probe) pairs by list, so every probed list is scanned once for all its queries.
+        pairs = np.argsort(probes.ravel(), kind='mergesort')
+        probed_lists = probes.ravel()[pairs]
+        group_starts = np.concatenate(([0], np.flatnonzero(np.diff(probed_lists)) + 1, [len(pairs)]))
+        subquantizer_range = np.arange(self.n_subquantizers)
+        for group_start, group_end in zip(group_starts[:-1], group_starts[1:]):
+            list_id = probed_lists[group_start]
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == end:
+                continue
+            group_pairs = pairs[group_start:group_end]
+            queries, slots = group_pairs // n_probe, group_pairs % n_probe  # no np.divmod before numpy 1.13
+            tables = self._distance_tables(Q[queries] - self.coarse_centroids[list_id])
+            distances = tables[:, subquantizer_range, np.asarray(self.codes[start:end], dtype=np.intp)].sum(axis=2)
+            n_nearest = min(k, end - start)
+            nearest = np.argpartition(distances, n_nearest - 1, axis=1)[:, :n_nearest] if n_nearest < end - start \
+                else np.tile(np.arange(end - start), (len(queries), 1))
+            candidate_distances[queries, slots, :n_nearest] = distances[np.arange(len(queries))[:, np.newaxis], nearest]
+            candidate_ids[queries, slots, :n_nearest] = self.ids[start + nearest]
+
+        candidate_distances = candidate_distances.reshape(n_queries, -1)
+        candidate_ids = candidate_ids.reshape(n_queries, -1)
+        order = np.argsort(candidate_distances, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(n_queries)[:, np.newaxis]
+        return candidate_distances[rows, order], candidate_ids[rows, order]
+
+    def save(self, index_dir):
+        check_if_path_exists_or_create(os.path.join(index_dir, ''))
+        for name in INDEX_ARRAY_NAMES:
+            np.save(os.path.join(index_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+            json.dump({'version': EMBEDDING_INDEX_VERSION, 'n': len(self), 'n_lists': self.n_lists,
+                       'n_subquantizers': self.n_subquantizers, 'dim': self.coarse_centroids.shape[1]}, f, indent=2)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        with open(os.path.join(index_dir, 'index.json'), 'r') as f:
+            metadata = json.load(f)
+        if metadata.get('version') != EMBEDDING_INDEX_VERSION:
+            raise Exception("Embedding index {} has version {}, expected {}".format(index_dir, metadata.get('version'),
+                                                                                    EMBEDDING_INDEX_VERSION))
+        # The small quantizer arrays are read into memory, the codes and ids stay memory-mapped.
+        arrays = dict((name, np.load(os.path.join(index_dir, name + '.npy'),
+                                     mmap_mode=mmap_mode if name in ('codes', 'ids') else None))
+                      for name in INDEX_ARRAY_NAMES)
+        return cls(**arrays)
+
+
+def rerank(X, Q, candidate_ids, k, chunk_rows=RERANK_CHUNK_ROWS):
+    """
+    Exact re-ranking of candidate_ids (n_queries, n_candidates), rows of X (-1 for missing candidates).
+    Returns the exact squared distances and ids of the k nearest candidates, nearest first.
+    """
+    distances = np.full(candidate_ids.shape, np.inf, dtype=np.float32)
+    for start in xrange(0, len(Q), chunk_rows):
+        ids = candidate_ids[start:start + chunk_rows]
+        valid = ids >= 0
+        # Reading the candidate rows in sorted order keeps the reads of a memory-mapped X sequential.
+        unique_ids, inverse = np.unique(ids[valid], return_inverse=True)
+        rows = np.asarray(X[unique_ids], dtype=np.float32)[inverse]
+        differences = rows - np.repeat(Q[start:start + chunk_rows], valid.sum(axis=1), axis=0)
+        distances[start:start + chunk_rows][valid] = np.einsum('ij,ij->i', differences, differences)
+    order = np.argsort(distances, axis=1, kind='mergesort')[:, :k]
+    rows = np.arange(len(Q))[:, np.newaxis]
+    return distances[rows, order], np.where(np.isinf(distances[rows, order]), -1, candidate_ids[rows, order])
+
+
+def brute_force_search(X, Q, k=10, chunk_rows=CHUNK_ROWS):
+    """
+    Exact k nearest rows of X for every query, by scanning X in chunks.
+    Returns the squared distances and ids, both of shape (n_queries, k), nearest first.
+    """
+    Q = np.asarray(Q, dtype=np.float32)
+    best_distances = np.full((len(Q), 0), np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(Q), 0), dtype=np.int64)
+    rows = np.arange(len(Q))[:, np.newaxis]
+    for start in xrange(0, len(X), chunk_rows):
+        chunk_distances = squared_distances(Q, np.asarray(X[start:start + chunk_rows], dtype=np.float32))
+        chunk_ids = np.tile(np.arange(start, start + chunk_distances.shape[1]), (len(Q), 1))
+        distances = np.concatenate((best_distances, chunk_distances), axis=1)
+        ids = np.concatenate((best_ids, chunk_ids), axis=1)
+        n_nearest = min(k, distances.shape[1])
+        nearest = np.argpartition(distances, n_nearest - 1, axis=1)[:, :n_nearest] \
+            if n_nearest < distances.shape[1] else np.tile(np.arange(distances.shape[1]), (len(Q), 1))
+        best_distances, best_ids = distances[rows, nearest], ids[rows, nearest]
+    order = np.argsort(best_distances, axis=1, kind='mergesort')
+    return best_distances[rows, order], best_ids[rows, order]
+
+
+def recall_at_k(approximate_ids, exact_ids):
+    # Average fraction of the exact k nearest neighbours found by the approximate search.
+    k = exact_ids.shape[1]
+    hits = (approximate_ids[:, :, np.newaxis] == exact_ids[:, np.newaxis, :]).any(axis=1).sum(axis=1)
+    return float(np.mean(hits / k)) if len(hits) else 0.0
+
+
+def class_centroids(X, labels, n_classes):
+    # (n_classes, d) mean embedding of every class, labels dense.
+    from data_utils import to_categorical
+
+    labels = np.asarray(labels)
+    sums = np.zeros((n_classes, np.shape(X)[1]), dtype=np.float64)
+    for start in xrange(0, len(X), CHUNK_ROWS):
+        sums += np.dot(to_categorical(labels[start:start + CHUNK_ROWS], n_classes).T,
+                       np.asarray(X[start:start + CHUNK_ROWS], dtype=np.float64))
+    counts = np.bincount(labels, minlength=n_classes)
+    return (sums / np.maximum(counts, 1)[:, np.newaxis]).astype(np.float32)
+
+
+def nearest_centroids(Q, centroids, k=1):
+    # Exact: ids (n_queries, k) of the k nearest centroids, nearest first.
+    distances = squared_distances(np.asarray(Q, dtype=np.float32), centroids)
+    return np.argsort(distances, axis=1, kind='mergesort')[:, :k]
+
+
+def get_embedding_index_dir(model_id):
+    return os.path.join(EMBEDDING_INDEX_DIR, model_id)
+
+
+def run_recall_report(model_id, n_lists=DEFAULT_N_LISTS, n_subquantizers=DEFAULT_N_SUBQUANTIZERS,
+                      n_probes=(1, 4, DEFAULT_N_PROBE, 32), k=10):
+    """
+    Indexes the hidden reps of the cifar100 training set under model_id's checkpoint, and reports recall@k and query
+    time against brute force search for the test set, plus the accuracy of nearest coarse centroid classification.
+    """
+    from data_utils import load_cifar
+    from model_utils import get_model_output_kwargs, TRAINING_STORAGE
+    from hidden_rep_cache import get_hidden_reps
+
+    assert ALL_MODEL_DICTS[model_id]['network_type'] != 'pyramid', "The pyramid has two hidden reps, use a single head model"
+    X_train, y_train, _, _, X_test, y_test = load_cifar(dataset='cifar100', storage=TRAINING_STORAGE)
+    embeddings = get_hidden_reps(model_id, X_train, **get_model_output_kwargs(model_id))
+    queries = np.asarray(get_hidden_reps(model_id, X_test, **get_model_output_kwargs(model_id)), dtype=np.float32)
+
+    start = time.time()
+    IVFPQIndex.build(embeddings, n_lists=n_lists, n_subquantizers=n_subquantizers).save(get_embedding_index_dir(model_id))
+    print("Index over {} embeddings built in {:.1f}s".format(len(embeddings), time.time() - start))
+    index = IVFPQIndex.load(get_embedding_index_dir(model_id))
+    print("Index size {:.1f} MB, embeddings {:.1f} MB".format(index.nbytes / 2**20, embeddings.nbytes / 2**20))
+
+    start = time.time()
+    _, exact_ids = brute_force_search(embeddings, queries, k=k)
+    exact_time = time.time() - start
+
+    print("{:>8} {:>8} {:>10} {:>12}".format('n_probe', 'rerank', 'recall@{}'.format(k), 'ms / query'))
+    print("{:>8} {:>8} {:>10.4f} {:>12.4f}".format('exact', '-', 1.0, 1000. * exact_time / len(queries)))
+    report = {'model_id': model_id, 'n': len(index), 'n_lists': n_lists, 'n_subquantizers': n_subquantizers, 'k': k,
+              'index_bytes': index.nbytes, 'exact_ms_per_query': 1000. * exact_time / len(queries), 'n_probes': []}
+    for n_probe in n_probes:
+        for reranked in (False, True):
+            start = time.time()
+            _, ids = index.search(queries, k=k, n_probe=n_probe, embeddings=embeddings if reranked else None)
+            ms_per_query = 1000. * (time.time() - start) / len(queries)
+            recall = recall_at_k(ids, exact_ids)
+            print("{:>8} {:>8} {:>10.4f} {:>12.4f}".format(n_probe, 'yes' if reranked else 'no', recall, ms_per_query))
+            report['n_probes'].append({'n_probe': n_probe, 'reranked': reranked, 'recall': recall,
+                                       'ms_per_query': ms_per_query})
+
+    y_coarse_train, y_coarse_test = np.asarray(y_train)[:, 1], np.asarray(y_test)[:, 1]
+    centroids = class_centroids(embeddings, y_coarse_train, N_COARSE_CIFAR)
+    start = time.time()
+    nearest_coarse = nearest_centroids(queries, centroids)[:, 0]
+    report['centroid_ms_per_query'] = 1000. * (time.time() - start) / len(queries)
+    report['centroid_accuracy'] = float(np.mean(nearest_coarse == y_coarse_test))
+    print("nearest coarse centroid: accuracy {:.4f}, {:.4f} ms / query".format(report['centroid_accuracy'],
+                                                                            report['centroid_ms_per_query']))
+    with open(os.path.join(get_embedding_index_dir(model_id), 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python embedding_index.py -m <model_id> [-l <n_lists>] [-s <n_subquantizers>] "
+              "[-p <n_probe,n_probe,...>] [-k <k>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:l:s:p:k:", ["help", "model_id", "n_lists", "n_subquantizers",
+                                                                "n_probes", "k"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    config = {'model_id': None, 'n_lists': DEFAULT_N_LISTS, 'n_subquantizers': DEFAULT_N_SUBQUANTIZERS,
+              'n_probes': (1, 4, DEFAULT_N_PROBE, 32), 'k': 10}
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-m", "--model_id"):
+            config['model_id'] = a
+        elif o in ("-l", "--n_lists"):
+            config['n_lists'] = int(a)
+        elif o in ("-s", "--n_subquantizers"):
+            config['n_subquantizers'] = int(a)
+        elif o in ("-p", "--n_probes"):
+            config['n_probes'] = [int(n_probe) for n_probe in a.split(',')]
+        elif o in ("-k", "--k"):
+            config['k'] = int(a)
+        else:
+            assert False, "unhandled option"
+
+    assert config['model_id'] is not None, "Please specify the model_id with -m"
+    return config
+
+
+def main():
+    config = read_commandline_args()
+    run_recall_report(config['model_id'], n_lists=config['n_lists'], n_subquantizers=config['n_subquantizers'],
+                      n_probes=config['n_probes'], k=config['k'])
+
+
+if __name__ == '__main__':
+    main()
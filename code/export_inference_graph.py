@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# export_inference_graph.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Exports an inference-only frozen graph for a model_id and checkpoint:
+#   - variables are folded into constants (the tflearn is_training flag included,
+#     frozen to False, so dropout is a no-op)
+#   - the graph is pruned to the ops the outputs depend on, which drops the
+#     regression / optimizer nodes, the custom loss and accuracy closures and
+#     the target placeholders
+#   - outputs are only the softmax heads (stacked coarse + fine for the pyramid),
+#     or the hidden reps with -r
+# Data augmentation is applied in python by tflearn during training and is not
+# part of any exported graph. Featurewise preprocessing (lenet / vggnet) is also
+# applied in python by tflearn, so its restored mean / std are written to the
+# .json sidecar and FrozenModel applies them before feeding the graph.
+#
+# FrozenModel loads an exported graph with tensorflow only (no tflearn, no
+# network builder) and runs it in batches.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# python export_inference_graph.py -m <model_id> [-c <ckpt_model_id>] [-r] [-t]
+#   -r exports the hidden reps instead of the softmax outputs
+#   -t compares load time, predict time and outputs against tflearn.DNN on random inputs
+#
+# from export_inference_graph import FrozenModel
+# model = FrozenModel(get_frozen_graph_file('simple_cnn_cifar100_fine'))
+# probs = model.predict(X_test)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+
+import numpy as np
+
+from constants import *
+from utils import *
+from model_utils import load_model, get_model_output_kwargs, predict_in_batches, get_featurewise_preprocessing, \
+    apply_featurewise_preprocessing, PREDICT_BATCH_SIZE
+
+
+FROZEN_MODELS_DIR = '../frozen_models/'
+
+
+def get_frozen_graph_file(model_id, hidden_reps=False):
+    return os.path.join(FROZEN_MODELS_DIR, "{}{}.pb".format(model_id, '_hidden_reps' if hidden_reps else ''))
+
+
+def _as_list(tensors):
+    return list(tensors) if isinstance(tensors, (list, tuple)) else [tensors]
+
+
+def export_inference_graph(model_id, checkpoint_model_id=None, hidden_reps=False, output_file=None):
+    """
+    Builds model_id, restores the latest checkpoint of checkpoint_model_id (default: model_id), and writes the
+    frozen, pruned GraphDef to output_file with a .json sidecar naming the input and output tensors.
+    Returns output_file.
+    """
+    import tensorflow as tf
+    import tflearn
+    from tensorflow.python.framework import graph_util
+
+    checkpoint_model_id = checkpoint_model_id or model_id
+    output_file = output_file or get_frozen_graph_file(model_id, hidden_reps)
+
+    with tf.Graph().as_default() as graph:
+        model = load_model(model_id, checkpoint_model_id=checkpoint_model_id, is_training=False,
+                           get_hidden_reps=hidden_reps, **get_model_output_kwargs(model_id))
+        tflearn.is_training(False, session=model.session)
+        input_tensor = model.inputs[0]
+        output_tensors = _as_list(model.net)
+        output_node_names = [tensor.op.name for tensor in output_tensors]
+        preprocessing = get_featurewise_preprocessing(model)
+
+        # convert_variables_to_constants also prunes everything the outputs don't depend on.
+        graph_def = graph_util.convert_variables_to_constants(model.session, graph.as_graph_def(), output_node_names)
+        if hasattr(graph_util, 'remove_training_nodes'):
+            graph_def = graph_util.remove_training_nodes(graph_def)
+
+    check_if_path_exists_or_create(output_file)
+    with open(output_file, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    signature = {'model_id': model_id, 'checkpoint_model_id': checkpoint_model_id, 'hidden_reps': hidden_reps,
+                 'input': input_tensor.name, 'input_shape': input_tensor.get_shape().as_list(),
+                 'outputs': [tensor.name for tensor in output_tensors],
+                 'output_shapes': [tensor.get_shape().as_list() for tensor in output_tensors],
+                 'preprocessing': preprocessing}
+    with open(os.path.splitext(output_file)[0] + '.json', 'w') as f:
+        json.dump(signature, f, indent=2, sort_keys=True)
+    print("Exported {} ({} nodes) to {}".format(model_id, len(graph_def.node), output_file))
+    return output_file
+
+
+class FrozenModel(object):
+    def __init__(self, frozen_graph_file, batch_size=PREDICT_BATCH_SIZE):
+        import tensorflow as tf
+
+        with open(os.path.splitext(frozen_graph_file)[0] + '.json', 'r') as f:
+            self.signature = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(frozen_graph_file, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph)
+        self.input_tensor = self.graph.get_tensor_by_name(self.signature['input'])
+        self.output_tensors = [self.graph.get_tensor_by_name(name) for name in self.signature['outputs']]
+        self.batch_size = batch_size
+
+    def predict(self, X):
+        """
+        Returns an array of outputs for X (a list of arrays if the graph has several outputs, e.g. the pyramid
+        hidden reps), like tflearn.DNN.predict but in batches of batch_size.
+        """
+        outputs = [[] for _ in self.output_tensors]
+        for start in xrange(0, len(X), self.batch_size):
+            X_batch = np.asarray(X[start:start + self.batch_size])
+            if self.signature['preprocessing'] is not None:
+                X_batch = apply_featurewise_preprocessing(X_batch, self.signature['preprocessing'])
+            for output, batch_output in zip(outputs, self.session.run(self.output_tensors,
+                                                                      feed_dict={self.input_tensor: X_batch})):
+                output.append(batch_output)
+        outputs = [np.concatenate(output) for output in outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def close(self):
+        self.session.close()
+
+
+def compare_with_dnn(model_id, frozen_graph_file, hidden_reps=False, n_samples=1024, seed=0):
+    """
+    Cold load time, predict time and max abs output difference of FrozenModel vs load_model + tflearn.DNN,
+    on random inputs shaped like the model's input.
+    """
+    import tensorflow as tf
+
+    start = time.time()
+    frozen_model = FrozenModel(frozen_graph_file)
+    frozen_load_seconds = time.time() - start
+    X = np.random.RandomState(seed).rand(*([n_samples] + frozen_model.signature['input_shape'][1:]))
+    X = X.astype(np.float32)
+    start = time.time()
+    frozen_outputs = _as_list(frozen_model.predict(X))
+    frozen_predict_seconds = time.time() - start
+
+    start = time.time()
+    with tf.Graph().as_default():
+        model = load_model(model_id, checkpoint_model_id=frozen_model.signature['checkpoint_model_id'],
+                           is_training=False, get_hidden_reps=hidden_reps, **get_model_output_kwargs(model_id))
+        dnn_load_seconds = time.time() - start
+        start = time.time()
+        dnn_outputs = _as_list(predict_in_batches(model, X))
+        dnn_predict_seconds = time.time() - start
+
+    max_abs_diff = max(float(np.max(np.abs(np.asarray(a) - np.asarray(b)))) for a, b in zip(frozen_outputs, dnn_outputs))
+    results = {'frozen_load_seconds': frozen_load_seconds, 'dnn_load_seconds': dnn_load_seconds,
+               'frozen_predict_seconds': frozen_predict_seconds, 'dnn_predict_seconds': dnn_predict_seconds,
+               'max_abs_diff': max_abs_diff, 'n_samples': n_samples}
+    print("load: frozen {:.2f}s vs DNN {:.2f}s | predict {} samples: frozen {:.3f}s vs DNN {:.3f}s | "
+          "max abs diff {:.2e}".format(frozen_load_seconds, dnn_load_seconds, n_samples, frozen_predict_seconds,
+                                       dnn_predict_seconds, max_abs_diff))
+    return results
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python export_inference_graph.py -m <model_id> [-c <ckpt_model_id>] [-r] [-t]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:c:rt", ["help", "model_id", "ckpt_model_id", "hidden_reps",
+                                                            "compare"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    model_id, checkpoint_model_id, hidden_reps, compare = None, None, False, False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-m", "--model_id"):
+            model_id = a
+        elif o in ("-c", "--ckpt_model_id"):
+            checkpoint_model_id = a
+        elif o in ("-r", "--hidden_reps"):
+            hidden_reps = True
+        elif o in ("-t", "--compare"):
+            compare = True
+        else:
+            assert False, "unhandled option"
+
+    assert model_id is not None, "Please specify a model_id with -m"
+    return model_id, checkpoint_model_id, hidden_reps, compare
+
+
+def main():
+    model_id, checkpoint_model_id, hidden_reps, compare = read_commandline_args()
+    frozen_graph_file = export_inference_graph(model_id, checkpoint_model_id, hidden_reps=hidden_reps)
+    if compare:
+        compare_with_dnn(model_id, frozen_graph_file, hidden_reps=hidden_reps)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,11 +16,21 @@
 # Commandline:
 # To get help:python feature_extractor.py -h
 #
+# Hidden reps are served from the hidden rep cache (see hidden_rep_cache.py)
+# when the checkpoint and data are unchanged.
+#
+# Streaming mode (bounded memory, resumable after interruption):
+# python feature_extractor.py -d <dataset> -c <ckpt_model_id> -s <shard_size> [-b <batch_size>]
+#
 #===============================================================================
 
 from __future__ import division, print_function, absolute_import
 
+import shutil
+
 from model_utils import *
+from feature_shards import *
+from hidden_rep_cache import LazyHiddenRepModel, load_or_compute_hidden_reps
 
 sys.path.append("../") # so we can import models.
 
@@ -29,9 +39,10 @@ sys.path.append("../") # so we can import models.
 
 def read_commandline_args():
     def usage():
-        print("Usage: python feature_extractor.py -d <dataset> -c <ckpt_model_id>")
+        print("Usage: python feature_extractor.py -d <dataset> -c <ckpt_model_id> [-s <shard_size>] [-b <batch_size>]")
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"ht:m:d:c:", ["help", "dataset", "ckpt_model_id"])
+        opts, args = getopt.getopt(sys.argv[1:],"ht:m:d:c:s:b:", ["help", "dataset", "ckpt_model_id", "shard_size",
+                                                                  "batch_size"])
     except getopt.GetoptError as err:
         # print help information and exit:
         print (str(err))  # will print something like "option -a not recognized"
@@ -39,6 +50,7 @@ def read_commandline_args():
         sys.exit(2)
 
     dataset, checkpoint_model_id = None, None
+    shard_size, batch_size = None, DEFAULT_BATCH_SIZE
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -47,31 +59,62 @@ def read_commandline_args():
             dataset = a
         elif o in ("-c", "--ckpt_model_id"):
             checkpoint_model_id = a
+        elif o in ("-s", "--shard_size"):
+            shard_size = int(a)
+        elif o in ("-b", "--batch_size"):
+            batch_size = int(a)
         else:
             assert False, "unhandled option"
 
     assert dataset is not None and checkpoint_model_id is not None
 
-    return dataset, checkpoint_model_id
+    return dataset, checkpoint_model_id, shard_size, batch_size
 
 
-def main():
-    dataset, checkpoint_model_id = read_commandline_args()
+def extract_features_streaming(model, dataset, checkpoint_model_id, X_subsets, arrays, batch_size, shard_size):
+    # X_subsets, arrays: lists of (name, array). X_subsets are featurized, arrays (labels) are stored as is.
+    feature_set_dir = get_feature_shards_dir(dataset)
+    manifest = open_feature_manifest(feature_set_dir, checkpoint_model_id, dataset)
+    for name, array in arrays:
+        save_feature_set_array(array, feature_set_dir, name, manifest)
+    for name, X in X_subsets:
+        extract_features_to_shards(model, X, feature_set_dir, name, manifest, batch_size=batch_size,
+                                   shard_size=shard_size)
+    # All shards are done, assemble them into the feature set read by load_data_pyramid.
+    save_feature_set_from_shards(feature_set_dir, get_feature_set_dir(dataset))
+    shutil.rmtree(feature_set_dir)
+    print("Features written to {}".format(get_feature_set_dir(dataset)))
+
 
+def extract_features(dataset, checkpoint_model_id, shard_size=None, batch_size=DEFAULT_BATCH_SIZE):
     print("Using checkpoint_model {} as feature extractor for pyramid image dataset {}".format(checkpoint_model_id, dataset))
 
     # Encodes X, and X_test using specified model
 
     # Define a new DNN that goes until the penultimate point (right before the final classification layer).
     X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, \
-    X_test, y_test, fine_or_coarse_test = load_data_pyramid(dataset=dataset, return_subset='all')
-
-    # Test using classifier
-    model = load_model(checkpoint_model_id, checkpoint_model_id=checkpoint_model_id, is_training=False, get_hidden_reps=True)
-
-    X_train_joint = model.predict(X_train_joint)
-    X_train_gate = model.predict(X_train_gate)
-    X_test = model.predict(X_test)
+    X_test, y_test, fine_or_coarse_test = load_data_pyramid(dataset=dataset, return_subset='all', storage=TRAINING_STORAGE)
+
+    # The model is only built if some hidden reps are not in the hidden rep cache.
+    compute_hidden_reps = LazyHiddenRepModel(checkpoint_model_id, batch_size=batch_size)
+
+    if shard_size:
+        model = compute_hidden_reps.load()
+        with compute_hidden_reps.graph.as_default():
+            extract_features_streaming(model, dataset, checkpoint_model_id,
+                                       X_subsets=[('X_train_joint', X_train_joint), ('X_train_gate', X_train_gate),
+                                                  ('X_test', X_test)],
+                                       arrays=[('y_train_joint', y_train_joint), ('y_train_gate', y_train_gate),
+                                               ('fine_or_coarse_train_gate', fine_or_coarse_train_gate),
+                                               ('y_test', y_test), ('fine_or_coarse_test', fine_or_coarse_test)],
+                                       batch_size=batch_size, shard_size=shard_size)
+        print("DONE.")
+        return
+
+    network_type = ALL_MODEL_DICTS[checkpoint_model_id]['network_type']
+    X_train_joint = load_or_compute_hidden_reps(checkpoint_model_id, network_type, X_train_joint, compute_hidden_reps)
+    X_train_gate = load_or_compute_hidden_reps(checkpoint_model_id, network_type, X_train_gate, compute_hidden_reps)
+    X_test = load_or_compute_hidden_reps(checkpoint_model_id, network_type, X_test, compute_hidden_reps)
 
 
     save_features(X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, \
@@ -80,5 +123,10 @@ def main():
     print("DONE.")
 
 
+def main():
+    dataset, checkpoint_model_id, shard_size, batch_size = read_commandline_args()
+    extract_features(dataset, checkpoint_model_id, shard_size=shard_size, batch_size=batch_size)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+# feature_sets.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Columnar on-disk format for prefeaturized datasets. A feature set is a
+# directory with one .npy file per named array and a metadata.json recording
+# each array's dtype and shape, the dataset and the checkpoint_model_id the
+# features were extracted with:
+#
+#   ../data/feature_sets/cifar100_joint_prefeaturized.features/
+#       metadata.json
+#       X_train_joint.npy, y_train_joint.npy, X_train_gate.npy, ...
+#
+# Arrays are loaded memory-mapped, so consumers only read the arrays (and the
+# rows) they actually use, without unpickling or copying the whole file.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from feature_sets import *
+#
+# save_feature_set(get_feature_set_dir(dataset), [('X_train_joint', X_train_joint), ...], checkpoint_model_id, dataset)
+# arrays = load_feature_set(get_feature_set_dir(dataset), ['X_test', 'y_test'])
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+from utils import *
+from feature_shards import FEATURE_SETS_DIR, read_feature_manifest, write_shards_to_memmap
+
+
+METADATA_NAME = 'metadata.json'
+FEATURE_SET_FORMAT_VERSION = 1
+
+
+def get_feature_set_dir(dataset):
+    return os.path.join(FEATURE_SETS_DIR, "{}_prefeaturized.features".format(dataset))
+
+
+def read_feature_set_metadata(feature_set_dir):
+    metadata_file = os.path.join(feature_set_dir, METADATA_NAME)
+    if not os.path.isfile(metadata_file):
+        return None
+    with open(metadata_file, 'r') as f:
+        return json.load(f)
+
+
+def feature_set_exists(feature_set_dir):
+    return read_feature_set_metadata(feature_set_dir) is not None
+
+
+def _array_metadata(array_file):
+    array = np.load(array_file, mmap_mode='r')
+    return {'file': os.path.basename(array_file), 'dtype': str(array.dtype), 'shape': list(array.shape)}
+
+
+def _finalize_feature_set(tmp_dir, feature_set_dir, array_metadata, checkpoint_model_id, dataset):
+    metadata = {'version': FEATURE_SET_FORMAT_VERSION, 'checkpoint_model_id': checkpoint_model_id,
+                'dataset': dataset, 'arrays': array_metadata}
+    with open(os.path.join(tmp_dir, METADATA_NAME), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+    if os.path.isdir(feature_set_dir):
+        shutil.rmtree(feature_set_dir)
+    os.rename(tmp_dir, feature_set_dir)
+
+
+def save_feature_set(feature_set_dir, arrays, checkpoint_model_id, dataset):
+    """
+    arrays: list of (name, array) pairs
+    The feature set is written to a temporary directory and renamed into place, so readers never see it half written.
+    """
+    tmp_dir = "{}.tmp{}".format(feature_set_dir, os.getpid())
+    check_if_path_exists_or_create(tmp_dir + '/')
+    array_metadata = {}
+    for name, array in arrays:
+        array_file = os.path.join(tmp_dir, name + '.npy')
+        np.save(array_file, np.asarray(array))
+        array_metadata[name] = _array_metadata(array_file)
+    _finalize_feature_set(tmp_dir, feature_set_dir, array_metadata, checkpoint_model_id, dataset)
+
+
+def save_feature_set_from_shards(shards_dir, feature_set_dir):
+    """
+    Converts the output of feature_shards.extract_features_to_shards into a feature set. Sharded features are
+    copied into one memory-mapped .npy per subset, one shard at a time, so memory stays bounded by a shard.
+    """
+    manifest = read_feature_manifest(shards_dir)
+    tmp_dir = "{}.tmp{}".format(feature_set_dir, os.getpid())
+    check_if_path_exists_or_create(tmp_dir + '/')
+    array_metadata = {}
+
+    for name, subset in manifest['subsets'].items():
+        assert subset['complete'], "Feature extraction for {} in {} did not finish.".format(name, shards_dir)
+        array_file = os.path.join(tmp_dir, name + '.npy')
+        write_shards_to_memmap(shards_dir, subset, array_file)
+        array_metadata[name] = _array_metadata(array_file)
+
+    for name, array_file in manifest['arrays'].items():
+        shutil.copyfile(os.path.join(shards_dir, array_file), os.path.join(tmp_dir, name + '.npy'))
+        array_metadata[name] = _array_metadata(os.path.join(tmp_dir, name + '.npy'))
+
+    _finalize_feature_set(tmp_dir, feature_set_dir, array_metadata, manifest['checkpoint_model_id'],
+                          manifest['dataset'])
+
+
+def load_feature_set(feature_set_dir, array_names=None, mmap_mode='r'):
+    """
+    Returns a dict name -> array for the requested arrays (all arrays if array_names is None). Arrays are
+    memory-mapped read-only unless mmap_mode is None.
+    """
+    metadata = read_feature_set_metadata(feature_set_dir)
+    assert metadata is not None, "No feature set found at {}".format(feature_set_dir)
+    if array_names is None:
+        array_names = sorted(metadata['arrays'])
+
+    arrays = {}
+    for name in array_names:
+        array_info = metadata['arrays'][name]
+        array = np.load(os.path.join(feature_set_dir, array_info['file']), mmap_mode=mmap_mode)
+        if str(array.dtype) != array_info['dtype'] or list(array.shape) != array_info['shape']:
+            raise Exception("Array {} in feature set {} does not match its metadata: {} {} != {} {}".format(
+                name, feature_set_dir, array.dtype, list(array.shape), array_info['dtype'], array_info['shape']))
+        arrays[name] = array
+    return arrays
@@ -0,0 +1,189 @@
+# feature_shards.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Streaming, resumable feature extraction. Features are computed batch by batch
+# and written to fixed-size .npy shards, with a manifest.json recording which
+# shards are complete. If extraction is interrupted, rerunning it skips the
+# shards that are already on disk, so memory stays bounded by one shard and
+# work is never restarted from zero. The manifest is keyed by the checkpoint
+# model id and the fingerprint of its latest checkpoint file, so the shards of
+# a retrained checkpoint are not resumed from.
+#
+# Layout of a feature set directory:
+#   manifest.json
+#   <subset>_features_<shard index>.npy   e.g. X_train_joint_features_00003.npy
+#   <name>.npy                            label arrays, e.g. y_train_joint.npy
+#   <subset>_features.npy                 all shards of a subset, assembled by
+#                                         load_sharded_features on first load
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from feature_shards import *
+#
+# manifest = open_feature_manifest(feature_set_dir, checkpoint_model_id, dataset)
+# extract_features_to_shards(model, X_train_joint, feature_set_dir, 'X_train_joint', manifest)
+# X_train_joint = load_sharded_features(feature_set_dir, 'X_train_joint')
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+
+import numpy as np
+
+from utils import *
+
+
+FEATURE_SETS_DIR = '../data/feature_sets'
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_SHARD_SIZE = 4096
+DEFAULT_BATCH_SIZE = 128
+COPY_CHUNK_SIZE = 4096
+
+
+def get_feature_shards_dir(dataset):
+    return os.path.join(FEATURE_SETS_DIR, "{}_prefeaturized_shards".format(dataset))
+
+
+def read_feature_manifest(feature_set_dir):
+    manifest_file = os.path.join(feature_set_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def _write_json_atomic(obj, filename):
+    tmp_file = "{}.tmp{}".format(filename, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, filename)
+
+
+def _save_npy_atomic(array, filename):
+    tmp_file = "{}.tmp{}.npy".format(filename[:-len('.npy')], os.getpid())
+    np.save(tmp_file, array)
+    os.rename(tmp_file, filename)
+
+
+def open_feature_manifest(feature_set_dir, checkpoint_model_id, dataset):
+    """
+    Returns the manifest for feature_set_dir, or a fresh one if none exists or it was written for a different
+    checkpoint model id, checkpoint file (see hidden_rep_cache.checkpoint_fingerprint) or dataset, in which case
+    previously written shards are ignored and overwritten.
+    """
+    from hidden_rep_cache import checkpoint_fingerprint
+
+    check_if_path_exists_or_create(feature_set_dir + '/')
+    manifest = read_feature_manifest(feature_set_dir)
+    checkpoint = checkpoint_fingerprint(checkpoint_model_id)
+    if manifest is None or manifest.get('checkpoint_model_id') != checkpoint_model_id \
+            or manifest.get('checkpoint') != checkpoint or manifest.get('dataset') != dataset:
+        manifest = {'checkpoint_model_id': checkpoint_model_id, 'checkpoint': checkpoint, 'dataset': dataset,
+                    'subsets': {}, 'arrays': {}}
+        _write_json_atomic(manifest, os.path.join(feature_set_dir, MANIFEST_NAME))
+    return manifest
+
+
+def extract_features_to_shards(model, X, feature_set_dir, subset_name, manifest,
+                               batch_size=DEFAULT_BATCH_SIZE, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Runs model.predict over X in batches of batch_size and writes the outputs to shards of shard_size rows.
+    Shards already recorded in the manifest (and present on disk) are skipped.
+
+    Args:
+        model: anything with a predict(X_batch) method, e.g. a tflearn.DNN built with get_hidden_reps=True
+        X: array-like supporting len() and slicing (np.ndarray, memmap or NormalizedImages)
+        manifest: manifest dict from open_feature_manifest, updated and rewritten after every shard
+    """
+    n_samples = len(X)
+    manifest_file = os.path.join(feature_set_dir, MANIFEST_NAME)
+    subset = manifest['subsets'].get(subset_name)
+    if subset is None or subset['n_samples'] != n_samples or subset['shard_size'] != shard_size:
+        subset = {'n_samples': n_samples, 'shard_size': shard_size, 'shards': {}, 'complete': False}
+        manifest['subsets'][subset_name] = subset
+
+    n_shards = int(np.ceil(n_samples / shard_size))
+    for shard_index in xrange(n_shards):
+        shard_key = "{:05d}".format(shard_index)
+        shard_file = os.path.join(feature_set_dir, "{}_features_{}.npy".format(subset_name, shard_key))
+        start, stop = shard_index * shard_size, min((shard_index + 1) * shard_size, n_samples)
+        if shard_key in subset['shards'] and os.path.isfile(shard_file):
+            continue
+
+        features = []
+        for batch_start in xrange(start, stop, batch_size):
+            X_batch = np.asarray(X[batch_start:min(batch_start + batch_size, stop)])
+            features.extend(model.predict(X_batch))
+        features = np.asarray(features, dtype=np.float32)
+        _save_npy_atomic(features, shard_file)
+
+        subset['shards'][shard_key] = {'file': os.path.basename(shard_file), 'start': start, 'stop': stop}
+        subset['feature_shape'] = list(features.shape[1:])
+        _write_json_atomic(manifest, manifest_file)
+        print("{}: wrote shard {} / {} (samples {}-{})".format(subset_name, shard_index + 1, n_shards, start, stop))
+
+    subset['complete'] = True
+    _write_json_atomic(manifest, manifest_file)
+
+
+def save_feature_set_array(array, feature_set_dir, name, manifest):
+    # Small arrays (labels, fine_or_coarse) are stored whole next to the shards.
+    array_file = os.path.join(feature_set_dir, name + '.npy')
+    _save_npy_atomic(np.asarray(array), array_file)
+    manifest['arrays'][name] = os.path.basename(array_file)
+    _write_json_atomic(manifest, os.path.join(feature_set_dir, MANIFEST_NAME))
+
+
+def is_feature_set_complete(feature_set_dir, subset_names, array_names=()):
+    manifest = read_feature_manifest(feature_set_dir)
+    if manifest is None:
+        return False
+    subsets_complete = all(manifest['subsets'].get(name, {}).get('complete') for name in subset_names)
+    return subsets_complete and all(name in manifest['arrays'] for name in array_names)
+
+
+def write_shards_to_memmap(feature_set_dir, subset, array_file, chunk_size=COPY_CHUNK_SIZE):
+    # Copies the shards of a complete subset into one preallocated .npy, chunk_size rows at a time.
+    features = np.lib.format.open_memmap(array_file, mode='w+', dtype=np.float32,
+                                         shape=tuple([subset['n_samples']] + subset.get('feature_shape', [])))
+    for shard in subset['shards'].values():
+        shard_features = np.load(os.path.join(feature_set_dir, shard['file']), mmap_mode='r')
+        for start in xrange(0, len(shard_features), chunk_size):
+            chunk = shard_features[start:start + chunk_size]
+            features[shard['start'] + start:shard['start'] + start + len(chunk)] = chunk
+    features.flush()
+    del features
+
+
+def load_sharded_features(feature_set_dir, subset_name, mmap_mode='r'):
+    """
+    All features of a complete subset as one memory-mapped array. The shards are assembled into
+    <subset>_features.npy on the first load (chunk by chunk, memory stays bounded), later loads map that file.
+    """
+    manifest = read_feature_manifest(feature_set_dir)
+    subset = manifest['subsets'][subset_name]
+    assert subset['complete'], "Feature extraction for {} in {} did not finish.".format(subset_name, feature_set_dir)
+    if len(subset['shards']) == 1:
+        return np.load(os.path.join(feature_set_dir, list(subset['shards'].values())[0]['file']), mmap_mode=mmap_mode)
+
+    array_file = os.path.join(feature_set_dir, "{}_features.npy".format(subset_name))
+    if subset.get('assembled') != os.path.basename(array_file) or not os.path.isfile(array_file):
+        tmp_file = "{}.tmp{}.npy".format(array_file[:-len('.npy')], os.getpid())
+        write_shards_to_memmap(feature_set_dir, subset, tmp_file)
+        os.rename(tmp_file, array_file)
+        subset['assembled'] = os.path.basename(array_file)
+        _write_json_atomic(manifest, os.path.join(feature_set_dir, MANIFEST_NAME))
+    return np.load(array_file, mmap_mode=mmap_mode)
+
+
+def load_feature_set_array(feature_set_dir, name, mmap_mode='r'):
+    manifest = read_feature_manifest(feature_set_dir)
+    return np.load(os.path.join(feature_set_dir, manifest['arrays'][name]), mmap_mode=mmap_mode)
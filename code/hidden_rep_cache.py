@@ -0,0 +1,238 @@
+# hidden_rep_cache.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Content-addressed on-disk cache of the hidden representations (the 512-d
+# output of build_network(get_hidden_reps=True)) of a checkpoint on a dataset.
+# An entry is keyed by
+#   - the fingerprint of the checkpoint file the weights are restored from
+#     (path, size and mtime, so retraining invalidates it),
+#   - the network type and
+#   - a hash of the input rows (the raw uint8 rows and normalization for
+#     NormalizedImages), so any subset or ordering of a dataset gets its own entry.
+# Each entry is one float32 .npy file plus a .json with its key, returned
+# memory-mapped. The cache is bounded in size: after every write, the least
+# recently used entries are evicted until the total is under max_bytes (a hit
+# refreshes the entry's mtime).
+#
+# Inputs without a checkpoint (random weights) are not cached.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from hidden_rep_cache import get_hidden_reps
+#
+# hidden_reps = get_hidden_reps('simple_cnn_cifar100_fine_for_featurization', X_test)
+#
+# or, with an already loaded model:
+# hidden_reps = load_or_compute_hidden_reps(checkpoint_model_id, network_type, X,
+#                                           lambda X: predict_in_batches(model, X))
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import re
+import json
+import glob
+import hashlib
+
+import numpy as np
+
+from constants import *
+from utils import *
+from dataset_cache import file_fingerprint
+from image_store import NormalizedImages
+from model_utils import load_model, predict_in_batches, PREDICT_BATCH_SIZE
+
+
+HIDDEN_REP_CACHE_DIR = '../data/hidden_rep_cache'
+DEFAULT_MAX_CACHE_BYTES = 4 << 30
+
+# Bump whenever the hidden reps of a network change for the same checkpoint and inputs.
+HIDDEN_REP_CACHE_VERSION = 1
+HASH_CHUNK_ROWS = 4096
+
+
+def get_latest_checkpoint_file(checkpoint_model_id):
+    """
+    Latest checkpoint of ../checkpoints/<checkpoint_model_id>/, as tf.train.latest_checkpoint (which load_model
+    restores) would return it, read from the checkpoint state file without importing tensorflow. None if there is no
+    checkpoint.
+    """
+    checkpoint_dir = '../checkpoints/' + checkpoint_model_id + '/'
+    state_file = os.path.join(checkpoint_dir, 'checkpoint')
+    if not os.path.isfile(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        match = re.search(r'^model_checkpoint_path:\s*"(.*)"', f.read(), re.MULTILINE)
+    if match is None:
+        return None
+    checkpoint = match.group(1)
+    if not os.path.isabs(checkpoint):
+        checkpoint = os.path.join(checkpoint_dir, checkpoint)
+    return checkpoint if os.path.isfile(checkpoint) else None
+
+
+def checkpoint_fingerprint(checkpoint_model_id):
+    # Fingerprint of the latest checkpoint file (and its .meta etc. siblings), None if there is no checkpoint.
+    checkpoint = get_latest_checkpoint_file(checkpoint_model_id)
+    if checkpoint is None:
+        return None
+    return dict((os.path.basename(f), file_fingerprint(f)) for f in sorted(glob.glob(checkpoint + '*')))
+
+
+def array_fingerprint(X, chunk_rows=HASH_CHUNK_ROWS):
+    """
+    sha1 of the shape, dtype and contents of X, read chunk_rows rows at a time (memory-mapped arrays are not loaded
+    at once). For NormalizedImages, hashes the raw rows and the normalization instead of the normalized floats.
+    """
+    sha1 = hashlib.sha1()
+    if isinstance(X, NormalizedImages):
+        sha1.update(json.dumps({'mean': np.asarray(X.mean).tolist(), 'scale': np.asarray(X.scale).tolist(),
+                                'dtype': str(X.dtype)}, sort_keys=True).encode('utf-8'))
+        rows = X.indices if X.indices is not None else np.arange(len(X.images))
+        source = X.images
+    else:
+        rows, source = None, X
+    sha1.update(json.dumps({'shape': list(np.shape(X)), 'dtype': str(np.asarray(source[:1]).dtype)}).encode('utf-8'))
+    for start in xrange(0, len(X), chunk_rows):
+        chunk = source[rows[start:start + chunk_rows]] if rows is not None else source[start:start + chunk_rows]
+        sha1.update(np.ascontiguousarray(chunk).data)
+    return sha1.hexdigest()
+
+
+def make_hidden_rep_cache_key(checkpoint_model_id, network_type, X):
+    # Returns (cache_key, key_dict), or (None, None) if checkpoint_model_id has no checkpoint.
+    fingerprint = checkpoint_fingerprint(checkpoint_model_id)
+    if fingerprint is None:
+        return None, None
+    key_dict = {'version': HIDDEN_REP_CACHE_VERSION, 'checkpoint_model_id': checkpoint_model_id,
+                'checkpoint': fingerprint, 'network_type': network_type, 'data': array_fingerprint(X)}
+    key_hash = hashlib.sha1(json.dumps(key_dict, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return "{}_{}".format(checkpoint_model_id, key_hash), key_dict
+
+
+def _entry_files(cache_key, cache_dir):
+    return os.path.join(cache_dir, cache_key + '.npy'), os.path.join(cache_dir, cache_key + '.json')
+
+
+def load_cached_hidden_reps(cache_key, cache_dir=HIDDEN_REP_CACHE_DIR, mmap_mode='r'):
+    # Returns the memory-mapped hidden reps of a complete entry (and marks it as recently used), or None.
+    array_file, key_file = _entry_files(cache_key, cache_dir)
+    if not (os.path.isfile(array_file) and os.path.isfile(key_file)):
+        return None
+    try:
+        with open(key_file, 'r') as f:
+            entry = json.load(f)
+    except ValueError:
+        return None
+    if os.path.getsize(array_file) != entry.get('nbytes'):
+        return None
+    os.utime(array_file, None)
+    return np.load(array_file, mmap_mode=mmap_mode)
+
+
+def save_cached_hidden_reps(cache_key, hidden_reps, key_dict=None, cache_dir=HIDDEN_REP_CACHE_DIR):
+    # Writes to temporary files first and renames them into place, so readers never see a partial entry.
+    array_file, key_file = _entry_files(cache_key, cache_dir)
+    check_if_path_exists_or_create(array_file)
+    tmp_suffix = '.tmp{}'.format(os.getpid())
+    with open(array_file + tmp_suffix, 'wb') as f:
+        np.save(f, np.asarray(hidden_reps, dtype=np.float32))
+    with open(key_file + tmp_suffix, 'w') as f:
+        json.dump({'key': key_dict or {}, 'shape': list(np.shape(hidden_reps)),
+                   'nbytes': os.path.getsize(array_file + tmp_suffix)}, f, indent=2, sort_keys=True)
+    # The array goes last: an entry only counts as complete once both files exist.
+    os.rename(key_file + tmp_suffix, key_file)
+    os.rename(array_file + tmp_suffix, array_file)
+
+
+def evict_hidden_reps(max_bytes=DEFAULT_MAX_CACHE_BYTES, cache_dir=HIDDEN_REP_CACHE_DIR, keep=()):
+    """
+    Removes least recently used entries until the cache holds at most max_bytes (entries in keep are never removed).
+    Returns the cache keys of the removed entries.
+    """
+    entries = []
+    for array_file in glob.glob(os.path.join(cache_dir, '*.npy')):
+        cache_key = os.path.basename(array_file)[:-len('.npy')]
+        stat = os.stat(array_file)
+        entries.append((stat.st_mtime, stat.st_size, cache_key))
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, cache_key in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if cache_key in keep:
+            continue
+        for entry_file in _entry_files(cache_key, cache_dir):
+            if os.path.isfile(entry_file):
+                os.remove(entry_file)
+        total_bytes -= size
+        evicted.append(cache_key)
+    if evicted:
+        print("Evicted {} hidden rep cache entries.".format(len(evicted)))
+    return evicted
+
+
+def load_or_compute_hidden_reps(checkpoint_model_id, network_type, X, compute_fn, use_cache=True,
+                                max_bytes=DEFAULT_MAX_CACHE_BYTES, cache_dir=HIDDEN_REP_CACHE_DIR):
+    """
+    compute_fn: function X -> hidden reps of X, with the weights of the latest checkpoint of checkpoint_model_id
+    Returns the hidden reps of X, memory-mapped read-only float32 when served from (or written to) the cache.
+    """
+    cache_key, key_dict = make_hidden_rep_cache_key(checkpoint_model_id, network_type, X) if use_cache else (None, None)
+    if cache_key is None:
+        return np.asarray(compute_fn(X), dtype=np.float32)
+
+    hidden_reps = load_cached_hidden_reps(cache_key, cache_dir)
+    if hidden_reps is not None:
+        print("Loaded hidden reps of {} from cache entry {}".format(checkpoint_model_id, cache_key))
+        return hidden_reps
+
+    save_cached_hidden_reps(cache_key, compute_fn(X), key_dict=key_dict, cache_dir=cache_dir)
+    print("Saved hidden reps of {} to cache entry {}".format(checkpoint_model_id, cache_key))
+    evict_hidden_reps(max_bytes, cache_dir, keep=(cache_key,))
+    return load_cached_hidden_reps(cache_key, cache_dir)
+
+
+class LazyHiddenRepModel(object):
+    # Loads the hidden rep model of model_id (in a graph of its own) on the first call only, so cache hits don't
+    # build a graph.
+    def __init__(self, model_id, checkpoint_model_id=None, batch_size=PREDICT_BATCH_SIZE, **model_kwargs):
+        self.model_id = model_id
+        self.checkpoint_model_id = checkpoint_model_id or model_id
+        self.batch_size = batch_size
+        self.model_kwargs = model_kwargs
+        self.graph, self.model = None, None
+
+    def load(self):
+        if self.model is None:
+            import tensorflow as tf
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                self.model = load_model(self.model_id, checkpoint_model_id=self.checkpoint_model_id, is_training=False,
+                                        get_hidden_reps=True, **self.model_kwargs)
+        return self.model
+
+    def __call__(self, X):
+        model = self.load()
+        with self.graph.as_default():
+            return predict_in_batches(model, X, batch_size=self.batch_size)
+
+
+def get_hidden_reps(model_id, X, checkpoint_model_id=None, batch_size=PREDICT_BATCH_SIZE, use_cache=True,
+                    max_bytes=DEFAULT_MAX_CACHE_BYTES, **model_kwargs):
+    """
+    Hidden reps of X for model_id's network with the weights of checkpoint_model_id (default: model_id), from the
+    cache if possible. model_kwargs (n_classes, pyramid_output_dims) are passed to load_model on a cache miss.
+    """
+    checkpoint_model_id = checkpoint_model_id or model_id
+    compute_fn = LazyHiddenRepModel(model_id, checkpoint_model_id, batch_size=batch_size, **model_kwargs)
+    return load_or_compute_hidden_reps(checkpoint_model_id, ALL_MODEL_DICTS[model_id]['network_type'], X, compute_fn,
+                                       use_cache=use_cache, max_bytes=max_bytes)
+
+
+def clear_hidden_rep_cache(cache_dir=HIDDEN_REP_CACHE_DIR):
+    for entry_file in glob.glob(os.path.join(cache_dir, '*.npy')) + glob.glob(os.path.join(cache_dir, '*.json')):
+        os.remove(entry_file)
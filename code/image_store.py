@@ -0,0 +1,62 @@
+# image_store.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Lazily normalized view over a uint8 NHWC image array (typically a memory-
+# mapped .npy file from the dataset cache). Images stay uint8 on disk and are
+# only converted to float32 and normalized one batch at a time, when tflearn
+# (or predict_in_batches) indexes into the view. Otherwise a DatasetView (see
+# dataset_view.py), so shuffles and splits stay index views too.
+#
+# Indexing semantics:
+#   images[i]             -> one normalized float32 image
+#   images[[i, j, ...]]   -> normalized float32 batch (this is how tflearn's
+#                            data flow gathers batches)
+#   images[start:stop]    -> lazy NormalizedImages view, no data is read
+#   images.subset(idx)    -> lazy NormalizedImages view over the given rows
+#   np.asarray(images)    -> materializes everything (avoid for large sets)
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from image_store import NormalizedImages
+#
+# X = NormalizedImages(np.load('X_train.npy', mmap_mode='r'), mean, std + EPSILON)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+from dataset_view import DatasetView
+
+
+class NormalizedImages(DatasetView):
+    def __init__(self, images, mean=0., scale=1., indices=None, dtype=np.float32):
+        """
+        Args:
+            images: uint8 array of shape (n_images, height, width, channels), usually memory-mapped
+            mean, scale: each returned image is (image - mean) / scale
+            indices: optional integer array selecting (and ordering) rows of images
+        """
+        DatasetView.__init__(self, images, indices=indices)
+        self.mean = mean
+        self.scale = scale
+        self.normalized_dtype = np.dtype(dtype)
+
+    @property
+    def images(self):
+        return self.data
+
+    @property
+    def dtype(self):
+        return self.normalized_dtype
+
+    def _new_view(self, images, indices):
+        return NormalizedImages(images, self.mean, self.scale, indices=indices, dtype=self.dtype)
+
+    def _transform(self, raw):
+        batch = raw.astype(self.dtype)
+        batch -= self.dtype.type(self.mean)
+        batch /= self.dtype.type(self.scale)
+        return batch
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# import_budget.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Import-time budget check for the command line entry points. Each target is
+# run in a fresh interpreter (cold start, like a user typing the command) and
+# the check fails if it is slower than its budget, or if it loaded one of the
+# heavy modules (tensorflow, tflearn, sklearn, plotting libraries, ...) that
+# should only be imported once a mode / network_type actually needs them.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# python import_budget.py [-n <n_runs>] [-s <budget_scale>]
+# Exit code is 1 if any target is over budget.
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+import subprocess
+
+import numpy as np
+
+
+HEAVY_MODULES = ['tensorflow', 'tflearn', 'sklearn', 'scipy', 'matplotlib', 'seaborn', 'pandas', 'tabulate']
+
+# (name, script, argv, budget in seconds). script=None means the target is only imported.
+IMPORT_BUDGET_TARGETS = [
+    ('pipeline.py -h', 'pipeline.py', ['-h'], 1.0),
+    ('feature_extractor.py -h', 'feature_extractor.py', ['-h'], 1.0),
+    ('import pyramid_wrapper', None, ['pyramid_wrapper'], 1.0),
+    ('import numpy_inference', None, ['numpy_inference'], 1.0),
+    ('import vis', None, ['vis'], 1.0),
+]
+
+# Runs a target in a fresh interpreter and prints the heavy modules it loaded as JSON on the last line.
+_PROBE = """
+import sys, json, runpy
+script, argv = sys.argv[1], sys.argv[2:]
+try:
+    if script == '-':
+        __import__(argv[0])
+    else:
+        sys.argv = [script] + argv
+        runpy.run_path(script, run_name='__main__')
+except SystemExit:
+    pass
+heavy = %r
+print(json.dumps(sorted(m for m in heavy if m in sys.modules)))
+""" % (HEAVY_MODULES, )
+
+
+def measure_cold_start(script, argv, n_runs=3):
+    """
+    Returns (seconds, heavy_modules): the median wall clock time of n_runs fresh interpreters running the target,
+    and the heavy modules it imported.
+    """
+    times, heavy_modules = [], []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(n_runs):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, '-c', _PROBE, script or '-'] + argv, stderr=devnull)
+            times.append(time.time() - start)
+            heavy_modules = json.loads(output.strip().splitlines()[-1])
+    return float(np.median(times)), heavy_modules
+
+
+def check_import_budgets(n_runs=3, budget_scale=1.):
+    results, all_ok = [], True
+    for name, script, argv, budget in IMPORT_BUDGET_TARGETS:
+        seconds, heavy_modules = measure_cold_start(script, argv, n_runs=n_runs)
+        ok = seconds <= budget * budget_scale and not heavy_modules
+        all_ok = all_ok and ok
+        results.append({'target': name, 'seconds': seconds, 'budget': budget * budget_scale,
+                        'heavy_modules': heavy_modules, 'ok': ok})
+        print("{:<28} {:6.2f}s (budget {:.2f}s) {} {}".format(
+            name, seconds, budget * budget_scale, 'OK  ' if ok else 'FAIL',
+            'heavy modules: ' + ', '.join(heavy_modules) if heavy_modules else ''))
+    return all_ok, results
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python import_budget.py [-n <n_runs>] [-s <budget_scale>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:", ["help", "n_runs", "budget_scale"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    n_runs, budget_scale = 3, 1.
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--n_runs"):
+            n_runs = int(a)
+        elif o in ("-s", "--budget_scale"):
+            budget_scale = float(a)
+        else:
+            assert False, "unhandled option"
+    return n_runs, budget_scale
+
+
+def main():
+    n_runs, budget_scale = read_commandline_args()
+    all_ok, _ = check_import_budgets(n_runs=n_runs, budget_scale=budget_scale)
+    sys.exit(0 if all_ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+# input_pipeline.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Producer/consumer input pipeline for training. A pool of workers (threads or
+# processes) gathers batches, runs the network's data preprocessing and
+# augmentation, and keeps up to prefetch_depth batches ready, so that batch
+# preparation overlaps with the training step instead of running serially
+# with it as it does inside tflearn.DNN.fit.
+#
+# fit_with_prefetch is a replacement for model.fit(...) for tflearn.DNN models
+# built by model_utils.load_model: it runs the model's own training op on the
+# prefetched batches and writes checkpoints with the model's saver, so they
+# can be restored with load_model as before.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from input_pipeline import *
+#
+# fit_with_prefetch(model, X, Y, n_epoch=200, batch_size=128, validation_set=0.1, n_workers=4, prefetch_depth=8)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import time
+import random
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from dataset_view import split_views
+
+
+# Per-process state for process workers, set by _init_worker. Thread workers share the prefetcher's arrays directly.
+_worker_state = {}
+
+
+def _init_worker(X, Y, transform_fn):
+    _worker_state['X'] = X
+    _worker_state['Y'] = Y
+    _worker_state['transform_fn'] = transform_fn
+
+
+def _gather_batch(X, Y, transform_fn, batch_indices, seed=None):
+    if seed is not None:
+        # Forked workers start with identical RNG states, reseed so they don't produce identical augmentations.
+        random.seed(seed)
+        np.random.seed(seed)
+    X_batch = np.asarray(X[batch_indices])
+    Y_batch = np.asarray(Y[batch_indices])
+    if transform_fn is not None:
+        X_batch = transform_fn(X_batch)
+    return X_batch, Y_batch
+
+
+def _gather_batch_in_process(batch_indices, seed):
+    return _gather_batch(_worker_state['X'], _worker_state['Y'], _worker_state['transform_fn'], batch_indices, seed)
+
+
+class BatchPrefetcher(object):
+    def __init__(self, X, Y, batch_size=128, shuffle=True, transform_fn=None, n_workers=2, prefetch_depth=4,
+                 use_processes=False, seed=None):
+        """
+        Args:
+            X, Y: arrays (or NormalizedImages) indexable with an integer index list
+            transform_fn: function applied by the workers to each X batch (preprocessing + augmentation).
+                With use_processes=True it runs in forked worker processes, so it must not depend on TF sessions.
+            n_workers: number of worker threads / processes
+            prefetch_depth: maximum number of batches prepared ahead of the consumer
+        """
+        assert n_workers > 0 and prefetch_depth > 0
+        self.X, self.Y = X, Y
+        self.n_samples = len(X)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.transform_fn = transform_fn
+        self.prefetch_depth = prefetch_depth
+        self.use_processes = use_processes
+        self.random_state = np.random.RandomState(seed)
+        if use_processes:
+            # Workers are forked here and inherit X, Y (cheap for memory-mapped stores).
+            self.pool = Pool(n_workers, initializer=_init_worker, initargs=(X, Y, transform_fn))
+        else:
+            self.pool = ThreadPool(n_workers)
+
+    def n_batches(self):
+        return int(np.ceil(self.n_samples / self.batch_size))
+
+    def _submit(self, batch_indices):
+        if self.use_processes:
+            return self.pool.apply_async(_gather_batch_in_process,
+                                         (batch_indices, self.random_state.randint(2 ** 31 - 1)))
+        return self.pool.apply_async(_gather_batch, (self.X, self.Y, self.transform_fn, batch_indices))
+
+    def epoch(self):
+        """
+        Yields (X_batch, Y_batch) for one pass over the data, in order, with at most prefetch_depth batches in flight.
+        """
+        index_array = np.arange(self.n_samples)
+        if self.shuffle:
+            self.random_state.shuffle(index_array)
+        batches = (index_array[start:start + self.batch_size] for start in xrange(0, self.n_samples, self.batch_size))
+
+        in_flight = deque()
+        for batch_indices in batches:
+            in_flight.append(self._submit(batch_indices))
+            if len(in_flight) >= self.prefetch_depth:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _get_data_ops(model):
+    # The model input layer's tflearn ImagePreprocessing and ImageAugmentation (each None if there is none).
+    import tensorflow as tf
+
+    with model.session.graph.as_default():
+        preprocessings = tf.get_collection(tf.GraphKeys.DATA_PREP)
+        augmentations = tf.get_collection(tf.GraphKeys.DATA_AUG)
+    return preprocessings[0] if preprocessings else None, augmentations[0] if augmentations else None
+
+
+def get_preprocessing_fn(model, X_sample=None):
+    """
+    Returns a function applying only the data preprocessing the model's input layer registered (what tflearn applies
+    at validation and test time too), or None if there is none.
+    Featurewise preprocessing statistics are initialized on X_sample, as DNN.fit would on the training set.
+    """
+    preprocessing, _ = _get_data_ops(model)
+    if preprocessing is None:
+        return None
+    if X_sample is not None:
+        preprocessing.initialize(X_sample, model.session)
+    return preprocessing.apply
+
+
+def get_augmentation_fn(model):
+    # Returns a function applying the model's training-time data augmentation, or None if there is none.
+    _, augmentation = _get_data_ops(model)
+    return augmentation.apply if augmentation is not None else None
+
+
+def compose_transforms(*transform_fns):
+    # Applies the given batch transforms in order, skipping None. Returns None if all of them are None.
+    transform_fns = [fn for fn in transform_fns if fn is not None]
+    if not transform_fns:
+        return None
+
+    def transform_fn(X_batch):
+        for fn in transform_fns:
+            X_batch = fn(X_batch)
+        return X_batch
+
+    return transform_fn
+
+
+def get_data_transform_fn(model, X_sample=None):
+    """
+    Returns a function applying the data preprocessing and then the augmentation that the model's input layer
+    registered (tflearn applies these itself inside DNN.fit), or None if there are none.
+    """
+    return compose_transforms(get_preprocessing_fn(model, X_sample), get_augmentation_fn(model))
+
+
+def get_training_transform_fns(model, X, seed=None):
+    """
+    Returns (transform_fn, val_transform_fn): preprocessing and augmentation for training batches, and only the
+    preprocessing for validation batches. The featurewise statistics are initialized on up to 10000 rows of X.
+    """
+    sample_indices = np.sort(np.random.RandomState(seed).permutation(len(X))[:10000])
+    preprocessing_fn = get_preprocessing_fn(model, X_sample=np.asarray(X[sample_indices]))
+    return compose_transforms(preprocessing_fn, get_augmentation_fn(model)), preprocessing_fn
+
+
+def _run_validation(model, train_op, prefetcher):
+    import tflearn
+
+    tflearn.is_training(False, session=model.session)
+    fetches = [train_op.loss] + ([train_op.metric] if train_op.metric is not None else [])
+    totals, n_samples = np.zeros(len(fetches)), 0
+    for X_batch, Y_batch in prefetcher.epoch():
+        values = model.session.run(fetches, feed_dict={model.inputs[0]: X_batch, model.targets[0]: Y_batch})
+        totals += np.array(values, dtype=np.float64) * len(X_batch)
+        n_samples += len(X_batch)
+    return totals / max(n_samples, 1)
+
+
+def fit_with_prefetch(model, X, Y, n_epoch=10, batch_size=128, validation_set=None, shuffle=True, snapshot_step=None,
+                      n_workers=2, prefetch_depth=4, use_processes=False, seed=None, transform_fn=None,
+                      val_transform_fn=None):
+    """
+    Trains a tflearn.DNN with batches from a BatchPrefetcher.
+
+    Args:
+        validation_set: None, a float (fraction of X, Y held out from the end, like tflearn) or a tuple (X_val, Y_val)
+        snapshot_step: save a checkpoint every snapshot_step training steps (and always at the end of each epoch)
+        transform_fn: batch transform run by the workers. Defaults to the model's own data preprocessing and
+            augmentation, see get_data_transform_fn. With use_processes=True the transform runs in forked workers,
+            so it must be plain numpy (tflearn's ImageAugmentation and ImagePreprocessing are).
+        val_transform_fn: batch transform for the validation set. Defaults to only the model's preprocessing when
+            transform_fn is None (no augmentation, like tflearn at test time), to no transform otherwise.
+    """
+    import tflearn
+
+    X_val, Y_val = None, None
+    if isinstance(validation_set, float):
+        (X, Y), (X_val, Y_val) = split_views([X, Y], validation_set)
+    elif validation_set is not None:
+        X_val, Y_val = validation_set
+
+    if transform_fn is None:
+        transform_fn, default_val_transform_fn = get_training_transform_fns(model, X, seed=seed)
+        val_transform_fn = val_transform_fn or default_val_transform_fn
+
+    train_op = model.trainer.train_ops[0]
+    session = model.session
+    input_placeholder, target_placeholder = model.inputs[0], model.targets[0]
+    train_prefetcher = BatchPrefetcher(X, Y, batch_size=batch_size, shuffle=shuffle, transform_fn=transform_fn,
+                                       n_workers=n_workers, prefetch_depth=prefetch_depth,
+                                       use_processes=use_processes, seed=seed)
+    val_prefetcher = None
+    if X_val is not None:
+        # No augmentation for validation, only the preprocessing tflearn would apply at test time.
+        val_prefetcher = BatchPrefetcher(X_val, Y_val, batch_size=batch_size, shuffle=False,
+                                         transform_fn=val_transform_fn, n_workers=n_workers,
+                                         prefetch_depth=prefetch_depth)
+
+    step = 0
+    try:
+        for epoch in xrange(n_epoch):
+            epoch_start = time.time()
+            losses = []
+            tflearn.is_training(True, session=session)
+            for X_batch, Y_batch in train_prefetcher.epoch():
+                _, loss = session.run([train_op.apply_grad, train_op.loss],
+                                      feed_dict={input_placeholder: X_batch, target_placeholder: Y_batch})
+                losses.append(loss)
+                step += 1
+                if snapshot_step and step % snapshot_step == 0:
+                    model.trainer.save(model.trainer.checkpoint_path, global_step=step)
+
+            message = "Epoch {} | step {} | loss: {:.5f} | {:.1f}s".format(epoch + 1, step, np.mean(losses),
+                                                                           time.time() - epoch_start)
+            if val_prefetcher is not None:
+                val_values = _run_validation(model, train_op, val_prefetcher)
+                message += " | val_loss: {:.5f}".format(val_values[0])
+                if len(val_values) > 1:
+                    message += " | val_acc: {:.4f}".format(val_values[1])
+            print(message)
+            if model.trainer.checkpoint_path:
+                model.trainer.save(model.trainer.checkpoint_path, global_step=step)
+    finally:
+        train_prefetcher.close()
+        if val_prefetcher is not None:
+            val_prefetcher.close()
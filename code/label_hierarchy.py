@@ -0,0 +1,121 @@
+# label_hierarchy.py
+#
+#===============================================================================
+# DESCRIPTION:
+# Integer lookup tables for the CIFAR-100 coarse / fine label hierarchy, so
+# hierarchy operations on label arrays are a single fancy-indexing lookup
+# instead of per-sample lookups of label names:
+#   fine_to_coarse[f]         coarse id of fine id f
+#   children(c)               fine ids of coarse id c, in label name order
+#                             (coarse_children[coarse_offsets[c]:coarse_offsets[c + 1]])
+#   fine_rank[f]              position of f among the children of its coarse class
+#   fine_role[f]              ROLE_JOINT, ROLE_GATE or ROLE_TEST_ONLY
+#
+# Roles (the pyramid split, see data_utils.load_cifar_pyramid): the first 2
+# fine labels of every coarse class are trained on at the fine level (joint),
+# the next 2 are only used to train the gate, the 5th is never seen in
+# training. Joint labels are used for the gate as well.
+#
+# A hierarchy is built from the fine and coarse label arrays of a dataset
+# alone; data_utils.load_cifar100_label_hierarchy builds it once from the
+# raw CIFAR-100 labels and caches it.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from data_utils import load_cifar100_label_hierarchy
+#
+# label_hierarchy = load_cifar100_label_hierarchy()
+# y_coarse = label_hierarchy.fine_to_coarse[y_fine]
+# joint_indices = np.flatnonzero(label_hierarchy.joint_mask()[y_fine])
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+ROLE_JOINT = 0
+ROLE_GATE = 1
+ROLE_TEST_ONLY = 2
+
+# Number of fine labels per coarse class with the joint and gate roles (see above).
+N_JOINT_PER_COARSE = 2
+N_GATE_PER_COARSE = 4
+
+
+class LabelHierarchy(object):
+    def __init__(self, fine_to_coarse, fine_label_names=None, coarse_label_names=None):
+        """
+        Args:
+            fine_to_coarse: integer array of shape (n_fine,), the coarse id of every fine id
+            fine_label_names, coarse_label_names: optional lists of label names; the children of a coarse class
+                are ordered by name (by id without names)
+        """
+        self.fine_to_coarse = np.asarray(fine_to_coarse, dtype=np.int64)
+        n_fine = len(self.fine_to_coarse)
+        self.fine_label_names = None if fine_label_names is None else list(fine_label_names)
+        self.coarse_label_names = None if coarse_label_names is None else list(coarse_label_names)
+        n_coarse = len(self.coarse_label_names) if self.coarse_label_names is not None \
+            else int(self.fine_to_coarse.max()) + 1
+        assert self.fine_label_names is None or len(self.fine_label_names) == n_fine, \
+            "fine_label_names has to have one name per fine label"
+        assert self.fine_to_coarse.min() >= 0 and self.fine_to_coarse.max() < n_coarse, "Invalid coarse ids"
+
+        name_order = np.arange(n_fine) if self.fine_label_names is None else \
+            np.argsort(np.argsort(self.fine_label_names, kind='mergesort'), kind='mergesort')
+        # CSR layout: the children of coarse class c are coarse_children[coarse_offsets[c]:coarse_offsets[c + 1]].
+        self.coarse_children = np.lexsort((name_order, self.fine_to_coarse))
+        self.coarse_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.fine_to_coarse, minlength=n_coarse))))
+
+        self.fine_rank = np.empty(n_fine, dtype=np.int64)
+        self.fine_rank[self.coarse_children] = np.arange(n_fine) - self.coarse_offsets[
+            self.fine_to_coarse[self.coarse_children]]
+        self.fine_role = np.full(n_fine, ROLE_TEST_ONLY, dtype=np.int8)
+        self.fine_role[self.fine_rank < N_GATE_PER_COARSE] = ROLE_GATE
+        self.fine_role[self.fine_rank < N_JOINT_PER_COARSE] = ROLE_JOINT
+
+    @classmethod
+    def from_labels(cls, y_fine, y_coarse, fine_label_names=None, coarse_label_names=None, n_fine=None):
+        # Derives fine_to_coarse from paired label arrays, every fine label has to occur (with a single coarse label).
+        y_fine, y_coarse = np.asarray(y_fine, dtype=np.int64), np.asarray(y_coarse, dtype=np.int64)
+        if n_fine is None:
+            n_fine = len(fine_label_names) if fine_label_names is not None else int(y_fine.max()) + 1
+        fine_to_coarse = np.full(n_fine, -1, dtype=np.int64)
+        fine_to_coarse[y_fine] = y_coarse
+        if np.any(fine_to_coarse < 0):
+            raise Exception("Fine labels {} don't occur in the labels".format(np.flatnonzero(fine_to_coarse < 0)))
+        if np.any(fine_to_coarse[y_fine] != y_coarse):
+            raise Exception("Some fine labels occur with more than one coarse label")
+        return cls(fine_to_coarse, fine_label_names, coarse_label_names)
+
+    @property
+    def n_fine(self):
+        return len(self.fine_to_coarse)
+
+    @property
+    def n_coarse(self):
+        return len(self.coarse_offsets) - 1
+
+    def children(self, coarse):
+        return self.coarse_children[self.coarse_offsets[coarse]:self.coarse_offsets[coarse + 1]]
+
+    def joint_mask(self):
+        # Boolean mask over fine ids, index it with fine labels: joint_mask()[y_fine].
+        return self.fine_role == ROLE_JOINT
+
+    def gate_mask(self):
+        return self.fine_role <= ROLE_GATE
+
+    def only_test_mask(self):
+        return self.fine_role == ROLE_TEST_ONLY
+
+    def is_consistent(self, y_fine, y_coarse):
+        # Per sample: whether fine label y_fine belongs to coarse label y_coarse.
+        return self.fine_to_coarse[y_fine] == np.asarray(y_coarse)
+
+    def to_coarse_to_fine_map(self):
+        # The legacy coarse_to_fine_map format: coarse name -> sorted list of fine names.
+        assert self.fine_label_names is not None and self.coarse_label_names is not None, "Needs label names"
+        return dict((self.coarse_label_names[c], [self.fine_label_names[f] for f in self.children(c)])
+                    for c in range(self.n_coarse))
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+# model_server.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Long-lived model daemon. Keeps up to max_models loaded models (graph built,
+# checkpoint restored) in an LRU cache keyed by (model_id, get_hidden_reps), and
+# serves predict, hidden_reps and evaluate requests over a local Unix socket,
+# so repeated test runs / notebook analysis skip graph construction and
+# checkpoint restore.
+#
+# Requests and responses are python dicts (numpy arrays included) sent with
+# multiprocessing.connection, which pickles them and authenticates the client
+# with authkey. Since unpickling a request can run arbitrary code, only the
+# user running the server may connect:
+#   - the socket lives in a private directory (mode 0700, owned by the user,
+#     checked on every start) and is created with a 0177 umask
+#   - the authkey is 32 random bytes, generated once per user into a 0600 file
+#     in that directory, and read by the clients
+#
+# Clients: pipeline.py -t test -s, pyramid_wrapper.py -s and
+# vis.visualize_embeddings_with_tsne(model_client=...).
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# Start the daemon:
+# python model_server.py [-a <socket_path>] [-n <max_models>] [-p <model_id,model_id,...>]
+#
+# From another process (e.g. a notebook):
+# from model_server import ModelClient
+# client = ModelClient()
+# probs = client.predict('simple_cnn_cifar100_fine', X_test)
+# reps = client.hidden_reps('simple_cnn_cifar100_fine_for_featurization', X_test)
+# acc = client.evaluate('simple_cnn_cifar100_fine')   # on the model's test set
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import time
+import stat
+import errno
+import socket
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import numpy as np
+
+from constants import *
+
+
+SERVER_DIR = os.path.join(tempfile.gettempdir(), 'semantic_convnets_model_server_{}'.format(os.getuid()))
+DEFAULT_SOCKET_PATH = os.path.join(SERVER_DIR, 'model_server.sock')
+AUTHKEY_FILE = os.path.join(SERVER_DIR, 'authkey')
+AUTHKEY_BYTES = 32
+DEFAULT_MAX_MODELS = 3
+
+
+def get_private_dir(directory=SERVER_DIR):
+    """
+    Creates directory with mode 0700 if needed. Raises if it exists but isn't a directory owned by this user and
+    inaccessible to everybody else (e.g. created by another user to intercept the socket).
+    """
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    dir_stat = os.lstat(directory)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise Exception("{} has to be a directory owned by the current user with mode 0700".format(directory))
+    return directory
+
+
+def load_or_create_authkey(authkey_file=AUTHKEY_FILE):
+    # The per-user random authkey, created (mode 0600) on first use.
+    get_private_dir(os.path.dirname(authkey_file))
+    try:
+        fd = os.open(authkey_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(AUTHKEY_BYTES))
+    with open(authkey_file, 'rb') as f:
+        authkey = f.read()
+    assert len(authkey) == AUTHKEY_BYTES, "Invalid authkey file {}".format(authkey_file)
+    return authkey
+
+
+class ModelCache(object):
+    def __init__(self, max_models=DEFAULT_MAX_MODELS):
+        self.max_models = max_models
+        self.models = OrderedDict()  # (model_id, get_hidden_reps) -> tflearn.DNN, least recently used first
+        self.n_loads, self.n_hits = 0, 0
+
+    def get(self, model_id, get_hidden_reps=False):
+        key = (model_id, get_hidden_reps)
+        if key in self.models:
+            self.n_hits += 1
+            model = self.models.pop(key)
+            self.models[key] = model
+            return model
+
+        while len(self.models) >= self.max_models:
+            self.evict(next(iter(self.models)))
+        self.models[key] = self._load(model_id, get_hidden_reps)
+        self.n_loads += 1
+        return self.models[key]
+
+    def _load(self, model_id, get_hidden_reps):
+        import tensorflow as tf
+        from model_utils import load_model, get_model_output_kwargs
+
+        start = time.time()
+        # Every model gets its own graph, so models can be evicted (and their sessions closed) independently.
+        with tf.Graph().as_default():
+            model = load_model(model_id, checkpoint_model_id=model_id, is_training=False,
+                               get_hidden_reps=get_hidden_reps, **get_model_output_kwargs(model_id))
+        print("Loaded {} (hidden reps: {}) in {:.1f}s".format(model_id, get_hidden_reps, time.time() - start))
+        return model
+
+    def evict(self, key):
+        model = self.models.pop(key)
+        model.session.close()
+        print("Evicted {} (hidden reps: {})".format(*key))
+
+    def stats(self):
+        return {'loaded': [list(key) for key in self.models], 'max_models': self.max_models,
+                'n_loads': self.n_loads, 'n_hits': self.n_hits}
+
+
+class ModelServer(object):
+    def __init__(self, address=DEFAULT_SOCKET_PATH, authkey=None, max_models=DEFAULT_MAX_MODELS):
+        # authkey: defaults to the per-user key of load_or_create_authkey
+        self.address = address
+        self.authkey = authkey or load_or_create_authkey()
+        self.cache = ModelCache(max_models)
+        # Loading, evicting and running models all go through one lock: requests from several clients are
+        # serialized, which keeps eviction from closing a session another request is using.
+        self.lock = threading.Lock()
+        self.test_sets = {}
+        self.running = False
+
+    def _get_test_set(self, dataset):
+        from data_utils import load_data
+        from model_utils import TRAINING_STORAGE
+
+        if dataset not in self.test_sets:
+            _, _, X_test, Y_test = load_data(dataset, storage=TRAINING_STORAGE)
+            self.test_sets[dataset] = (X_test, Y_test)
+        return self.test_sets[dataset]
+
+    def handle_request(self, request):
+        from model_utils import predict_in_batches, PREDICT_BATCH_SIZE
+
+        op = request['op']
+        batch_size = request.get('batch_size', PREDICT_BATCH_SIZE)
+        if op == 'predict':
+            model = self.cache.get(request['model_id'])
+            return predict_in_batches(model, request['X'], batch_size=batch_size)
+        elif op == 'hidden_reps':
+            model = self.cache.get(request['model_id'], get_hidden_reps=True)
+            return predict_in_batches(model, request['X'], batch_size=batch_size)
+        elif op == 'evaluate':
+            return self.evaluate(request['model_id'], request.get('X'), request.get('Y'), batch_size)
+        elif op == 'preload':
+            self.cache.get(request['model_id'], get_hidden_reps=request.get('get_hidden_reps', False))
+            return self.cache.stats()
+        elif op == 'evict':
+            key = (request['model_id'], request.get('get_hidden_reps', False))
+            if key in self.cache.models:
+                self.cache.evict(key)
+            return self.cache.stats()
+        elif op == 'stats':
+            return self.cache.stats()
+        elif op == 'shutdown':
+            self.running = False
+            return None
+        raise Exception("Unknown request op {}".format(op))
+
+    def evaluate(self, model_id, X=None, Y=None, batch_size=128):
+        """
+        Accuracy of a single-head classifier on (X, Y), or on the test set of the model's dataset if X is None.
+        Y can be one-hot or dense class ids.
+        """
+        from model_utils import predict_in_batches
+
+        model_dict = ALL_MODEL_DICTS[model_id]
+        if model_dict['network_type'] in ('pyramid', 'cnn_rnn', 'cnn_rnn_end_to_end'):
+            raise Exception("evaluate only supports single-head classifiers, use predict for {}".format(model_id))
+        if X is None:
+            X, Y = self._get_test_set(model_dict['dataset'])
+        Y = np.asarray(Y)
+        y = np.argmax(Y, axis=1) if Y.ndim == 2 else Y
+        pred = np.argmax(predict_in_batches(self.cache.get(model_id), X, batch_size=batch_size), axis=1)
+        return {'accuracy': float(np.mean(pred == y)), 'n_samples': len(y)}
+
+    def _serve_connection(self, conn):
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                start = time.time()
+                try:
+                    with self.lock:
+                        result = self.handle_request(request)
+                    response = {'ok': True, 'result': result}
+                except Exception as e:
+                    traceback.print_exc()
+                    response = {'ok': False, 'error': "{}: {}".format(type(e).__name__, e)}
+                response['seconds'] = time.time() - start
+                conn.send(response)
+                if not self.running:
+                    # Wake up serve_forever, which is blocked in accept(), so it sees the shutdown.
+                    Client(self.address, family='AF_UNIX', authkey=self.authkey).close()
+                    break
+        finally:
+            conn.close()
+
+    def serve_forever(self, preload_model_ids=()):
+        for model_id in preload_model_ids:
+            self.cache.get(model_id)
+        if self.address == DEFAULT_SOCKET_PATH:
+            get_private_dir(os.path.dirname(self.address))
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        # The socket is created 0600 (not chmod-ed after it already accepts connections).
+        old_umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(old_umask)
+        print("Model server listening on {}".format(self.address))
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    print("Rejected a connection with a wrong authkey.")
+                    continue
+                thread = threading.Thread(target=self._serve_connection, args=(conn, ))
+                thread.daemon = True
+                thread.start()
+                if not self.running:
+                    break
+        finally:
+            listener.close()
+            if os.path.exists(self.address):
+                os.remove(self.address)
+
+
+class ModelClient(object):
+    def __init__(self, address=DEFAULT_SOCKET_PATH, authkey=None):
+        self.conn = Client(address, family='AF_UNIX', authkey=authkey or load_or_create_authkey())
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        self.conn.send(kwargs)
+        response = self.conn.recv()
+        if not response['ok']:
+            raise Exception("Model server error: {}".format(response['error']))
+        return response['result']
+
+    def predict(self, model_id, X, batch_size=None):
+        kwargs = {'batch_size': batch_size} if batch_size else {}
+        return self.request('predict', model_id=model_id, X=np.asarray(X), **kwargs)
+
+    def hidden_reps(self, model_id, X, batch_size=None):
+        kwargs = {'batch_size': batch_size} if batch_size else {}
+        return self.request('hidden_reps', model_id=model_id, X=np.asarray(X), **kwargs)
+
+    def evaluate(self, model_id, X=None, Y=None):
+        if X is None:
+            return self.request('evaluate', model_id=model_id)
+        return self.request('evaluate', model_id=model_id, X=np.asarray(X), Y=np.asarray(Y))
+
+    def preload(self, model_id, get_hidden_reps=False):
+        return self.request('preload', model_id=model_id, get_hidden_reps=get_hidden_reps)
+
+    def evict(self, model_id, get_hidden_reps=False):
+        return self.request('evict', model_id=model_id, get_hidden_reps=get_hidden_reps)
+
+    def stats(self):
+        return self.request('stats')
+
+    def shutdown(self):
+        result = self.request('shutdown')
+        self.close()
+        return result
+
+    def close(self):
+        self.conn.close()
+
+
+def connect_to_model_server(address=DEFAULT_SOCKET_PATH):
+    # A ModelClient if a model server is running at address, else None.
+    if not os.path.exists(address):
+        print("No model server running at {}, loading the model in this process.".format(address))
+        return None
+    try:
+        return ModelClient(address)
+    except (socket.error, EOFError, AuthenticationError) as e:
+        print("Couldn't connect to the model server at {} ({}), loading the model in this process.".format(address, e))
+        return None
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python model_server.py [-a <socket_path>] [-n <max_models>] [-p <model_id,model_id,...>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ha:n:p:", ["help", "address", "max_models", "preload"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    address, max_models, preload_model_ids = DEFAULT_SOCKET_PATH, DEFAULT_MAX_MODELS, []
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-a", "--address"):
+            address = a
+        elif o in ("-n", "--max_models"):
+            max_models = int(a)
+        elif o in ("-p", "--preload"):
+            preload_model_ids = a.split(',')
+        else:
+            assert False, "unhandled option"
+    return address, max_models, preload_model_ids
+
+
+def main():
+    address, max_models, preload_model_ids = read_commandline_args()
+    ModelServer(address, max_models=max_models).serve_forever(preload_model_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,21 +21,56 @@ from __future__ import division, print_function, absolute_import
 import os, sys, getopt
 import datetime
 import pickle
+import importlib
 
-import tensorflow as tf
-import tflearn
-from tflearn.data_utils import shuffle, to_categorical
-from sklearn.metrics import accuracy_score
 import numpy as np
 
 from constants import *
 from utils import *
 from data_utils import *
+from feature_sets import *
+from input_pipeline import fit_with_prefetch
+from data_parallel import fit_data_parallel
+from dataset_stats import get_featurewise_stats
+from dataset_view import split_views
 
 sys.path.append("../") # so we can import models.
-from models import *
+# tensorflow, tflearn, sklearn and the network modules in models/ are imported inside the functions that need them,
+# so that importing model_utils (and running e.g. pipeline.py -h) stays fast.
 #===============================================================================
 
+PREDICT_BATCH_SIZE = 128
+
+# Fraction of the training set fit_model holds out for validation (from the end, like tflearn's validation_set).
+VALIDATION_FRACTION = 0.1
+
+# tflearn's ImagePreprocessing divides by (std + epsilon) in add_featurewise_stdnorm.
+FEATUREWISE_STD_EPSILON = 1e-8
+
+# Network types with featurewise preprocessing (their build_network takes featurewise_stats).
+FEATUREWISE_NETWORK_TYPES = ('lenet_cnn', 'lenet_small_cnn', 'vggnet_cnn')
+
+# Training reads images from the memory-mapped uint8 store and normalizes them per batch (see image_store.py).
+TRAINING_STORAGE = 'uint8_mmap'
+
+# n_workers=0 trains with tflearn's own model.fit. With n_workers > 0, batches are gathered, preprocessed and
+# augmented by a pool of background workers, up to prefetch_depth batches ahead (see input_pipeline.py).
+DEFAULT_N_WORKERS = 0
+DEFAULT_PREFETCH_DEPTH = 4
+
+# n_replicas > 1 trains with that many synchronous data-parallel processes, each computing the gradients of a shard of
+# every batch (see data_parallel.py).
+DEFAULT_N_REPLICAS = 1
+
+# Size of TF's intra / inter op thread pools in every graph load_model builds a model in, 0 for TF's default (all
+# cores). scheduler.py sets it to the cores of a job.
+NUM_CORES = 0
+
+# Opt in to training with the vectorized BatchImageAugmentation instead of tflearn's per-image ImageAugmentation.
+# Its rotations are bilinear and rounded to whole degrees (see models/batch_augmentation.py).
+BATCH_AUGMENTATION = False
+
+
 def get_weights_to_preload_function(model_id, checkpoint_model_id, is_training):
     def variable_name_map_func(existing_var_op_name):
         if not is_training:  # In test, always preload ALL weights
@@ -55,19 +90,89 @@ def get_weights_to_preload_function(model_id, checkpoint_model_id, is_training):
 
 def save_features(X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, \
     X_test, y_test, fine_or_coarse_test, checkpoint_model_id, dataset):
-    feature_set_storage_dir = "../data/feature_sets"
-    check_if_path_exists_or_create("/" + feature_set_storage_dir)
-
-    feature_set_pickle_name = "{}/{}_prefeaturized".format(feature_set_storage_dir, dataset)
-
+    # Written as a feature set (one memory-mappable .npy per array + metadata), see feature_sets.py.
     dataset_contents = [X_train_joint, y_train_joint, X_train_gate, y_train_gate, fine_or_coarse_train_gate, \
     X_test, y_test, fine_or_coarse_test]
 
-    pickle.dump(dataset_contents, open(feature_set_pickle_name, "wb"))
+    save_feature_set(get_feature_set_dir(dataset), zip(PYRAMID_ARRAY_NAMES, dataset_contents), checkpoint_model_id,
+                     dataset)
+
+
+def predict_in_batches(model, X, batch_size=PREDICT_BATCH_SIZE):
+    # tflearn's predict feeds all of X at once. Feeding slices keeps lazily normalized image stores
+    # (NormalizedImages) from being materialized as one big float array.
+    predictions = []
+    for start in xrange(0, len(X), batch_size):
+        predictions.extend(model.predict(np.asarray(X[start:start + batch_size])))
+    return np.array(predictions)
+
+
+def get_featurewise_preprocessing(model):
+    """
+    tflearn applies the input layer's ImagePreprocessing in python (in DNN.predict / fit), not in the graph.
+    Returns its featurewise steps and restored statistics as plain values, for apply_featurewise_preprocessing,
+    or None if the model has no preprocessing.
+    """
+    import tensorflow as tf
+
+    with model.session.graph.as_default():
+        preprocessings = tf.get_collection(tf.GraphKeys.DATA_PREP)
+    preprocessing = preprocessings[0] if preprocessings else None
+    if preprocessing is None or not preprocessing.methods:
+        return None
+    steps = [method.__name__.lstrip('_') for method in preprocessing.methods]
+    for step in steps:
+        assert step in ('featurewise_zero_center', 'featurewise_stdnorm'), \
+            "Preprocessing step {} can't be exported".format(step)
+    return {'steps': steps,
+            'mean': np.asarray(preprocessing.global_mean.value, dtype=np.float32).tolist(),
+            'std': np.asarray(preprocessing.global_std.value, dtype=np.float32).tolist()}
+
+
+def apply_featurewise_preprocessing(X, preprocessing):
+    # Same arithmetic as tflearn's ImagePreprocessing, on a copy of X.
+    X = np.array(X, dtype=np.float32)
+    for step in preprocessing['steps']:
+        if step == 'featurewise_zero_center':
+            X -= np.asarray(preprocessing['mean'], dtype=np.float32)
+        elif step == 'featurewise_stdnorm':
+            X /= np.asarray(preprocessing['std'], dtype=np.float32) + FEATUREWISE_STD_EPSILON
+    return X
+
+
+def fit_model(model_kwargs, X, Y, n_epoch, run_id, n_workers=DEFAULT_N_WORKERS, prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+              use_processes=False, n_replicas=DEFAULT_N_REPLICAS, validation_fraction=VALIDATION_FRACTION):
+    # model_kwargs: keyword arguments of load_model. The model is built here, or in every data-parallel replica.
+    # The validation set is held out as index views over X, Y (see dataset_view.py), so tflearn doesn't copy a split.
+    (X, Y), (X_val, Y_val) = split_views([X, Y], validation_fraction)
+    if n_replicas > 1:
+        fit_data_parallel(model_kwargs, X, Y, n_epoch=n_epoch, batch_size=128, validation_set=(X_val, Y_val),
+                          shuffle=True, snapshot_step=100, n_replicas=n_replicas)
+        return
+    model = load_model(**model_kwargs)
+    if n_workers > 0:
+        print("Training with {} background {} and prefetch depth {}".format(
+            n_workers, 'processes' if use_processes else 'threads', prefetch_depth))
+        fit_with_prefetch(model, X, Y, n_epoch=n_epoch, batch_size=128, validation_set=(X_val, Y_val), shuffle=True,
+                          snapshot_step=100, n_workers=n_workers, prefetch_depth=prefetch_depth,
+                          use_processes=use_processes)
+    else:
+        model.fit(X, Y, n_epoch=n_epoch, shuffle=True, validation_set=(X_val, Y_val),
+                  show_metric=True, batch_size=128, run_id=run_id, snapshot_step=100)
 
 
-def load_model(model_id, n_classes=10, pyramid_output_dims=None, is_training=False, checkpoint_model_id=None, get_hidden_reps=False):
+def load_model(model_id, n_classes=10, pyramid_output_dims=None, is_training=False, checkpoint_model_id=None, get_hidden_reps=False,
+               featurewise_stats=None, num_cores=None):
     # should be used for all models
+    # num_cores: thread pool size of the current graph's session (default NUM_CORES), unless the graph has a config
+    import tensorflow as tf
+    import tflearn
+
+    # tflearn keeps the session config in the graph's collections, so models built in a graph of their own (e.g.
+    # LazyHiddenRepModel) need it set here rather than once on the default graph.
+    num_cores = NUM_CORES if num_cores is None else num_cores
+    if num_cores and not tf.get_collection(tf.GraphKeys.GRAPH_CONFIG):
+        tflearn.init_graph(num_cores=num_cores)
 
     assert (not (is_training and get_hidden_reps)), "If you train, you can't get hidden reps and vice versa. "
     print ('Loading model...')
@@ -87,8 +192,13 @@ def load_model(model_id, n_classes=10, pyramid_output_dims=None, is_training=Fal
     check_if_path_exists_or_create(checkpoint_path)
     check_if_path_exists_or_create(best_checkpoint_path)
 
+    if featurewise_stats is None and is_training and network_type in FEATUREWISE_NETWORK_TYPES:
+        # Shared, precomputed statistics of the training data, instead of tflearn computing them from X in fit.
+        # (Restored models get theirs from the checkpoint.)
+        featurewise_stats = get_featurewise_stats(model_dict['dataset'])
     network = load_network(network_type=network_type, n_classes=n_classes, pyramid_output_dims=pyramid_output_dims,
-                           get_hidden_reps=get_hidden_reps)
+                           get_hidden_reps=get_hidden_reps, batch_augmentation=is_training and BATCH_AUGMENTATION,
+                           featurewise_stats=featurewise_stats)
 
     if is_training:
         model = tflearn.DNN(network, tensorboard_verbose=2, tensorboard_dir=tensorboard_dir,
@@ -110,34 +220,66 @@ def load_model(model_id, n_classes=10, pyramid_output_dims=None, is_training=Fal
     return model
 
 
-def load_network(network_type='simple_cnn', n_classes=10, pyramid_output_dims=None, get_hidden_reps=False):
+def get_model_output_kwargs(model_id):
+    # n_classes / pyramid_output_dims to pass to load_model for model_id, as used by the train_* functions.
+    model_dict = ALL_MODEL_DICTS[model_id]
+    if model_dict['network_type'] == 'pyramid':
+        return {'pyramid_output_dims': [N_COARSE_CIFAR, N_FINE_CIFAR]}
+    if model_dict['network_type'] in ('cnn_rnn', 'cnn_rnn_end_to_end'):
+        return {'n_classes': N_COARSE_CIFAR + N_FINE_CIFAR + 1}  # add 1 for the end token
+    return {'n_classes': DATASET_TO_N_CLASSES.get(model_dict['dataset'], 10)}
+
+
+def import_network_module(module_name):
+    # Network builders pull in tflearn and tensorflow, so only the one a network_type needs is imported.
+    return importlib.import_module('models.' + module_name)
+
+
+def load_network(network_type='simple_cnn', n_classes=10, pyramid_output_dims=None, get_hidden_reps=False,
+                 batch_augmentation=False, featurewise_stats=None):
     network = None
 
     if network_type == 'simple_cnn':
-        network = simple_cnn.build_network([n_classes], get_hidden_reps=get_hidden_reps)
+        simple_cnn = import_network_module('simple_cnn')
+        network = simple_cnn.build_network([n_classes], get_hidden_reps=get_hidden_reps,
+                                           batch_augmentation=batch_augmentation)
     elif network_type == 'lenet_cnn':
-        network = lenet_cnn.build_network([n_classes])
+        lenet_cnn = import_network_module('lenet_cnn')
+        network = lenet_cnn.build_network([n_classes], batch_augmentation=batch_augmentation,
+                                          featurewise_stats=featurewise_stats)
     elif network_type == 'lenet_small_cnn':
-        network = lenet_small_cnn.build_network([n_classes])
+        lenet_small_cnn = import_network_module('lenet_small_cnn')
+        network = lenet_small_cnn.build_network([n_classes], batch_augmentation=batch_augmentation,
+                                                featurewise_stats=featurewise_stats)
     elif network_type == 'vggnet_cnn':
-        network = vggnet_cnn.build_network([n_classes])
+        vggnet_cnn = import_network_module('vggnet_cnn')
+        network = vggnet_cnn.build_network([n_classes], batch_augmentation=batch_augmentation,
+                                           featurewise_stats=featurewise_stats)
     elif network_type == 'simple_cnn_extended_1':
-        network = simple_cnn_extended_1.build_network([n_classes], get_hidden_reps=get_hidden_reps)
+        simple_cnn_extended_1 = import_network_module('simple_cnn_extended_1')
+        network = simple_cnn_extended_1.build_network([n_classes], get_hidden_reps=get_hidden_reps,
+                                                      batch_augmentation=batch_augmentation)
     elif network_type == 'pyramid':
         assert (pyramid_output_dims != None), "If you try to load the pyramid model, you need to provide the " \
                                               "pyramid_output_dims, which is a list [coarse_dim, fine_dim]"
-        network = joint_pyramid_cnn.build_network(pyramid_output_dims, get_hidden_reps=get_hidden_reps )
+        joint_pyramid_cnn = import_network_module('joint_pyramid_cnn')
+        network = joint_pyramid_cnn.build_network(pyramid_output_dims, get_hidden_reps=get_hidden_reps,
+                                                  batch_augmentation=batch_augmentation)
     elif network_type == "cnn_rnn":
+        cnn_rnn = import_network_module('cnn_rnn')
         network = cnn_rnn.build_network(n_classes, get_hidden_reps=get_hidden_reps)
     elif network_type == "cnn_rnn_end_to_end":
-        network = cnn_rnn_end_to_end.build_network(n_classes, get_hidden_reps=get_hidden_reps)
+        cnn_rnn_end_to_end = import_network_module('cnn_rnn_end_to_end')
+        network = cnn_rnn_end_to_end.build_network(n_classes, get_hidden_reps=get_hidden_reps,
+                                                   batch_augmentation=batch_augmentation)
     else:
         print("Model {} not found. ".format(network_type))
         sys.exit()
     return network
 
 
-def train_model(model_id='simple_cnn', dataset='cifar10', checkpoint_model_id=None):
+def train_model(model_id='simple_cnn', dataset='cifar10', checkpoint_model_id=None, n_workers=DEFAULT_N_WORKERS,
+                prefetch_depth=DEFAULT_PREFETCH_DEPTH, n_replicas=DEFAULT_N_REPLICAS):
 
     print ("Training model {} with dataset {}".format(model_id, dataset))
 
@@ -146,50 +288,57 @@ def train_model(model_id='simple_cnn', dataset='cifar10', checkpoint_model_id=No
     date_time_string = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
     run_id = "{}_{}".format(model_id, date_time_string)
     # Train using classifier
-    model = load_model(model_id=model_id, n_classes=n_classes, is_training=True, checkpoint_model_id=checkpoint_model_id)
+    model_kwargs = {'model_id': model_id, 'n_classes': n_classes, 'is_training': True,
+                    'checkpoint_model_id': checkpoint_model_id}
 
-    X, Y, X_test, Y_test = load_data(dataset)
+    X, Y, X_test, Y_test = load_data(dataset, storage=TRAINING_STORAGE)
 
-    model.fit(X, Y, n_epoch=200, shuffle=True, validation_set=0.1,
-              show_metric=True, batch_size=128, run_id=run_id, snapshot_step=100)
+    fit_model(model_kwargs, X, Y, n_epoch=200, run_id=run_id, n_workers=n_workers, prefetch_depth=prefetch_depth,
+              n_replicas=n_replicas)
 
 
-def train_pyramid_model(model_id='pyramid_cifar100', dataset='cifar100_joint',  checkpoint_model_id=None):
+def train_pyramid_model(model_id='pyramid_cifar100', dataset='cifar100_joint',  checkpoint_model_id=None,
+                        n_workers=DEFAULT_N_WORKERS, prefetch_depth=DEFAULT_PREFETCH_DEPTH, n_replicas=DEFAULT_N_REPLICAS):
     coarse_dim = 20
     fine_dim = 100
-    X_train_joint, y_train_joint = load_data_pyramid(dataset=dataset, return_subset='joint_only')
+    X_train_joint, y_train_joint = load_data_pyramid(dataset=dataset, return_subset='joint_only', storage=TRAINING_STORAGE)
 
-    X_train_joint, y_train_joint = shuffle(X_train_joint, y_train_joint)
+    X_train_joint, y_train_joint = shuffle_data(X_train_joint, y_train_joint, seed=DATASET_SHUFFLE_SEED)
     y_train_fine, y_train_coarse = y_train_joint[:, 0], y_train_joint[:, 1]
     y_train_fine, y_train_coarse = to_categorical(y_train_fine, fine_dim), to_categorical(y_train_coarse, coarse_dim)
 
     y_train_joint = np.concatenate((y_train_coarse, y_train_fine), axis=1)
 
-    model = load_model(model_id, pyramid_output_dims=[coarse_dim, fine_dim], is_training=True, checkpoint_model_id=checkpoint_model_id)
+    model_kwargs = {'model_id': model_id, 'pyramid_output_dims': [coarse_dim, fine_dim], 'is_training': True,
+                    'checkpoint_model_id': checkpoint_model_id}
 
     date_time_string = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
     run_id = "{}_{}".format(model_id, date_time_string)
 
-    model.fit(X_train_joint, y_train_joint, n_epoch=50, shuffle=True, validation_set=0.1,
-              show_metric=True, batch_size=128, run_id=run_id, snapshot_step=100)
+    fit_model(model_kwargs, X_train_joint, y_train_joint, n_epoch=50, run_id=run_id, n_workers=n_workers,
+              prefetch_depth=prefetch_depth, n_replicas=n_replicas)
 
 
-def form_y_for_cnn_rnn(y, fine_or_coarse_gate, coarse_dim, fine_dim):
-    coarse_indexes, fine_indexes = y[:, 1] + fine_dim, y[:, 0]
+def form_y_for_cnn_rnn(y, fine_or_coarse_gate, coarse_dim, fine_dim, label_hierarchy=None):
+    """
+    Two concatenated one-hot steps of total_dim = coarse_dim + fine_dim + 1: the coarse class (offset by fine_dim),
+    then the fine class, or the end token (total_dim - 1) where fine_or_coarse_gate is 1.
+    label_hierarchy: optional LabelHierarchy, the coarse classes are looked up from the fine labels instead of y[:, 1].
+    """
+    y = np.asarray(y)
+    fine_indexes = y[:, 0]
+    coarse_indexes = label_hierarchy.fine_to_coarse[fine_indexes] if label_hierarchy is not None else y[:, 1]
     total_dim = coarse_dim + fine_dim + 1
+    fine_indexes = np.where(np.asarray(fine_or_coarse_gate) == 1, total_dim - 1, fine_indexes)
 
-    locations_of_end_token = fine_or_coarse_gate * -2 + 1  # 1 for not end token, -1 for end token
-    fine_indexes = fine_indexes * locations_of_end_token  # any end token now has negative index
-    fine_indexes[fine_indexes < 0] = total_dim - 1  # swap negative for end token
-
-    coarse_one_hots = to_categorical(coarse_indexes, total_dim)
-    fine_one_hots = to_categorical(fine_indexes, total_dim)
-
-    y_joint = np.concatenate((coarse_one_hots, fine_one_hots), axis=1)
-
+    rows = np.arange(len(y))
+    y_joint = np.zeros((len(y), 2 * total_dim))
+    y_joint[rows, fine_dim + coarse_indexes] = 1.
+    y_joint[rows, total_dim + fine_indexes] = 1.
     return y_joint
 
-def train_cnn_rnn_model(model_id='cnn_rnn_cifar100', dataset='cifar100_joint_prefeaturized',  checkpoint_model_id=None):
+def train_cnn_rnn_model(model_id='cnn_rnn_cifar100', dataset='cifar100_joint_prefeaturized',  checkpoint_model_id=None,
+                        n_workers=DEFAULT_N_WORKERS, prefetch_depth=DEFAULT_PREFETCH_DEPTH, n_replicas=DEFAULT_N_REPLICAS):
     coarse_dim = 20
     fine_dim = 100
     n_classes = coarse_dim + fine_dim + 1 # add 1 for the end token
@@ -197,10 +346,14 @@ def train_cnn_rnn_model(model_id='cnn_rnn_cifar100', dataset='cifar100_joint_pre
     X_train_gate, y_train_gate, fine_or_coarse_train_gate = load_data_pyramid(dataset=dataset, return_subset="gate_only")
     X_test, y_test, fine_or_coarse_test = load_data_pyramid(dataset=dataset, return_subset="test_only")
 
-    y_train_gate = form_y_for_cnn_rnn(y_train_gate, fine_or_coarse_train_gate, coarse_dim=coarse_dim, fine_dim=fine_dim)
-    y_test = form_y_for_cnn_rnn(y_test, fine_or_coarse_test, coarse_dim=coarse_dim, fine_dim=fine_dim)
+    label_hierarchy = load_cifar100_label_hierarchy()
+    y_train_gate = form_y_for_cnn_rnn(y_train_gate, fine_or_coarse_train_gate, coarse_dim=coarse_dim, fine_dim=fine_dim,
+                                      label_hierarchy=label_hierarchy)
+    y_test = form_y_for_cnn_rnn(y_test, fine_or_coarse_test, coarse_dim=coarse_dim, fine_dim=fine_dim,
+                                label_hierarchy=label_hierarchy)
 
-    model = load_model(model_id, n_classes=n_classes, is_training=True, checkpoint_model_id=checkpoint_model_id)
+    model_kwargs = {'model_id': model_id, 'n_classes': n_classes, 'is_training': True,
+                    'checkpoint_model_id': checkpoint_model_id}
 
     date_time_string = datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S")
     run_id = "{}_{}".format(model_id, date_time_string)
@@ -216,14 +369,16 @@ def train_cnn_rnn_model(model_id='cnn_rnn_cifar100', dataset='cifar100_joint_pre
     #np.tile(b, 2)
 
     print("\n\n\nFitting these now...")
-    model.fit(X_train_gate, y_train_gate, n_epoch=200, shuffle=True, validation_set=0.1,
-              show_metric=True, batch_size=128, run_id=run_id, snapshot_step=100)
+    fit_model(model_kwargs, X_train_gate, y_train_gate, n_epoch=200, run_id=run_id, n_workers=n_workers,
+              prefetch_depth=prefetch_depth, n_replicas=n_replicas)
 
 
 def test_model(model_id='simple_cnn', dataset='cifar10'):
+    from sklearn.metrics import accuracy_score
+
     print("Testing model {} with dataset {}".format(model_id, dataset))
 
-    X, Y, X_test, Y_test = load_data(dataset)
+    X, Y, X_test, Y_test = load_data(dataset, storage=TRAINING_STORAGE)
     n_classes = DATASET_TO_N_CLASSES[dataset]
 
     # Test using classifier
@@ -231,10 +386,8 @@ def test_model(model_id='simple_cnn', dataset='cifar10'):
     # pred_train_probs = model.predict(X)
     # pred_train = np.argmax(pred_train_probs, axis=1)
     # train_acc = accuracy_score(pred_train, np.argmax(Y, axis=1))
-    pred_test_probs = model.predict(X_test)
+    pred_test_probs = predict_in_batches(model, X_test)
     pred_test = np.argmax(pred_test_probs, axis=1)
     test_acc = accuracy_score(pred_test, np.argmax(Y_test, axis=1))
     print("Test acc: {}".format( test_acc))
-    import matplotlib.pyplot as plt
-
-    plt.imshow(image_to_show)
\ No newline at end of file
+    return test_acc
\ No newline at end of file
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+# numpy_inference.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Dependency-light forward pass for the deployed conv / fc networks in models/
+# (simple_cnn, simple_cnn_extended_1, lenet_cnn, lenet_small_cnn, vggnet_cnn
+# and the pyramid), in numpy only: no tensorflow or tflearn import at load or
+# predict time.
+#
+# Weights are exported once from a checkpoint (with tensorflow) to a .npz file
+# that also holds the layer list and the featurewise preprocessing statistics.
+# conv_2d is a batched im2col followed by one BLAS matmul, max_pool_2d a
+# reshape + max, fully_connected a matmul, all with tflearn's defaults
+# (stride 1 'same' convs, stride = kernel 'same' pools, NHWC flattening).
+# Dropout is the identity at inference and left out.
+#
+# predict_with_workers forks worker processes that share the weights (and the
+# input array) copy-on-write. With many workers, set OMP_NUM_THREADS (or the
+# BLAS library's equivalent) to 1 before starting python, so the workers don't
+# oversubscribe the cores.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# Export weights and check the outputs against tflearn.DNN.predict:
+# python numpy_inference.py -m <model_id> [-c <ckpt_model_id>] [-t <tolerance>] [-w <n_workers>]
+#
+# from numpy_inference import NumpyNetwork, get_numpy_model_file
+# network = NumpyNetwork.load(get_numpy_model_file('pyramid_cifar100'))
+# probs = network.predict(X_test)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from constants import *
+from utils import *
+from model_utils import apply_featurewise_preprocessing, PREDICT_BATCH_SIZE
+
+
+NUMPY_MODELS_DIR = '../numpy_models/'
+PARITY_TOLERANCE = 1e-4
+
+
+def _conv(name):
+    return ('conv', name, 'relu')
+
+
+def _fc(name, activation='relu'):
+    return ('fc', name, activation)
+
+
+_POOL = ('pool', 2)
+
+
+def get_network_layers(network_type, n_classes=10, pyramid_output_dims=None):
+    """
+    Layer list of build_network in models/<network_type>.py, with tflearn's layer (variable scope) names.
+    Returns (trunk, heads): the output of the network is the concatenation of the outputs of the heads, which all
+    run on the output of the trunk (one head, except for the pyramid: coarse and fine, like its stacked output).
+    """
+    heads = [[_fc('unique_FullyConnected_output_dim_{}'.format(n_classes), 'softmax')]]
+    if network_type == 'simple_cnn':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _conv('Conv2D_2'), _POOL, _fc('FullyConnected')]
+    elif network_type == 'simple_cnn_extended_1':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _conv('Conv2D_2'), _POOL,
+                 _conv('unique_Conv2D_3'), _conv('unique_Conv2D_4'), _POOL,
+                 _fc('unique_FullyConnected'), _fc('unique_FullyConnected_1')]
+    elif network_type == 'lenet_cnn':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _POOL, _conv('Conv2D_2'), _POOL, _conv('Conv2D_3'), _POOL,
+                 _conv('Conv2D_4'), _POOL,
+                 _fc('FullyConnected'), _fc('FullyConnected_1'), _fc('FullyConnected_2'), _fc('FullyConnected_3')]
+    elif network_type == 'lenet_small_cnn':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _POOL, _conv('Conv2D_2'), _POOL,
+                 _fc('FullyConnected'), _fc('FullyConnected_1'), _fc('FullyConnected_2'), _fc('FullyConnected_3')]
+    elif network_type == 'vggnet_cnn':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _POOL, _conv('Conv2D_2'), _conv('Conv2D_3'), _POOL,
+                 _fc('FullyConnected'), _fc('FullyConnected_1'), _fc('FullyConnected_2')]
+    elif network_type == 'pyramid':
+        trunk = [_conv('Conv2D'), _POOL, _conv('Conv2D_1'), _conv('Conv2D_2'), _POOL]
+        heads = [[_conv('unique_conv_1_' + branch), _conv('unique_conv_2_' + branch), _POOL,
+                  _fc('unique_fc_1_' + branch), _fc('unique_fc_2_' + branch, 'softmax')] for branch in ('coarse', 'fine')]
+    else:
+        raise Exception("No layer list for network_type {}".format(network_type))
+    return trunk, heads
+
+
+def get_weighted_layer_names(trunk, heads):
+    return [layer[1] for layer in trunk + sum(heads, []) if layer[0] != 'pool']
+
+
+def im2col(X, kernel_size):
+    """
+    X: (n, H, W, C). Returns the (n * H * W, kernel_size * kernel_size * C) patches of a stride 1 'same' convolution
+    (tflearn's conv_2d default), in the row order of the conv weights (kernel_size, kernel_size, C, n_filters)
+    reshaped to 2D. Zero padding, so int8 inputs can be unfolded before the matmul as well.
+    """
+    n, H, W, C = X.shape
+    pad_before = (kernel_size - 1) // 2
+    pad_after = kernel_size - 1 - pad_before
+    X_padded = np.pad(X, ((0, 0), (pad_before, pad_after), (pad_before, pad_after), (0, 0)), mode='constant')
+    s = X_padded.strides
+    patches = np.lib.stride_tricks.as_strided(X_padded, shape=(n, H, W, kernel_size, kernel_size, C),
+                                              strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+    return patches.reshape(n * H * W, kernel_size * kernel_size * C)
+
+
+def max_pool_2d(X, kernel_size):
+    # tflearn's max_pool_2d default: strides = kernel_size, 'same' padding.
+    n, H, W, C = X.shape
+    H_out, W_out = -(-H // kernel_size), -(-W // kernel_size)
+    if H_out * kernel_size != H or W_out * kernel_size != W:
+        X = np.pad(X, ((0, 0), (0, H_out * kernel_size - H), (0, W_out * kernel_size - W), (0, 0)),
+                   mode='constant', constant_values=-np.inf)
+    return X.reshape(n, H_out, kernel_size, W_out, kernel_size, C).max(axis=(2, 4))
+
+
+def relu(X):
+    return np.maximum(X, 0, out=X)
+
+
+def softmax(X):
+    exp = np.exp(X - X.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def activate(X, activation):
+    return relu(X) if activation == 'relu' else softmax(X)
+
+
+def count_flops(layers, weight_shapes, input_shape):
+    """
+    Multiply-adds (counted as 2 flops) of one sample through layers.
+    weight_shapes: layer name -> shape of its W, input_shape: (H, W, C) or (n_in,) of one sample.
+    Returns the flops and the output shape of one sample.
+    """
+    flops, shape = 0, tuple(input_shape)
+    for layer in layers:
+        if layer[0] == 'pool':
+            H, W, C = shape
+            shape = (-(-H // layer[1]), -(-W // layer[1]), C)
+            continue
+        W_shape = weight_shapes[layer[1]]
+        if layer[0] == 'conv':
+            H, W, _ = shape
+            flops += 2 * H * W * int(np.prod(W_shape))
+            shape = (H, W, W_shape[-1])
+        else:
+            flops += 2 * int(np.prod(W_shape))
+            shape = (W_shape[-1],)
+    return flops, shape
+
+
+def get_network_weights(model, layer_names):
+    # Restored weights of the given conv / fc layers of a loaded tflearn model, as name -> (W, b).
+    graph = model.session.graph
+    tensors = dict((name, (graph.get_tensor_by_name(name + '/W:0'), graph.get_tensor_by_name(name + '/b:0')))
+                   for name in layer_names)
+    return model.session.run(tensors)
+
+
+class NumpyNetwork(object):
+    def __init__(self, trunk, heads, weights, preprocessing=None, batch_size=PREDICT_BATCH_SIZE):
+        """
+        trunk, heads: layer lists, see get_network_layers
+        weights: layer name -> (W, b), W of shape (k, k, C_in, C_out) for convs and (n_in, n_out) for fc layers
+        preprocessing: featurewise preprocessing of the tflearn model (see model_utils.get_featurewise_preprocessing)
+        """
+        self.trunk, self.heads = trunk, heads
+        self.weights = weights
+        self.preprocessing = preprocessing
+        self.batch_size = batch_size
+
+    def _prepare_input(self, X):
+        if self.preprocessing is not None:
+            return apply_featurewise_preprocessing(X, self.preprocessing)
+        return np.asarray(X, dtype=np.float32)
+
+    def _forward(self, X, weighted_layer_fn):
+        def run_layers(layers, X):
+            for layer in layers:
+                X = max_pool_2d(X, layer[1]) if layer[0] == 'pool' else weighted_layer_fn(layer, X)
+            return X
+
+        X = run_layers(self.trunk, X)
+        if len(self.heads) == 1:
+            return run_layers(self.heads[0], X)
+        return np.concatenate([run_layers(head, X) for head in self.heads], axis=1)
+
+    def _layer(self, layer, X):
+        kind, name, activation = layer
+        W, b = self.weights[name]
+        if kind == 'conv':
+            n, H, W_in, _ = X.shape
+            out = im2col(X, W.shape[0]).dot(W.reshape(-1, W.shape[-1]))
+            out += b
+            return activate(out.reshape(n, H, W_in, -1), activation)
+        out = X.reshape(len(X), -1).dot(W)
+        out += b
+        return activate(out, activation)
+
+    def predict(self, X):
+        # Same outputs as tflearn.DNN.predict of the model, as one float32 array.
+        outputs = [self._forward(self._prepare_input(X[start:start + self.batch_size]), self._layer)
+                   for start in xrange(0, len(X), self.batch_size)]
+        return np.concatenate(outputs) if outputs else np.zeros((0, 0), dtype=np.float32)
+
+    def save(self, file_path):
+        check_if_path_exists_or_create(file_path)
+        arrays = {}
+        for name, (W, b) in self.weights.items():
+            arrays[name + '/W'], arrays[name + '/b'] = W, b
+        spec = {'trunk': self.trunk, 'heads': self.heads, 'preprocessing': self.preprocessing}
+        np.savez(file_path, __spec__=np.array(json.dumps(spec)), **arrays)
+
+    @classmethod
+    def load(cls, file_path, batch_size=PREDICT_BATCH_SIZE):
+        trunk, heads, preprocessing, arrays = load_network_file(file_path)
+        weights = dict((name, (arrays[name + '/W'], arrays[name + '/b'])) for name in get_weighted_layer_names(trunk, heads))
+        return cls(trunk, heads, weights, preprocessing, batch_size=batch_size)
+
+
+def load_network_file(file_path):
+    # Returns the trunk, heads and preprocessing saved with a network, and a dict of all its arrays.
+    with np.load(file_path) as npz:
+        arrays = dict((key, npz[key]) for key in npz.files)
+    spec = json.loads(str(arrays.pop('__spec__')))
+    to_layers = lambda layers: [tuple(layer) for layer in layers]
+    return to_layers(spec['trunk']), [to_layers(head) for head in spec['heads']], spec['preprocessing'], arrays
+
+
+def get_numpy_model_file(model_id):
+    return os.path.join(NUMPY_MODELS_DIR, model_id + '.npz')
+
+
+def numpy_network_from_model(model_id, model):
+    """
+    NumpyNetwork with the weights and featurewise preprocessing of model, a tflearn.DNN built for model_id
+    (see model_utils.load_model).
+    """
+    from model_utils import get_model_output_kwargs, get_featurewise_preprocessing
+
+    trunk, heads = get_network_layers(ALL_MODEL_DICTS[model_id]['network_type'], **get_model_output_kwargs(model_id))
+    weights = get_network_weights(model, get_weighted_layer_names(trunk, heads))
+    return NumpyNetwork(trunk, heads, weights, preprocessing=get_featurewise_preprocessing(model))
+
+
+def export_numpy_network(model_id, checkpoint_model_id=None, output_file=None):
+    """
+    Restores the latest checkpoint of checkpoint_model_id (default: model_id) into model_id's network and writes its
+    weights to output_file (default: get_numpy_model_file(model_id)). Returns the NumpyNetwork and the tflearn model.
+    """
+    import tensorflow as tf
+    from model_utils import load_model, get_model_output_kwargs
+
+    with tf.Graph().as_default():
+        model = load_model(model_id, checkpoint_model_id=checkpoint_model_id or model_id, is_training=False,
+                           **get_model_output_kwargs(model_id))
+        network = numpy_network_from_model(model_id, model)
+    network.save(output_file or get_numpy_model_file(model_id))
+    return network, model
+
+
+def check_parity(model_id, checkpoint_model_id=None, n_samples=512, tolerance=PARITY_TOLERANCE, seed=0):
+    """
+    Exports model_id's weights and compares NumpyNetwork.predict with tflearn.DNN.predict on random inputs.
+    Raises an Exception if the outputs differ by more than tolerance. Returns the max abs difference and the
+    predict time of both.
+    """
+    from model_utils import predict_in_batches
+
+    network, model = export_numpy_network(model_id, checkpoint_model_id)
+    X = np.random.RandomState(seed).randn(n_samples, 32, 32, 3).astype(np.float32)
+    start = time.time()
+    dnn_outputs = predict_in_batches(model, X)
+    dnn_seconds = time.time() - start
+    model.session.close()
+    start = time.time()
+    numpy_outputs = network.predict(X)
+    numpy_seconds = time.time() - start
+
+    max_abs_diff = float(np.max(np.abs(numpy_outputs - dnn_outputs)))
+    print("{}: max abs diff to tflearn.DNN.predict {:.2e} | predict {} samples: numpy {:.3f}s, DNN {:.3f}s".format(
+        model_id, max_abs_diff, n_samples, numpy_seconds, dnn_seconds))
+    if max_abs_diff > tolerance:
+        raise Exception("numpy outputs of {} differ from tflearn's by {} > {}".format(model_id, max_abs_diff,
+                                                                                    tolerance))
+    return {'max_abs_diff': max_abs_diff, 'numpy_seconds': numpy_seconds, 'dnn_seconds': dnn_seconds}
+
+
+# Set by predict_with_workers before forking, so the workers inherit the network and inputs without pickling them.
+_worker_state = {}
+
+
+def _predict_slice(bounds):
+    start, end = bounds
+    return _worker_state['network'].predict(_worker_state['X'][start:end])
+
+
+def predict_with_workers(network, X, n_workers=4, chunk_size=1024):
+    """
+    Like network.predict(X), split into chunks of chunk_size samples over n_workers forked processes.
+    """
+    if n_workers <= 1:
+        return network.predict(X)
+    _worker_state['network'], _worker_state['X'] = network, X
+    pool = Pool(n_workers)
+    try:
+        outputs = pool.map(_predict_slice, [(start, min(start + chunk_size, len(X)))
+                                            for start in xrange(0, len(X), chunk_size)])
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state.clear()
+    return np.concatenate(outputs)
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python numpy_inference.py -m <model_id> [-c <ckpt_model_id>] [-t <tolerance>] [-w <n_workers>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:c:t:w:", ["help", "model_id", "ckpt_model_id", "tolerance",
+                                                              "n_workers"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    model_id, checkpoint_model_id, tolerance, n_workers = None, None, PARITY_TOLERANCE, 0
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-m", "--model_id"):
+            model_id = a
+        elif o in ("-c", "--ckpt_model_id"):
+            checkpoint_model_id = a
+        elif o in ("-t", "--tolerance"):
+            tolerance = float(a)
+        elif o in ("-w", "--n_workers"):
+            n_workers = int(a)
+        else:
+            assert False, "unhandled option"
+
+    assert model_id is not None, "Please specify a model_id with -m"
+    return model_id, checkpoint_model_id, tolerance, n_workers
+
+
+def main():
+    model_id, checkpoint_model_id, tolerance, n_workers = read_commandline_args()
+    check_parity(model_id, checkpoint_model_id, tolerance=tolerance)
+    if n_workers > 1:
+        network = NumpyNetwork.load(get_numpy_model_file(model_id))
+        X = np.random.RandomState(0).randn(10000, 32, 32, 3).astype(np.float32)
+        start = time.time()
+        predict_with_workers(network, X, n_workers=n_workers)
+        print("{} workers: {:.1f} images/s".format(n_workers, len(X) / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main()
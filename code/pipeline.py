@@ -18,6 +18,9 @@
 #
 # Commandline:
 # python pipeline.py -t <train_or_test_mode> -m <model_id> -d <dataset>
+# optionally -w <n_prefetch_workers> -p <prefetch_depth> to train with the background input pipeline
+# and -r <n_replicas> to train with synchronous data-parallel processes (see data_parallel.py)
+# -t test -s tests with the running model server (see model_server.py), so the model isn't loaded again
 # or to get help:python pipeline.py -h
 #
 #===============================================================================
@@ -36,16 +39,21 @@ sys.path.append("../") # so we can import models.
 
 def read_commandline_args():
     def usage():
-        print("Usage: python pipeline.py -t <train_or_test_mode> -m <model_id> -c <ckpt_model_id>")
+        print("Usage: python pipeline.py -t <train_or_test_mode> -m <model_id> -c <ckpt_model_id> "
+              "-w <n_prefetch_workers> -p <prefetch_depth> -r <n_data_parallel_replicas> [-s]")
+        print("-s: in test mode, use the running model server (see model_server.py) if there is one")
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"ht:m:d:c:", ["help", "train_or_test_mode", "model_id", "ckpt_model_id"])
+        opts, args = getopt.getopt(sys.argv[1:],"ht:m:d:c:w:p:r:s", ["help", "train_or_test_mode", "model_id",
+                                                                     "ckpt_model_id", "n_workers", "prefetch_depth",
+                                                                     "n_replicas", "model_server"])
     except getopt.GetoptError as err:
         # print help information and exit:
         print (str(err))  # will print something like "option -a not recognized"
         usage()
         sys.exit(2)
 
-    mode, model_id, checkpoint_model_id = None, None, None
+    mode, model_id, checkpoint_model_id, use_model_server = None, None, None, False
+    n_workers, prefetch_depth, n_replicas = DEFAULT_N_WORKERS, DEFAULT_PREFETCH_DEPTH, DEFAULT_N_REPLICAS
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -56,6 +64,14 @@ def read_commandline_args():
             model_id = a
         elif o in ("-c", "--ckpt_model_id"):
             checkpoint_model_id = a
+        elif o in ("-w", "--n_workers"):
+            n_workers = int(a)
+        elif o in ("-p", "--prefetch_depth"):
+            prefetch_depth = int(a)
+        elif o in ("-r", "--n_replicas"):
+            n_replicas = int(a)
+        elif o in ("-s", "--model_server"):
+            use_model_server = True
         else:
             assert False, "unhandled option"
 
@@ -66,23 +82,51 @@ def read_commandline_args():
     if model_id == None:
         model_id = 'simple_cnn'
 
-    return mode, model_id, checkpoint_model_id
+    return mode, model_id, checkpoint_model_id, n_workers, prefetch_depth, n_replicas, use_model_server
+
+
+def train(model_id, checkpoint_model_id=None, n_workers=DEFAULT_N_WORKERS, prefetch_depth=DEFAULT_PREFETCH_DEPTH,
+          n_replicas=DEFAULT_N_REPLICAS):
+    dataset = ALL_MODEL_DICTS[model_id]["dataset"]
+    if model_id == 'pyramid_cifar100':
+        train_pyramid_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id,
+                            n_workers=n_workers, prefetch_depth=prefetch_depth, n_replicas=n_replicas)
+    elif model_id == 'cnn_rnn_cifar100' or model_id == 'cnn_rnn_end_to_end_cifar100':
+        train_cnn_rnn_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id,
+                            n_workers=n_workers, prefetch_depth=prefetch_depth, n_replicas=n_replicas)
+    else:
+        train_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id,
+                    n_workers=n_workers, prefetch_depth=prefetch_depth, n_replicas=n_replicas)
+
+
+def test(model_id, model_client=None):
+    # Returns the test accuracy (the hierarchical accuracy of the confidence gate for the pyramid).
+    # model_client: optional model_server.ModelClient, to test with the server's already loaded model.
+    dataset = ALL_MODEL_DICTS[model_id]["dataset"]
+    if ALL_MODEL_DICTS[model_id]["network_type"] == 'pyramid':
+        from pyramid_wrapper import test_pyramid_model
+        return test_pyramid_model(model_id, model_client=model_client)
+    if model_client is not None:
+        test_acc = model_client.evaluate(model_id)['accuracy']
+        print("Test acc: {}".format(test_acc))
+        return test_acc
+    return test_model(model_id, dataset)
 
 
 def main():
-    mode, model_id, checkpoint_model_id = read_commandline_args()
+    mode, model_id, checkpoint_model_id, n_workers, prefetch_depth, n_replicas, use_model_server = \
+        read_commandline_args()
 
-    dataset = ALL_MODEL_DICTS[model_id]["dataset"]
     if mode == 'train':
-        if model_id == 'pyramid_cifar100':
-            train_pyramid_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id)
-        elif model_id == 'cnn_rnn_cifar100' or model_id == 'cnn_rnn_end_to_end_cifar100':
-            train_cnn_rnn_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id)
-        else:
-            train_model(model_id, dataset, checkpoint_model_id=checkpoint_model_id)
+        train(model_id, checkpoint_model_id=checkpoint_model_id, n_workers=n_workers, prefetch_depth=prefetch_depth,
+              n_replicas=n_replicas)
     elif mode == 'test':
-        test_model(model_id, dataset)
+        model_client = None
+        if use_model_server:
+            from model_server import connect_to_model_server
+            model_client = connect_to_model_server()
+        test(model_id, model_client=model_client)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
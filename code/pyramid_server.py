@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# pyramid_server.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Dynamic micro-batching front end for online use of the pyramid model.
+# Single-image requests are queued and coalesced into batches of at most
+# max_batch_size images, waiting at most max_wait_ms for a batch to fill up.
+# Each batch runs one fused forward pass (PyramidWrapper.predict_both_fine_and_coarse,
+# both heads in one session.run), the confidence gate is applied to the whole
+# batch, and every request gets its own hierarchical prediction back.
+#
+# The server keeps latency (p50 / p99) and throughput counters, and can be
+# exercised locally with a synthetic load generator. With -f a synthetic
+# numpy model replaces the checkpoint, so the batching itself can be tested
+# without tensorflow.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# from pyramid_server import PyramidServer
+# server = PyramidServer(PyramidWrapper(checkpoint_model_id="pyramid_cifar100"))
+# server.start()
+# prediction = server.predict(image)   # blocks until the image's batch has run
+#
+# Commandline (synthetic load):
+# python pyramid_server.py [-c <ckpt_model_id> | -f] [-n <n_requests>] [-k <n_clients>] [-b <max_batch_size>] [-w <max_wait_ms>]
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import time
+import threading
+import Queue
+from collections import deque
+
+import numpy as np
+
+from constants import *
+from pyramid_wrapper import gate_fine_or_coarse, compute_confidence_scores
+
+
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 5.
+DEFAULT_CONFID_THRESHOLD = 74
+LATENCY_WINDOW = 10000
+
+
+class PendingPrediction(object):
+    def __init__(self, image):
+        self.image = image
+        self.enqueue_time = time.time()
+        self.done = threading.Event()
+        self.result, self.error = None, None
+
+    def set_result(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.done.set()
+
+    def get(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise Exception("Prediction timed out after {}s".format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class MicroBatcher(object):
+    def __init__(self, predict_batch_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        """
+        Args:
+            predict_batch_fn: function mapping an image batch (n, H, W, C) to a list of n per-image results
+        """
+        self.predict_batch_fn = predict_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.requests = Queue.Queue()
+        self.thread = None
+        self.running = False
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.latencies = deque(maxlen=LATENCY_WINDOW)
+            self.n_requests, self.n_batches, self.n_errors = 0, 0, 0
+            self.start_time = time.time()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, image):
+        pending = PendingPrediction(image)
+        self.requests.put(pending)
+        return pending
+
+    def _next_batch(self):
+        # Blocks for the first request, then fills the batch until it is full or max_wait has passed.
+        first = self.requests.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                pending = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if pending is None:
+                self.running = False
+                break
+            batch.append(pending)
+        return batch
+
+    def _run(self):
+        while self.running:
+            batch = self._next_batch()
+            if not batch:
+                break
+            try:
+                results = self.predict_batch_fn(np.stack([pending.image for pending in batch]))
+                for pending, result in zip(batch, results):
+                    pending.set_result(result)
+            except Exception as e:
+                for pending in batch:
+                    pending.set_result(error=e)
+            done_time = time.time()
+            with self.stats_lock:
+                self.latencies.extend(done_time - pending.enqueue_time for pending in batch)
+                self.n_requests += len(batch)
+                self.n_batches += 1
+                self.n_errors += sum(pending.error is not None for pending in batch)
+
+    def stats(self):
+        with self.stats_lock:
+            latencies_ms = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+            elapsed = time.time() - self.start_time
+            return {'n_requests': self.n_requests, 'n_batches': self.n_batches, 'n_errors': self.n_errors,
+                    'mean_batch_size': self.n_requests / max(self.n_batches, 1),
+                    'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+                    'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+                    'requests_per_second': self.n_requests / elapsed if elapsed > 0 else 0.}
+
+
+class PyramidServer(MicroBatcher):
+    def __init__(self, pyramid_model, confid_threshold=DEFAULT_CONFID_THRESHOLD,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        """
+        pyramid_model: a PyramidWrapper (or anything with predict_both_fine_and_coarse(X))
+        """
+        MicroBatcher.__init__(self, self.predict_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.pyramid_model = pyramid_model
+        self.confid_threshold = confid_threshold
+
+    def predict_batch(self, X):
+        """
+        Returns one dict per image:
+            prediction: class in PyramidWrapper.predict_fine_or_coarse's format (fine classes offset by N_COARSE_CIFAR)
+            is_fine: whether the gate chose the fine prediction
+            fine_class, coarse_class, fine_confidence: the raw outputs the gate decided on
+        """
+        fine_pred_probs, coarse_pred_probs = self.pyramid_model.predict_both_fine_and_coarse(X)
+        final_pred_classes = gate_fine_or_coarse(fine_pred_probs, coarse_pred_probs,
+                                                 confid_threshold=self.confid_threshold)
+        fine_confidence_scores = compute_confidence_scores(fine_pred_probs)
+        fine_pred_classes = np.argmax(fine_pred_probs, axis=1)
+        coarse_pred_classes = np.argmax(coarse_pred_probs, axis=1)
+        return [{'prediction': int(final_pred_classes[i]), 'is_fine': bool(final_pred_classes[i] >= N_COARSE_CIFAR),
+                 'fine_class': int(fine_pred_classes[i]), 'coarse_class': int(coarse_pred_classes[i]),
+                 'fine_confidence': float(fine_confidence_scores[i])} for i in xrange(len(X))]
+
+    def predict(self, image, timeout=None):
+        return self.submit(image).get(timeout)
+
+
+class SyntheticPyramidModel(object):
+    # Random linear fine / coarse heads over the flattened image, for testing the server without a checkpoint.
+    def __init__(self, image_shape=(32, 32, 3), per_call_overhead_ms=2., seed=0):
+        rng = np.random.RandomState(seed)
+        n_features = int(np.prod(image_shape))
+        self.fine_weights = rng.randn(n_features, N_FINE_CIFAR).astype(np.float32) / np.sqrt(n_features)
+        self.coarse_weights = rng.randn(n_features, N_COARSE_CIFAR).astype(np.float32) / np.sqrt(n_features)
+        self.per_call_overhead = per_call_overhead_ms / 1000.
+
+    def predict_both_fine_and_coarse(self, X):
+        time.sleep(self.per_call_overhead)
+        features = np.asarray(X, dtype=np.float32).reshape(len(X), -1)
+        return _softmax(features.dot(self.fine_weights) * 4), _softmax(features.dot(self.coarse_weights) * 4)
+
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def run_synthetic_load(server, n_requests=2000, n_clients=32, image_shape=(32, 32, 3), seed=0):
+    """
+    n_clients threads each send single-image requests back to back (closed loop) until n_requests are done.
+    Returns the server's stats for the run.
+    """
+    images = np.random.RandomState(seed).randn(256, *image_shape).astype(np.float32)
+    counter = iter(xrange(n_requests))
+    counter_lock = threading.Lock()
+
+    def client():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            server.predict(images[i % len(images)], timeout=60)
+
+    server.reset_stats()
+    threads = [threading.Thread(target=client) for _ in xrange(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return server.stats()
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python pyramid_server.py [-c <ckpt_model_id> | -f] [-n <n_requests>] [-k <n_clients>] "
+              "[-b <max_batch_size>] [-w <max_wait_ms>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:fn:k:b:w:", ["help", "ckpt_model_id", "fake_model", "n_requests",
+                                                                 "n_clients", "max_batch_size", "max_wait_ms"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    config = {'checkpoint_model_id': 'pyramid_cifar100', 'fake_model': False, 'n_requests': 2000, 'n_clients': 32,
+              'max_batch_size': DEFAULT_MAX_BATCH_SIZE, 'max_wait_ms': DEFAULT_MAX_WAIT_MS}
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--ckpt_model_id"):
+            config['checkpoint_model_id'] = a
+        elif o in ("-f", "--fake_model"):
+            config['fake_model'] = True
+        elif o in ("-n", "--n_requests"):
+            config['n_requests'] = int(a)
+        elif o in ("-k", "--n_clients"):
+            config['n_clients'] = int(a)
+        elif o in ("-b", "--max_batch_size"):
+            config['max_batch_size'] = int(a)
+        elif o in ("-w", "--max_wait_ms"):
+            config['max_wait_ms'] = float(a)
+        else:
+            assert False, "unhandled option"
+    return config
+
+
+def main():
+    config = read_commandline_args()
+    if config['fake_model']:
+        pyramid_model = SyntheticPyramidModel()
+    else:
+        from pyramid_wrapper import PyramidWrapper
+        pyramid_model = PyramidWrapper(checkpoint_model_id=config['checkpoint_model_id'])
+
+    server = PyramidServer(pyramid_model, max_batch_size=config['max_batch_size'],
+                           max_wait_ms=config['max_wait_ms'])
+    server.start()
+    stats = run_synthetic_load(server, n_requests=config['n_requests'], n_clients=config['n_clients'])
+    server.stop()
+
+    print("{} requests from {} clients: {:.1f} requests/s, mean batch size {:.1f}, p50 {:.2f}ms, p99 {:.2f}ms, "
+          "{} errors".format(stats['n_requests'], config['n_clients'], stats['requests_per_second'],
+                             stats['mean_batch_size'], stats['latency_p50_ms'], stats['latency_p99_ms'],
+                             stats['n_errors']))
+
+
+if __name__ == '__main__':
+    main()
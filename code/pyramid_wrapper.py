@@ -2,13 +2,8 @@ from __future__ import division, print_function, absolute_import
 
 import os, sys, getopt
 import datetime
+import time
 
-from tabulate import tabulate
-
-import tensorflow as tf
-import tflearn
-from tflearn.data_utils import shuffle, to_categorical
-from sklearn.metrics import accuracy_score
 import numpy as np
 
 from utils import *
@@ -17,36 +12,68 @@ from data_utils import *
 from constants import *
 
 sys.path.append("../") # so we can import models.
-from models import *
+# tensorflow / tflearn, sklearn, tabulate and matplotlib are imported where they are used, so importing this module
+# (e.g. for the vectorized evaluation helpers) doesn't pay for them.
 
 class PyramidWrapper(object):
-    def __init__(self, checkpoint_model_id):
-        coarse_net, fine_net = joint_pyramid_cnn.build_network(output_dims=[N_COARSE_CIFAR, N_FINE_CIFAR],
-                                                               get_fc_softmax_activations=True)
+    def __init__(self, checkpoint_model_id, batch_size=PREDICT_BATCH_SIZE):
+        import tflearn
+        joint_pyramid_cnn = import_network_module('joint_pyramid_cnn')
+
+        self.coarse_net, self.fine_net, self.trunk = joint_pyramid_cnn.build_network(
+            output_dims=[N_COARSE_CIFAR, N_FINE_CIFAR], get_fc_softmax_activations=True, get_trunk=True)
         self.checkpoint_model_id = checkpoint_model_id
-        self.coarse_model = tflearn.DNN(coarse_net)
-        self.fine_model = tflearn.DNN(fine_net)
+        self.batch_size = batch_size
+        # Both heads live in the same graph, so a single DNN (one session, one saver) covers the shared trunk and
+        # both branches.
+        self.model = tflearn.DNN(self.coarse_net)
+        self.session = self.model.session
+        self.input_placeholder = self.model.inputs[0]
+        self.label_hierarchy = None
         print ("models loaded")
         self.load_checkpoint()
 
     def load_checkpoint(self):
+        import tensorflow as tf
+
         start_checkpoint_path = '../checkpoints/' + self.checkpoint_model_id + '/'
         checkpoint = tf.train.latest_checkpoint(start_checkpoint_path)  # can be none of no checkpoint exists
         if checkpoint and os.path.isfile(checkpoint):
             variable_name_map_func = get_weights_to_preload_function(model_id=None,
                                                                      checkpoint_model_id=self.checkpoint_model_id,
                                                                      is_training=False)
-            self.coarse_model.load(checkpoint, weights_only=True, verbose=True, variable_name_map=variable_name_map_func)
-            self.fine_model.load(checkpoint, weights_only=True, verbose=True, variable_name_map=variable_name_map_func)
+            self.model.load(checkpoint, weights_only=True, verbose=True, variable_name_map=variable_name_map_func)
             print('Checkpoint loaded.')
         else:
             print('No checkpoint found. ')
 
 
+    def get_label_hierarchy(self):
+        # Loaded on first use, predicting doesn't need the CIFAR-100 labels.
+        if self.label_hierarchy is None:
+            self.label_hierarchy = load_cifar100_label_hierarchy()
+        return self.label_hierarchy
+
+
     def predict_both_fine_and_coarse(self, X):
-        coarse_pred_probs = self.coarse_model.predict(X)
-        fine_pred_probs = self.fine_model.predict(X)
-        return np.array(fine_pred_probs), np.array(coarse_pred_probs)
+        """
+        Runs the shared trunk once per batch and fetches both softmax heads in the same session.run.
+        Returns fine_pred_probs of shape (n_samples, N_FINE_CIFAR), coarse_pred_probs of shape (n_samples, N_COARSE_CIFAR)
+        """
+        import tflearn
+
+        with self.session.graph.as_default():
+            tflearn.is_training(False, session=self.session)
+        fine_pred_probs, coarse_pred_probs = [], []
+        for start in xrange(0, len(X), self.batch_size):
+            X_batch = np.asarray(X[start:start + self.batch_size])
+            coarse_batch, fine_batch = self.session.run([self.coarse_net, self.fine_net],
+                                                        feed_dict={self.input_placeholder: X_batch})
+            fine_pred_probs.append(fine_batch)
+            coarse_pred_probs.append(coarse_batch)
+        if not fine_pred_probs:
+            return np.zeros((0, N_FINE_CIFAR)), np.zeros((0, N_COARSE_CIFAR))
+        return np.concatenate(fine_pred_probs), np.concatenate(coarse_pred_probs)
 
 
     def predict_fine_or_coarse(self, fine_pred_probs, coarse_pred_probs, confid_threshold=74):
@@ -61,22 +88,108 @@ class PyramidWrapper(object):
         to the fine class at index 0)
 
         """
-        n_samples = fine_pred_probs.shape[0]
-        fine_confidence_scores = compute_confidence_scores(fine_pred_probs)
+        final_pred_classes = gate_fine_or_coarse(fine_pred_probs, coarse_pred_probs, confid_threshold=confid_threshold)
+        n_fine = np.count_nonzero(final_pred_classes >= N_COARSE_CIFAR)
+        print ("predicted fine label {} times out of {} total samples.".format(n_fine, final_pred_classes.shape[0]))
+        return final_pred_classes
+
+
+    def predict_cascade(self, X, confid_threshold=74):
+        """
+        Early exit version of predict_both_fine_and_coarse followed by predict_fine_or_coarse: per batch, runs the
+        shared trunk and the fine branch, and the coarse branch only for the samples whose fine confidence score is
+        <= confid_threshold, fed with their trunk outputs gathered into one sub-batch.
+        Returns final_pred_classes (same format as predict_fine_or_coarse) and the number of samples the coarse
+        branch ran on.
+        """
+        import tflearn
+
+        with self.session.graph.as_default():
+            tflearn.is_training(False, session=self.session)
+        final_pred_classes, n_coarse = [], 0
+        for start in xrange(0, len(X), self.batch_size):
+            X_batch = np.asarray(X[start:start + self.batch_size])
+            trunk_batch, fine_batch = self.session.run([self.trunk, self.fine_net],
+                                                       feed_dict={self.input_placeholder: X_batch})
+            pred_classes = N_COARSE_CIFAR + np.argmax(fine_batch, axis=1)
+            coarse_indices = np.flatnonzero(compute_confidence_scores(fine_batch) <= confid_threshold)
+            if len(coarse_indices):
+                coarse_batch = self.session.run(self.coarse_net, feed_dict={self.trunk: trunk_batch[coarse_indices]})
+                pred_classes[coarse_indices] = np.argmax(coarse_batch, axis=1)
+            final_pred_classes.append(pred_classes)
+            n_coarse += len(coarse_indices)
+        if not final_pred_classes:
+            return np.zeros((0,), dtype=np.int64), 0
+        return np.concatenate(final_pred_classes), n_coarse
+
+
+    def get_branch_flops(self):
+        # Flops per sample of the shared trunk and of each branch, from the shapes of the restored weights.
+        from numpy_inference import get_network_layers, get_weighted_layer_names, count_flops
+
+        trunk_layers, (coarse_layers, fine_layers) = get_network_layers('pyramid')
+        graph = self.session.graph
+        weight_shapes = dict((name, graph.get_tensor_by_name(name + '/W:0').get_shape().as_list())
+                             for name in get_weighted_layer_names(trunk_layers, [coarse_layers, fine_layers]))
+        input_shape = self.input_placeholder.get_shape().as_list()[1:]
+        trunk_flops, trunk_shape = count_flops(trunk_layers, weight_shapes, input_shape)
+        return {'trunk': trunk_flops, 'coarse': count_flops(coarse_layers, weight_shapes, trunk_shape)[0],
+                'fine': count_flops(fine_layers, weight_shapes, trunk_shape)[0]}
+
+
+class RemotePyramidModel(PyramidWrapper):
+    """
+    PyramidWrapper whose predictions come from a running model_server.py, which keeps the model loaded between runs.
+    The server returns the concatenated [coarse, fine] softmax outputs of the pyramid model. predict_cascade needs the
+    trunk of a local graph and is not available.
+    """
+    def __init__(self, model_client, checkpoint_model_id, batch_size=PREDICT_BATCH_SIZE):
+        self.model_client = model_client
+        self.checkpoint_model_id = checkpoint_model_id
+        self.batch_size = batch_size
+        self.label_hierarchy = None
+
+    def predict_both_fine_and_coarse(self, X):
+        pred_probs = self.model_client.predict(self.checkpoint_model_id, X, batch_size=self.batch_size)
+        return pred_probs[:, N_COARSE_CIFAR:], pred_probs[:, :N_COARSE_CIFAR]
 
-        coarse_pred_classes = np.argmax(coarse_pred_probs, axis=1)
-        fine_pred_classes = np.argmax(fine_pred_probs, axis=1)
+    def predict_cascade(self, X, confid_threshold=74):
+        raise Exception("Cascade inference needs a local PyramidWrapper")
 
-        final_pred_classes = [] # list for final predictions, each prediction is EITHER coarse OR fine.
-        n_fine = 0
-        for i in xrange(n_samples):
-            if fine_confidence_scores[i] > confid_threshold:
-                final_pred_classes.append(N_COARSE_CIFAR + fine_pred_classes[i])
-                n_fine += 1
-            else:
-                final_pred_classes.append(coarse_pred_classes[i])
-        print ("predicted fine label {} times out of {} total samples.".format(n_fine, n_samples))
-        return np.array(final_pred_classes)
+
+def compare_cascade(model, X, confid_threshold=74):
+    """
+    Runs the two branch path (predict_both_fine_and_coarse + gate) and PyramidWrapper.predict_cascade on X, raises an
+    Exception if their predictions differ, and reports the flops and time the cascade saves.
+    Returns final_pred_classes and a dict with the report.
+    """
+    start = time.time()
+    fine_pred_probs, coarse_pred_probs = model.predict_both_fine_and_coarse(X)
+    two_branch_pred_classes = gate_fine_or_coarse(fine_pred_probs, coarse_pred_probs, confid_threshold=confid_threshold)
+    two_branch_time = time.time() - start
+
+    start = time.time()
+    cascade_pred_classes, n_coarse = model.predict_cascade(X, confid_threshold=confid_threshold)
+    cascade_time = time.time() - start
+
+    n_mismatches = np.count_nonzero(two_branch_pred_classes != cascade_pred_classes)
+    if n_mismatches:
+        raise Exception("Cascade predictions differ from the two branch predictions for {} out of {} samples.".format(
+            n_mismatches, len(X)))
+
+    flops = model.get_branch_flops()
+    two_branch_flops = len(X) * (flops['trunk'] + flops['fine'] + flops['coarse'])
+    cascade_flops = len(X) * (flops['trunk'] + flops['fine']) + n_coarse * flops['coarse']
+    report = {'n_samples': len(X), 'n_early_exits': len(X) - n_coarse, 'branch_flops_per_sample': flops,
+              'flops_saved': 1. - cascade_flops / max(two_branch_flops, 1),
+              'two_branch_time': two_branch_time, 'cascade_time': cascade_time}
+    print("Cascade predictions identical to the two branch predictions on {} samples.".format(len(X)))
+    print("{} samples ({:.1%}) exited after the fine branch, the coarse branch ran on {}.".format(
+        report['n_early_exits'], report['n_early_exits'] / max(len(X), 1), n_coarse))
+    print("flops per sample: trunk {trunk}, fine branch {fine}, coarse branch {coarse}".format(**flops))
+    print("flops saved: {:.1%}, time: {:.2f}s two branch vs {:.2f}s cascade".format(report['flops_saved'],
+                                                                                  two_branch_time, cascade_time))
+    return cascade_pred_classes, report
 
 
 def compute_confidence_scores(pred_probs):
@@ -85,23 +198,79 @@ def compute_confidence_scores(pred_probs):
     return confidence_scores
 
 
+def gate_fine_or_coarse(fine_pred_probs, coarse_pred_probs, confid_threshold=74):
+    # Vectorized confidence gate, same output format as PyramidWrapper.predict_fine_or_coarse.
+    fine_confidence_scores = compute_confidence_scores(fine_pred_probs)
+    coarse_pred_classes = np.argmax(coarse_pred_probs, axis=1)
+    fine_pred_classes = np.argmax(fine_pred_probs, axis=1)
+    return np.where(fine_confidence_scores > confid_threshold, N_COARSE_CIFAR + fine_pred_classes, coarse_pred_classes)
+
+
+def fine_or_coarse_to_coarse(final_pred_classes, fine_to_coarse):
+    # Coarse class of every gated prediction, fine predictions (offset by N_COARSE_CIFAR) map to their coarse class.
+    final_pred_classes = np.asarray(final_pred_classes)
+    is_fine = final_pred_classes >= N_COARSE_CIFAR
+    fine_classes = np.where(is_fine, final_pred_classes - N_COARSE_CIFAR, 0)
+    return np.where(is_fine, fine_to_coarse[fine_classes], final_pred_classes)
+
+
+def compute_true_fine_or_coarse_classes(Y_fine_coarse, fine_or_coarse):
+    # Fine classes are offset by the number of coarse classes, so fine and coarse don't overlap.
+    fine_or_coarse = np.asarray(fine_or_coarse)
+    return np.where(fine_or_coarse == 0, N_COARSE_CIFAR + Y_fine_coarse[:, 0], Y_fine_coarse[:, 1])
+
+
 def compute_accuracy_predict_fine_or_coarse(final_pred_classes, Y_fine_coarse, fine_or_coarse):
-    n_samples = final_pred_classes.shape[0]
-    true_classes = []
-    for i in xrange(n_samples):
-        # true_classes.append(Y_fine_coarse[i, fine_or_coarse[i]])
-        if fine_or_coarse[i] == 0:  # should predict fine
-            true_classes.append(N_COARSE_CIFAR + Y_fine_coarse[i, 0])
-            # use number of coarse classes as offset, so fine and coarse don't overlap
-        else:  # shoud predict coarse
-            true_classes.append(Y_fine_coarse[i, 1])
-    true_classes = np.array(true_classes)
+    from sklearn.metrics import accuracy_score
+
+    true_classes = compute_true_fine_or_coarse_classes(Y_fine_coarse, fine_or_coarse)
     acc = accuracy_score(true_classes, final_pred_classes)
     return acc
 
 
+def sweep_confidence_thresholds(fine_pred_probs, coarse_pred_probs, Y_fine_coarse, fine_or_coarse, thresholds=None):
+    """
+    Computes the hierarchical accuracy of the confidence gate for many thresholds at once.
+    A sample is predicted fine iff its fine confidence score > threshold, so after sorting the scores once, the
+    accuracy at any threshold is (#correct coarse predictions among scores <= threshold
+    + #correct fine predictions among scores > threshold) / n_samples, read off cumulative sums.
+
+    Args:
+        thresholds: iterable of thresholds (any floats). If None, every distinct confidence score (plus 0, i.e.
+        always predict fine) is used, which covers every distinct gating decision.
+
+    Returns: thresholds, accuracies (arrays of the same length), best_threshold, best_accuracy.
+    Ties are resolved in favour of the smallest threshold.
+    """
+    n_samples = fine_pred_probs.shape[0]
+    fine_confidence_scores = compute_confidence_scores(fine_pred_probs)
+    true_classes = compute_true_fine_or_coarse_classes(Y_fine_coarse, fine_or_coarse)
+    fine_correct = (N_COARSE_CIFAR + np.argmax(fine_pred_probs, axis=1)) == true_classes
+    coarse_correct = np.argmax(coarse_pred_probs, axis=1) == true_classes
+
+    order = np.argsort(fine_confidence_scores, kind='mergesort')
+    sorted_scores = fine_confidence_scores[order]
+    # cum[k] = number of correct predictions among the k lowest scores
+    coarse_correct_cum = np.concatenate(([0], np.cumsum(coarse_correct[order])))
+    fine_correct_cum = np.concatenate(([0], np.cumsum(fine_correct[order])))
+
+    if thresholds is None:
+        thresholds = np.concatenate(([0.], np.unique(sorted_scores)))
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    n_coarse = np.searchsorted(sorted_scores, thresholds, side='right')  # samples with score <= threshold
+    n_correct = coarse_correct_cum[n_coarse] + (fine_correct_cum[-1] - fine_correct_cum[n_coarse])
+    accuracies = n_correct / float(max(n_samples, 1))
+
+    best_index = int(np.argmax(accuracies)) if len(accuracies) else None
+    if best_index is None:
+        return thresholds, accuracies, None, 0.0
+    return thresholds, accuracies, thresholds[best_index], accuracies[best_index]
+
+
 def evaluate_predictions(model, X, Y, fine_or_coarse, confid_threshold=None):
     # expects model to be an instance of PyramidWrapper
+    from sklearn.metrics import accuracy_score
 
     fine_pred_probs, coarse_pred_probs = model.predict_both_fine_and_coarse(X)
 
@@ -114,34 +283,46 @@ def evaluate_predictions(model, X, Y, fine_or_coarse, confid_threshold=None):
 
     print("Accuracy for coarse predictions: {}".format(coarse_acc))
     print("Accuracy for fine predictions: {}".format(fine_acc))
+    fine_to_coarse = model.get_label_hierarchy().fine_to_coarse
+    print("Coarse accuracy of the fine predictions: {}".format(np.mean(fine_to_coarse[fine_pred_classes] == Y_coarse)))
+    print("Fine predictions within the predicted coarse class: {}".format(
+        np.mean(fine_to_coarse[fine_pred_classes] == coarse_pred_classes)))
 
-    best_acc = 0.0
-    best_thres = None
     if confid_threshold == None:
-        for confid_threshold in xrange(60,85):
-            final_pred_classes = model.predict_fine_or_coarse(fine_pred_probs, coarse_pred_probs, confid_threshold=confid_threshold)
-            fine_or_coarse_acc = compute_accuracy_predict_fine_or_coarse(final_pred_classes, Y, fine_or_coarse)
-            if fine_or_coarse_acc > best_acc:
-                best_acc = fine_or_coarse_acc
-                best_thres = confid_threshold
-            print("confid_threshold: {}, hierarchical accuracy: {}".format(confid_threshold, fine_or_coarse_acc))
-        print ("best confid_threshold: {}, best hierarchical accuracy: {}".format(best_thres, best_acc))
+        thresholds, accuracies, best_thres, best_acc = sweep_confidence_thresholds(
+            fine_pred_probs, coarse_pred_probs, Y, fine_or_coarse, thresholds=range(60, 85))
+        for confid_threshold, fine_or_coarse_acc in zip(thresholds, accuracies):
+            print("confid_threshold: {}, hierarchical accuracy: {}".format(int(confid_threshold), fine_or_coarse_acc))
+        print ("best confid_threshold: {}, best hierarchical accuracy: {}".format(int(best_thres), best_acc))
+
+        _, _, exact_best_thres, exact_best_acc = sweep_confidence_thresholds(fine_pred_probs, coarse_pred_probs, Y,
+                                                                             fine_or_coarse)
+        print ("best confid_threshold over all confidence scores: {}, best hierarchical accuracy: {}".format(
+            exact_best_thres, exact_best_acc))
+        return best_thres, best_acc
     else:
         final_pred_classes = model.predict_fine_or_coarse(fine_pred_probs, coarse_pred_probs,
                                                           confid_threshold=confid_threshold)
         fine_or_coarse_acc = compute_accuracy_predict_fine_or_coarse(final_pred_classes, Y, fine_or_coarse)
         print("confid_threshold: {}, hierarchical accuracy: {}".format(confid_threshold,
                                                                                      fine_or_coarse_acc))
+        print("Coarse accuracy of the gated predictions: {}".format(
+            np.mean(fine_or_coarse_to_coarse(final_pred_classes, fine_to_coarse) == Y_coarse)))
+        return confid_threshold, fine_or_coarse_acc
 
 def examine_images_and_predictions_pyramid(model, X, y, confid_threshold=74, n_samples=50):
     # add third column to say which one predicted
+    import matplotlib.pyplot as plt
+    from tabulate import tabulate
+
     fine_pred_probs, coarse_pred_probs = model.predict_both_fine_and_coarse(X)
     fine_confidence_scores = compute_confidence_scores(fine_pred_probs)
     coarse_pred_classes = np.argmax(coarse_pred_probs, axis=1)
     fine_pred_classes = np.argmax(fine_pred_probs, axis=1)
 
     y_fine, y_coarse = y[:,0], y[:,1]
-    fine_label_names, coarse_label_names = load_cifar100_label_names(label_type='all')
+    label_hierarchy = model.get_label_hierarchy()
+    fine_label_names, coarse_label_names = label_hierarchy.fine_label_names, label_hierarchy.coarse_label_names
 
     for i in xrange(n_samples):
         img = X[i]
@@ -163,8 +344,61 @@ def examine_images_and_predictions_pyramid(model, X, y, confid_threshold=74, n_s
 
 
 
-if __name__ == "__main__":
-    pyramid_model = PyramidWrapper(checkpoint_model_id="pyramid_cifar100")
+def test_pyramid_model(checkpoint_model_id="pyramid_cifar100", confid_threshold=74, cascade=False, model_client=None):
+    # Returns the hierarchical accuracy on the test set.
+    # cascade: predict with PyramidWrapper.predict_cascade, checked against the two branch predictions.
+    # model_client: optional model_server.ModelClient, to predict with the server's already loaded model.
+    if model_client is not None and not cascade:
+        pyramid_model = RemotePyramidModel(model_client, checkpoint_model_id)
+    else:
+        pyramid_model = PyramidWrapper(checkpoint_model_id=checkpoint_model_id)
     X, Y, fine_or_coarse = load_data_pyramid(return_subset='test_only')
+    if cascade:
+        final_pred_classes, _ = compare_cascade(pyramid_model, X, confid_threshold=confid_threshold)
+        fine_or_coarse_acc = compute_accuracy_predict_fine_or_coarse(final_pred_classes, Y, fine_or_coarse)
+        print("confid_threshold: {}, hierarchical accuracy: {}".format(confid_threshold, fine_or_coarse_acc))
+        return fine_or_coarse_acc
     # evaluate_predictions(pyramid_model, X[:10], Y[:10], fine_or_coarse[:10], confid_threshold=15)
-    evaluate_predictions(pyramid_model, X, Y, fine_or_coarse, confid_threshold=74)
\ No newline at end of file
+    _, fine_or_coarse_acc = evaluate_predictions(pyramid_model, X, Y, fine_or_coarse, confid_threshold=confid_threshold)
+    return fine_or_coarse_acc
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python pyramid_wrapper.py [-c <ckpt_model_id>] [-t <confid_threshold>] [-x] [-s]")
+        print("-x: cascade inference (early exit after the fine branch), checked against the two branch path")
+        print("-s: predict with the running model server (see model_server.py), if there is one")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:t:xs", ["help", "ckpt_model_id", "confid_threshold", "cascade",
+                                                             "model_server"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    checkpoint_model_id, confid_threshold, cascade, use_model_server = "pyramid_cifar100", 74, False, False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-c", "--ckpt_model_id"):
+            checkpoint_model_id = a
+        elif o in ("-t", "--confid_threshold"):
+            confid_threshold = float(a)
+        elif o in ("-x", "--cascade"):
+            cascade = True
+        elif o in ("-s", "--model_server"):
+            use_model_server = True
+        else:
+            assert False, "unhandled option"
+    return checkpoint_model_id, confid_threshold, cascade, use_model_server
+
+
+if __name__ == "__main__":
+    checkpoint_model_id, confid_threshold, cascade, use_model_server = read_commandline_args()
+    model_client = None
+    if use_model_server:
+        from model_server import connect_to_model_server
+        model_client = connect_to_model_server()
+    test_pyramid_model(checkpoint_model_id, confid_threshold=confid_threshold, cascade=cascade,
+                       model_client=model_client)
\ No newline at end of file
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# quantization.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Post-training int8 quantization for CPU inference of the conv / fc networks
+# run by numpy_inference.py (simple_cnn, simple_cnn_extended_1, lenet_cnn,
+# lenet_small_cnn, vggnet_cnn and the pyramid).
+#
+#   - weights of every conv_2d / fully_connected layer are stored as int8 with
+#     one float scale per output channel (symmetric, max abs / 127)
+#   - the input range of every such layer is calibrated by running the float
+#     network on a sample of the training set; inputs are quantized to int8
+#     with one scale per layer
+#   - inference quantizes each layer's input, runs the conv (im2col) / matmul
+#     on the int8 operands with exact int32 accumulators (int8_matmul) and
+#     rescales them with input_scale * weight_scale before adding the bias
+#
+# Speed path: numpy has no int8 GEMM (and its integer matmul doesn't use
+# BLAS), so int8_matmul tiles the product. The weights stay int8 in memory;
+# each (reduction chunk, output-channel block) tile is widened to float32 just
+# before its sgemm, so a batch reads 1 byte per weight from memory instead of
+# 4. The reduction is split into chunks of at most 1040 rows, whose sums of
+# int8 products (at most 1040 * 127 * 127 < 2^24) float32 represents exactly,
+# and the chunk sums are added in int32, so the accumulators are exact for any
+# layer size.
+#
+# The report compares float (tflearn.DNN) and int8 accuracy, top-1 agreement,
+# throughput and weight size for every ALL_MODEL_DICTS entry with a checkpoint,
+# and the hierarchical accuracy of the confidence gate for the pyramid.
+# Throughput is measured for tflearn, the float32 numpy engine
+# (numpy_inference.NumpyNetwork) and the int8 engine; the int8 speed-up is
+# against the float32 numpy engine, so it shows the effect of int8 alone.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# python quantization.py [-m <model_id,model_id,...>] [-n <n_calibration>] [-e <n_eval>]
+#
+# from quantization import QuantizedNetwork
+# net = QuantizedNetwork.load(get_quantized_model_file('vggnet_cnn_cifar100_fine'))
+# probs = net.predict(X_test)
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+
+import numpy as np
+
+from constants import *
+from utils import *
+from data_utils import *
+from model_utils import load_model, get_model_output_kwargs, predict_in_batches, PREDICT_BATCH_SIZE, TRAINING_STORAGE
+from numpy_inference import NumpyNetwork, get_network_layers, numpy_network_from_model, load_network_file, im2col, \
+    activate
+from pyramid_wrapper import gate_fine_or_coarse, compute_accuracy_predict_fine_or_coarse
+
+
+QUANTIZED_MODELS_DIR = '../quantized_models/'
+N_CALIBRATION_SAMPLES = 1000
+INT8_MAX = 127
+CONFID_THRESHOLD = 74
+
+# Largest reduction chunk whose sums of int8 products are exact in float32: k * 127 * 127 < 2^24.
+EXACT_FLOAT32_CHUNK = (2 ** 24 - 1) // (INT8_MAX * INT8_MAX)
+# Output channels per weight tile (a 1040 x 256 float32 tile is about 1 MB).
+GEMM_OUT_BLOCK = 256
+
+
+def quantize(X, scale):
+    return np.clip(np.rint(X / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+
+
+def quantize_weights(W):
+    """
+    W: conv (k, k, C_in, C_out) or fc (n_in, n_out) weights.
+    Returns int8 weights reshaped to 2D (n_in, n_out) and the float32 scale of every output channel.
+    """
+    W = W.reshape(-1, W.shape[-1])
+    max_abs = np.abs(W).max(axis=0)
+    scales = np.where(max_abs > 0, max_abs / INT8_MAX, 1.).astype(np.float32)
+    return quantize(W, scales), scales
+
+
+def int8_matmul(A_q, W_q, k_chunk=EXACT_FLOAT32_CHUNK, out_block=GEMM_OUT_BLOCK):
+    """
+    A_q: int8 (n, K), W_q: int8 (K, n_out). Returns the exact int32 products A_q . W_q.
+    Sums at most k_chunk products per sgemm call, see the description above.
+    """
+    assert k_chunk <= EXACT_FLOAT32_CHUNK, "float32 sums of more than {} int8 products aren't exact".format(
+        EXACT_FLOAT32_CHUNK)
+    n, K = A_q.shape
+    n_out = W_q.shape[1]
+    accumulators = np.zeros((n, n_out), dtype=np.int32)
+    for k_start in xrange(0, K, k_chunk):
+        A_chunk = A_q[:, k_start:k_start + k_chunk].astype(np.float32)
+        for out_start in xrange(0, n_out, out_block):
+            W_tile = W_q[k_start:k_start + k_chunk, out_start:out_start + out_block].astype(np.float32)
+            accumulators[:, out_start:out_start + out_block] += A_chunk.dot(W_tile).astype(np.int32)
+    return accumulators
+
+
+def calibrate_input_ranges(float_network, X_calibration):
+    # Runs the float network and returns the max abs input of every weighted layer.
+    input_max = dict((name, 0.) for name in float_network.weights)
+
+    def observed_layer(layer, X):
+        input_max[layer[1]] = max(input_max[layer[1]], float(np.abs(X).max()) if X.size else 0.)
+        return float_network._layer(layer, X)
+
+    for start in xrange(0, len(X_calibration), float_network.batch_size):
+        float_network._forward(float_network._prepare_input(X_calibration[start:start + float_network.batch_size]),
+                               observed_layer)
+    return input_max
+
+
+class QuantizedNetwork(NumpyNetwork):
+    def __init__(self, trunk, heads, layer_params, preprocessing=None, batch_size=PREDICT_BATCH_SIZE):
+        """
+        layer_params: layer name -> dict with w_q (int8, 2D), w_scale, b, input_scale and kernel_size (conv only)
+        Runs like NumpyNetwork (see numpy_inference.py), with quantized convs / matmuls.
+        """
+        NumpyNetwork.__init__(self, trunk, heads, None, preprocessing=preprocessing, batch_size=batch_size)
+        self.layer_params = layer_params
+
+    @classmethod
+    def from_float(cls, float_network, X_calibration):
+        """
+        float_network: NumpyNetwork with the float weights
+        X_calibration: images the float network is run on to calibrate the input scale of every layer
+        """
+        input_max = calibrate_input_ranges(float_network, X_calibration)
+        layer_params = {}
+        for name, (W, b) in float_network.weights.items():
+            w_q, w_scale = quantize_weights(W)
+            layer_params[name] = {'w_q': w_q, 'w_scale': w_scale, 'b': b.astype(np.float32),
+                                  'input_scale': np.float32(max(input_max[name], 1e-8) / INT8_MAX),
+                                  'kernel_size': W.shape[0] if W.ndim == 4 else 0}
+        return cls(float_network.trunk, float_network.heads, layer_params, float_network.preprocessing,
+                   batch_size=float_network.batch_size)
+
+    def _layer(self, layer, X):
+        kind, name, activation = layer
+        params = self.layer_params[name]
+        X_q = quantize(X, params['input_scale'])
+        if kind == 'conv':
+            n, H, W, _ = X.shape
+            cols = im2col(X_q, params['kernel_size'])
+        else:
+            cols = X_q.reshape(len(X_q), -1)
+        accumulators = int8_matmul(cols, params['w_q'])
+        out = accumulators.astype(np.float32) * (params['input_scale'] * params['w_scale']) + params['b']
+        if kind == 'conv':
+            out = out.reshape(n, H, W, -1)
+        return activate(out, activation)
+
+    def n_weight_bytes(self):
+        return sum(params['w_q'].nbytes + params['w_scale'].nbytes + params['b'].nbytes
+                   for params in self.layer_params.values())
+
+    def save(self, file_path):
+        check_if_path_exists_or_create(file_path)
+        arrays = {}
+        for name, params in self.layer_params.items():
+            for key, value in params.items():
+                arrays[name + '/' + key] = value
+        spec = {'trunk': self.trunk, 'heads': self.heads, 'preprocessing': self.preprocessing}
+        np.savez(file_path, __spec__=np.array(json.dumps(spec)), **arrays)
+
+    @classmethod
+    def load(cls, file_path, batch_size=PREDICT_BATCH_SIZE):
+        trunk, heads, preprocessing, arrays = load_network_file(file_path)
+        layer_params = {}
+        for key, value in arrays.items():
+            name, param = key.rsplit('/', 1)
+            layer_params.setdefault(name, {})[param] = value
+        return cls(trunk, heads, layer_params, preprocessing, batch_size=batch_size)
+
+
+def get_quantized_model_file(model_id):
+    return os.path.join(QUANTIZED_MODELS_DIR, model_id + '.npz')
+
+
+def has_checkpoint(model_id):
+    import tensorflow as tf
+
+    checkpoint = tf.train.latest_checkpoint('../checkpoints/' + model_id + '/')
+    return bool(checkpoint and os.path.isfile(checkpoint))
+
+
+def get_quantizable_model_ids():
+    model_ids = []
+    for model_id, model_dict in sorted(ALL_MODEL_DICTS.items()):
+        try:
+            get_network_layers(model_dict['network_type'])
+        except Exception:
+            continue
+        if model_dict['dataset'] is not None:
+            model_ids.append(model_id)
+    return model_ids
+
+
+def load_quantization_data(dataset, n_calibration, n_eval):
+    """
+    Returns X_calibration (training images), X_eval, Y_eval (test set) and fine_or_coarse_eval (None except for
+    the pyramid dataset). Y_eval holds dense class ids, (fine, coarse) pairs for the pyramid.
+    """
+    if dataset == 'cifar100_joint':
+        X_train, _ = load_data_pyramid(return_subset='joint_only', storage=TRAINING_STORAGE)
+        X_test, Y_test, fine_or_coarse_test = load_data_pyramid(return_subset='test_only', storage=TRAINING_STORAGE)
+        fine_or_coarse_test = fine_or_coarse_test[:n_eval]
+    else:
+        X_train, _, X_test, Y_test = load_data(dataset, storage=TRAINING_STORAGE)
+        Y_test = np.argmax(Y_test, axis=1)
+        fine_or_coarse_test = None
+    X_calibration = np.asarray(X_train[:n_calibration], dtype=np.float32)
+    return X_calibration, X_test[:n_eval], Y_test[:n_eval], fine_or_coarse_test
+
+
+def _timed(predict_fn, X):
+    start = time.time()
+    outputs = predict_fn(X)
+    return outputs, len(X) / max(time.time() - start, 1e-9)
+
+
+def quantize_model(model_id, X_calibration):
+    """
+    Loads model_id from its checkpoint, calibrates and quantizes it, and saves the result (see
+    get_quantized_model_file). Returns the float tflearn model, the float NumpyNetwork and the QuantizedNetwork.
+    """
+    model = load_model(model_id, checkpoint_model_id=model_id, is_training=False, **get_model_output_kwargs(model_id))
+    float_network = numpy_network_from_model(model_id, model)
+    network = QuantizedNetwork.from_float(float_network, X_calibration)
+    network.save(get_quantized_model_file(model_id))
+    return model, float_network, network
+
+
+def compare_float_and_int8(model_id, X_calibration, X_eval, Y_eval, fine_or_coarse_eval=None):
+    import tensorflow as tf
+
+    with tf.Graph().as_default():
+        model, float_network, network = quantize_model(model_id, X_calibration)
+        float_probs, float_images_per_second = _timed(lambda X: predict_in_batches(model, X), X_eval)
+        model.session.close()
+    _, numpy_float_images_per_second = _timed(float_network.predict, X_eval)
+    int8_probs, int8_images_per_second = _timed(network.predict, X_eval)
+    n_float_weight_bytes = sum(4 * (params['w_q'].size + params['b'].size) for params in network.layer_params.values())
+
+    result = {'model_id': model_id, 'n_eval': len(X_eval), 'float_images_per_second': float_images_per_second,
+              'numpy_float_images_per_second': numpy_float_images_per_second,
+              'int8_images_per_second': int8_images_per_second,
+              'int8_speedup': int8_images_per_second / max(numpy_float_images_per_second, 1e-9),
+              'float_weight_mb': n_float_weight_bytes / 2 ** 20,
+              'int8_weight_mb': network.n_weight_bytes() / 2 ** 20}
+    if ALL_MODEL_DICTS[model_id]['network_type'] == 'pyramid':
+        for name, probs in (('float', float_probs), ('int8', int8_probs)):
+            coarse_probs, fine_probs = probs[:, :N_COARSE_CIFAR], probs[:, N_COARSE_CIFAR:]
+            result[name + '_fine_accuracy'] = float(np.mean(np.argmax(fine_probs, axis=1) == Y_eval[:, 0]))
+            result[name + '_coarse_accuracy'] = float(np.mean(np.argmax(coarse_probs, axis=1) == Y_eval[:, 1]))
+            final_pred_classes = gate_fine_or_coarse(fine_probs, coarse_probs, confid_threshold=CONFID_THRESHOLD)
+            result[name + '_hierarchical_accuracy'] = float(compute_accuracy_predict_fine_or_coarse(
+                final_pred_classes, Y_eval, fine_or_coarse_eval))
+        result['float_accuracy'], result['int8_accuracy'] = result['float_fine_accuracy'], result['int8_fine_accuracy']
+        float_probs, int8_probs = float_probs[:, N_COARSE_CIFAR:], int8_probs[:, N_COARSE_CIFAR:]
+    else:
+        result['float_accuracy'] = float(np.mean(np.argmax(float_probs, axis=1) == Y_eval))
+        result['int8_accuracy'] = float(np.mean(np.argmax(int8_probs, axis=1) == Y_eval))
+    result['top1_agreement'] = float(np.mean(np.argmax(float_probs, axis=1) == np.argmax(int8_probs, axis=1)))
+    return result
+
+
+def print_quantization_report(results):
+    print("int8: weights stored as int8, exact int32 accumulation via tiled float32 sgemm (see int8_matmul); "
+          "float acc, tf im/s: tflearn; np f32 im/s: float32 numpy engine; speedup: int8 vs np f32")
+    print("{:<46} {:>9} {:>9} {:>7} {:>10} {:>11} {:>10} {:>7} {:>9} {:>9}".format(
+        'model_id', 'float acc', 'int8 acc', 'agree', 'tf im/s', 'np f32 im/s', 'int8 im/s', 'speedup', 'float MB',
+        'int8 MB'))
+    for result in results:
+        print("{:<46} {:9.4f} {:9.4f} {:7.4f} {:10.1f} {:11.1f} {:10.1f} {:6.2f}x {:9.2f} {:9.2f}".format(
+            result['model_id'], result['float_accuracy'], result['int8_accuracy'], result['top1_agreement'],
+            result['float_images_per_second'], result['numpy_float_images_per_second'],
+            result['int8_images_per_second'], result['int8_speedup'], result['float_weight_mb'],
+            result['int8_weight_mb']))
+        if 'float_hierarchical_accuracy' in result:
+            print("{:<46} hierarchical accuracy (confid_threshold {}): float {:.4f}, int8 {:.4f}; "
+                  "coarse accuracy: float {:.4f}, int8 {:.4f}".format(
+                      '', CONFID_THRESHOLD, result['float_hierarchical_accuracy'],
+                      result['int8_hierarchical_accuracy'], result['float_coarse_accuracy'],
+                      result['int8_coarse_accuracy']))
+
+
+def run_quantization_report(model_ids=None, n_calibration=N_CALIBRATION_SAMPLES, n_eval=None):
+    model_ids = model_ids or get_quantizable_model_ids()
+    results, datasets = [], {}
+    for model_id in model_ids:
+        if not has_checkpoint(model_id):
+            print("Skipping {}: no checkpoint found.".format(model_id))
+            continue
+        dataset = ALL_MODEL_DICTS[model_id]['dataset']
+        if dataset not in datasets:
+            datasets[dataset] = load_quantization_data(dataset, n_calibration, n_eval)
+        results.append(compare_float_and_int8(model_id, *datasets[dataset]))
+
+    print_quantization_report(results)
+    report_file = os.path.join(QUANTIZED_MODELS_DIR, 'report.json')
+    check_if_path_exists_or_create(report_file)
+    with open(report_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python quantization.py [-m <model_id,model_id,...>] [-n <n_calibration>] [-e <n_eval>]")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:n:e:", ["help", "model_ids", "n_calibration", "n_eval"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    model_ids, n_calibration, n_eval = None, N_CALIBRATION_SAMPLES, None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-m", "--model_ids"):
+            model_ids = a.split(',')
+        elif o in ("-n", "--n_calibration"):
+            n_calibration = int(a)
+        elif o in ("-e", "--n_eval"):
+            n_eval = int(a)
+        else:
+            assert False, "unhandled option"
+    return model_ids, n_calibration, n_eval
+
+
+def main():
+    model_ids, n_calibration, n_eval = read_commandline_args()
+    run_quantization_report(model_ids, n_calibration=n_calibration, n_eval=n_eval)
+
+
+if __name__ == '__main__':
+    main()
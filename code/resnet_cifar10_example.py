@@ -30,8 +30,10 @@ Y = tflearn.data_utils.to_categorical(Y, 10)
 Y_test = tflearn.data_utils.to_categorical(Y_test, 10)
 
 # Real-time data preprocessing
+# Per-channel means of the training set, precomputed with the dataset (see dataset_stats.py).
+from dataset_stats import get_featurewise_stats
 img_prep = tflearn.ImagePreprocessing()
-img_prep.add_featurewise_zero_center(per_channel=True)
+img_prep.add_featurewise_zero_center(per_channel=True, mean=get_featurewise_stats('cifar10', per_channel=True)['mean'])
 
 # Real-time data augmentation
 img_aug = tflearn.ImageAugmentation()
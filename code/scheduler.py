@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+# scheduler.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Runs a list of experiments (model_id, mode) concurrently on one host, in
+# place of hand-run pipeline.py / feature_extractor.py invocations.
+# Modes: train, test (pipeline.py) and featurize (feature_extractor.py: writes
+# cifar100_joint_prefeaturized with the hidden reps of the model).
+#
+#   - jobs are ordered by their dependencies: test and featurize run after the
+#     model's train job, and jobs on cifar100_joint_prefeaturized (cnn_rnn_cifar100)
+#     after the featurize job; there can only be one featurize job per run, since
+#     every featurize job writes the same cifar100_joint_prefeaturized
+#   - every job runs in its own python process (python scheduler.py -r) and
+#     gets cores_per_job cores of its own: it is started under taskset pinned
+#     to them, with OMP / MKL / OPENBLAS_NUM_THREADS set in its environment (so
+#     numpy and tensorflow pick them up when they initialize), and its TF intra /
+#     inter op thread pools are limited to that many threads
+#   - the datasets the jobs need are loaded once up front, which builds the
+#     on-disk dataset cache (see dataset_cache.py); the jobs are started after
+#     that and all memory-map the same cache entries
+#   - a test job writes its accuracy to a result file next to its log, which
+#     is read once the job has exited
+#   - each job logs to its own file, and a summary table of status, wall time
+#     and test accuracy is printed and written as json at the end
+# Jobs whose dependencies failed are skipped.
+#===============================================================================
+# CURRENT STATUS: Working
+#===============================================================================
+# USAGE:
+# python scheduler.py -j <model_id:mode,model_id:mode,...> [-n <n_cores>] [-k <cores_per_job>]
+# e.g.
+# python scheduler.py -k 8 -j simple_cnn_cifar100_fine_for_featurization:train,\
+#   simple_cnn_cifar100_fine_for_featurization:featurize,cnn_rnn_cifar100:train,\
+#   lenet_cnn_cifar100_coarse:train,lenet_cnn_cifar100_coarse:test
+#===============================================================================
+
+from __future__ import division, print_function, absolute_import
+
+import os, sys, getopt
+import json
+import time
+import datetime
+import subprocess
+import traceback
+import multiprocessing
+from distutils.spawn import find_executable
+
+from constants import *
+from utils import *
+
+
+SCHEDULER_LOG_DIR = '../scheduler_logs/'
+JOB_MODES = ('train', 'featurize', 'test')
+FEATURIZE_DATASET = 'cifar100_joint'
+PREFEATURIZED_DATASET = 'cifar100_joint_prefeaturized'
+THREAD_ENV_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+class Job(object):
+    def __init__(self, model_id, mode):
+        assert model_id in ALL_MODEL_DICTS, "Unknown model_id {}".format(model_id)
+        assert mode in JOB_MODES, "Unknown mode {}, use one of {}".format(mode, JOB_MODES)
+        self.model_id, self.mode = model_id, mode
+        self.dependencies = []
+        self.status = 'pending'  # pending, running, done, failed, skipped
+        self.cpus = []
+        self.start_time, self.wall_time, self.accuracy = None, None, None
+        self.process, self.log_file, self.result_file = None, None, None
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.model_id, self.mode)
+
+    def datasets(self):
+        # Datasets the job loads.
+        if self.mode == 'featurize':
+            return [FEATURIZE_DATASET]
+        dataset = ALL_MODEL_DICTS[self.model_id]['dataset']
+        return [dataset] if dataset else []
+
+
+def parse_jobs(job_specs):
+    # job_specs: list of "model_id:mode" strings
+    jobs = []
+    for spec in job_specs:
+        model_id, _, mode = spec.strip().rpartition(':')
+        jobs.append(Job(model_id, mode))
+    assert len(set(job.name for job in jobs)) == len(jobs), "Duplicate jobs in {}".format(job_specs)
+    return jobs
+
+
+def order_jobs(jobs):
+    """
+    Sets the dependencies of every job and returns the jobs in dependency order (stable w.r.t. the given order).
+    """
+    jobs_by_name = dict((job.name, job) for job in jobs)
+    featurize_jobs = [job for job in jobs if job.mode == 'featurize']
+    if len(featurize_jobs) > 1:
+        # They would all write the one PREFEATURIZED_DATASET feature set (and shards), overwriting each other.
+        raise Exception("Only one featurize job per run, got {}".format([job.name for job in featurize_jobs]))
+    for job in jobs:
+        train_job = jobs_by_name.get("{}:train".format(job.model_id))
+        if job.mode in ('test', 'featurize') and train_job is not None:
+            job.dependencies.append(train_job)
+        if job.mode != 'featurize' and PREFEATURIZED_DATASET in job.datasets():
+            job.dependencies.extend(featurize_jobs)
+
+    ordered, done = [], set()
+    while len(ordered) < len(jobs):
+        ready = [job for job in jobs if job.name not in done and all(dep.name in done for dep in job.dependencies)]
+        if not ready:
+            raise Exception("Cyclic job dependencies among {}".format([job.name for job in jobs if job.name not in done]))
+        ordered.extend(ready)
+        done.update(job.name for job in ready)
+    return ordered
+
+
+def warm_up_datasets(jobs):
+    """
+    Loads every dataset the jobs need once, so the dataset cache entries are built before the jobs start (instead of
+    concurrently by several jobs), and the jobs only memory-map them.
+    """
+    from data_utils import load_data, load_data_pyramid
+    from model_utils import TRAINING_STORAGE
+
+    datasets = sorted(set(sum([job.datasets() for job in jobs], [])))
+    for dataset in datasets:
+        if dataset == PREFEATURIZED_DATASET:
+            continue  # written by the featurize jobs
+        start = time.time()
+        try:
+            if dataset == FEATURIZE_DATASET:
+                load_data_pyramid(dataset, return_subset='test_only', storage=TRAINING_STORAGE)
+            else:
+                load_data(dataset, storage=TRAINING_STORAGE)
+            print("Dataset {} ready in {:.1f}s".format(dataset, time.time() - start))
+        except Exception as e:
+            print("Could not load dataset {} ({}), its jobs will load it themselves.".format(dataset, e))
+
+
+def job_command(job):
+    """
+    Command line running the job in a fresh python process, pinned to the job's cpus with taskset (util-linux; python 2
+    has no os.sched_setaffinity) when it is available.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '-r', job.name, '-o', job.result_file]
+    if find_executable('taskset') is None:
+        print("taskset not available, {} is not pinned to cpus {}".format(job.name, job.cpus))
+        return command
+    return ['taskset', '-c', ','.join(str(cpu) for cpu in job.cpus)] + command
+
+
+def job_environment(n_threads):
+    # OMP / BLAS thread pools are sized when numpy / tensorflow are first imported, so this has to be the environment
+    # the job process starts with.
+    env = dict(os.environ)
+    for variable in THREAD_ENV_VARIABLES:
+        env[variable] = str(n_threads)
+    return env
+
+
+def limit_threads(n_threads):
+    # Must run before tensorflow builds its first session. load_model applies model_utils.NUM_CORES to every graph it
+    # builds a model in (featurize jobs use graphs of their own), init_graph covers the default graph.
+    import tflearn
+    import model_utils
+    model_utils.NUM_CORES = n_threads
+    tflearn.init_graph(num_cores=n_threads)
+
+
+def run_job(model_id, mode):
+    # Runs one job in the current process. Returns the test accuracy for test jobs, None otherwise.
+    if mode == 'train':
+        from pipeline import train
+        train(model_id)
+    elif mode == 'test':
+        from pipeline import test
+        return test(model_id)
+    elif mode == 'featurize':
+        from feature_extractor import extract_features
+        extract_features(FEATURIZE_DATASET, model_id)
+    return None
+
+
+def run_job_process(job_spec, result_file):
+    # Body of python scheduler.py -r <model_id:mode> -o <result_file>, started by run_jobs.
+    model_id, _, mode = job_spec.rpartition(':')
+    limit_threads(int(os.environ.get('OMP_NUM_THREADS', multiprocessing.cpu_count())))
+    accuracy = run_job(model_id, mode)
+    with open(result_file, 'w') as f:
+        json.dump({'accuracy': accuracy}, f)
+
+
+def read_job_result(job):
+    # Accuracy written by the job process, None if it wrote none (non-test job, or it failed).
+    try:
+        with open(job.result_file, 'r') as f:
+            return json.load(f)['accuracy']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def run_jobs(jobs, n_cores=None, cores_per_job=None, log_dir=None, poll_interval=1.):
+    """
+    Runs the jobs in dependency order, as many at a time as fit on n_cores cores with cores_per_job cores each.
+    Returns the ordered jobs with their status, wall time and accuracy.
+    """
+    n_cores = n_cores or multiprocessing.cpu_count()
+    cores_per_job = min(cores_per_job or n_cores, n_cores)
+    log_dir = log_dir or os.path.join(SCHEDULER_LOG_DIR, datetime.datetime.now().strftime("%m-%d-%Y_%H-%M-%S"))
+    check_if_path_exists_or_create(os.path.join(log_dir, ''))
+
+    jobs = order_jobs(jobs)
+    print("Running {} jobs on {} cores, {} cores per job, logs in {}".format(len(jobs), n_cores, cores_per_job,
+                                                                              log_dir))
+    warm_up_datasets(jobs)
+
+    free_cpus = range(n_cores)
+    running = []
+    while any(job.status in ('pending', 'running') for job in jobs):
+        for job in jobs:
+            if job.status != 'pending':
+                continue
+            if any(dep.status in ('failed', 'skipped') for dep in job.dependencies):
+                job.status = 'skipped'
+                print("Skipping {}: a dependency failed".format(job.name))
+            elif all(dep.status == 'done' for dep in job.dependencies) and len(free_cpus) >= cores_per_job:
+                job.cpus, free_cpus = free_cpus[:cores_per_job], free_cpus[cores_per_job:]
+                job.log_file = os.path.join(log_dir, job.name.replace(':', '_') + '.log')
+                job.result_file = os.path.join(log_dir, job.name.replace(':', '_') + '.result.json')
+                job.start_time = time.time()
+                with open(job.log_file, 'a') as log:
+                    job.process = subprocess.Popen(job_command(job), stdout=log, stderr=subprocess.STDOUT,
+                                                   env=job_environment(len(job.cpus)))
+                job.status = 'running'
+                running.append(job)
+                print("Started {} on cpus {}".format(job.name, job.cpus))
+
+        time.sleep(poll_interval)
+        for job in list(running):
+            if job.process.poll() is None:
+                continue
+            job.wall_time = time.time() - job.start_time
+            job.status = 'done' if job.process.returncode == 0 else 'failed'
+            job.accuracy = read_job_result(job)
+            free_cpus = sorted(free_cpus + job.cpus)
+            running.remove(job)
+            print("{} {} after {:.1f}s".format(job.name, job.status, job.wall_time))
+
+    write_summary(jobs, os.path.join(log_dir, 'summary.json'))
+    return jobs
+
+
+def write_summary(jobs, summary_file):
+    print("{:<56} {:<8} {:>10} {:>9}  {}".format('job', 'status', 'wall time', 'accuracy', 'cpus'))
+    for job in jobs:
+        print("{:<56} {:<8} {:>10} {:>9}  {}".format(
+            job.name, job.status, '{:.1f}s'.format(job.wall_time) if job.wall_time is not None else '-',
+            '{:.4f}'.format(job.accuracy) if job.accuracy is not None else '-',
+            ','.join(str(cpu) for cpu in job.cpus)))
+    summary = [{'model_id': job.model_id, 'mode': job.mode, 'status': job.status, 'wall_time': job.wall_time,
+                'accuracy': job.accuracy, 'cpus': job.cpus, 'log_file': job.log_file,
+                'dependencies': [dep.name for dep in job.dependencies]} for job in jobs]
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def read_commandline_args():
+    def usage():
+        print("Usage: python scheduler.py -j <model_id:mode,model_id:mode,...> [-n <n_cores>] [-k <cores_per_job>]")
+        print("modes: {}".format(', '.join(JOB_MODES)))
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hj:n:k:r:o:", ["help", "jobs", "n_cores", "cores_per_job",
+                                                                 "run_job", "result_file"])
+    except getopt.GetoptError as err:
+        print (str(err))
+        usage()
+        sys.exit(2)
+
+    job_specs, n_cores, cores_per_job, run_job_spec, result_file = None, None, None, None, None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-j", "--jobs"):
+            job_specs = a.split(',')
+        elif o in ("-n", "--n_cores"):
+            n_cores = int(a)
+        elif o in ("-k", "--cores_per_job"):
+            cores_per_job = int(a)
+        elif o in ("-r", "--run_job"):
+            run_job_spec = a
+        elif o in ("-o", "--result_file"):
+            result_file = a
+        else:
+            assert False, "unhandled option"
+
+    assert job_specs or (run_job_spec and result_file), "Please specify the jobs with -j"
+    return job_specs, n_cores, cores_per_job, run_job_spec, result_file
+
+
+def main():
+    job_specs, n_cores, cores_per_job, run_job_spec, result_file = read_commandline_args()
+    if run_job_spec:
+        try:
+            run_job_process(run_job_spec, result_file)
+        except BaseException:
+            traceback.print_exc()
+            sys.exit(1)
+        return
+    jobs = run_jobs(parse_jobs(job_specs), n_cores=n_cores, cores_per_job=cores_per_job)
+    sys.exit(0 if all(job.status == 'done' for job in jobs) else 1)
+
+
+if __name__ == '__main__':
+    main()
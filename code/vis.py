@@ -5,6 +5,16 @@
 #===============================================================================
 # DESCRIPTION:
 # Exports functions to visualize network embeddings
+#
+# visualize_embeddings_with_tsne scales to the full 50k training set:
+#   - samples are subsampled per class (stratified) to max_samples before
+#     computing hidden reps, so every class keeps its share of the plot
+#   - the PCA and t-SNE projections are cached on disk, keyed by a hash of
+#     the hidden reps and the projection parameters (including the seed), so
+#     re-plotting the same embeddings (e.g. with other label names or colors)
+#     skips both
+#   - points are grouped by class with argsort / bincount and drawn with a
+#     single scatter call and a per-point color array
 #===============================================================================
 # CURRENT STATUS: Working
 #===============================================================================
@@ -14,49 +24,138 @@
 # tsne_experiments.ipynb notebook.
 #===============================================================================
 
-from model_utils import *
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import hashlib
+
 import numpy as np
-import tensorflow as tf
-from sklearn.manifold import TSNE
-from tflearn.data_utils import to_categorical, pad_sequences
-from sklearn.metrics import accuracy_score
-import matplotlib.pyplot as plt
-# from matplotlib import style
-import pandas as pd
-import seaborn as sns
-from sklearn.decomposition import PCA
-
-
-def visualize_embeddings_with_tsne(model_id, X, Y, label_names):
-    print "HI"
-    # Y has to be dense (not one-hot)
-    n_classes = len(label_names)
-    hidden_reps = None
-    graph_to_use = tf.Graph()
-    with graph_to_use.as_default():
-        hidden_rep_model = load_model(model_id, n_classes=n_classes, checkpoint_model_id=model_id, is_training=False, get_hidden_reps=True)
-        hidden_reps = np.array(hidden_rep_model.predict(X))
 
-    y = np.array(np.argmax(Y, axis=1),dtype="int")
+from model_utils import *
+from hidden_rep_cache import get_hidden_reps, array_fingerprint
+# sklearn, matplotlib and seaborn are imported where they are used.
+
+
+EMBEDDING_PROJECTION_CACHE_DIR = '../data/embedding_projection_cache'
+DEFAULT_MAX_SAMPLES = 10000
+PCA_COMPONENTS = 5
+TSNE_PERPLEXITY = 35
+
+
+def group_by_class(y, n_classes):
+    # order: sample indices sorted by class (stable), offsets: the samples of class c are order[offsets[c]:offsets[c + 1]].
+    y = np.asarray(y)
+    order = np.argsort(y, kind='mergesort')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(y, minlength=n_classes))))
+    return order, offsets
+
+
+def stratified_subsample(y, n_classes, max_samples, seed=0):
+    """
+    Sorted indices of at most max_samples samples, drawn uniformly at random within every class, with every class
+    keeping its share of the samples (and at least one sample).
+    """
+    y = np.asarray(y)
+    if max_samples is None or len(y) <= max_samples:
+        return np.arange(len(y))
+    rng = np.random.RandomState(seed)
+    permutation = rng.permutation(len(y))
+    order, offsets = group_by_class(y[permutation], n_classes)
+    counts = np.diff(offsets)
+    quotas = np.minimum(counts, np.maximum(counts * max_samples // len(y), 1))
+    sorted_y = y[permutation][order]
+    rank_in_class = np.arange(len(y)) - offsets[sorted_y]
+    return np.sort(permutation[order[rank_in_class < quotas[sorted_y]]])
+
+
+def _projection_file(cache_key, cache_dir):
+    return os.path.join(cache_dir, cache_key + '.npy')
 
-    pca = PCA(n_components=5)
-    pca_results = pca.fit_transform(hidden_reps)
-    tsne_model = TSNE(n_components=2, perplexity=35, random_state=0)
-    tsne_results = tsne_model.fit_transform(pca_results)
-    dim_0 = np.reshape(tsne_results[:,0], tsne_results.shape[0])
-    dim_1 = np.reshape(tsne_results[:,1], tsne_results.shape[0])
 
+def cached_projection(name, params, source_key, compute_fn, use_cache=True,
+                      cache_dir=EMBEDDING_PROJECTION_CACHE_DIR):
+    # Returns compute_fn(), from cache_dir if it was computed before for the same source_key and params.
+    if not use_cache:
+        return compute_fn()
+    key_dict = {'name': name, 'params': params, 'source': source_key}
+    cache_key = "{}_{}".format(name, hashlib.sha1(json.dumps(key_dict, sort_keys=True).encode('utf-8')).hexdigest()[:16])
+    projection_file = _projection_file(cache_key, cache_dir)
+    if os.path.isfile(projection_file):
+        print("Loaded {} projection from {}".format(name, projection_file))
+        return np.load(projection_file)
+    projection = compute_fn()
+    check_if_path_exists_or_create(projection_file)
+    tmp_file = "{}.tmp{}".format(projection_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.save(f, projection)
+    os.rename(tmp_file, projection_file)
+    return projection
+
+
+def compute_tsne(hidden_reps, n_pca_components=PCA_COMPONENTS, perplexity=TSNE_PERPLEXITY, seed=0, use_cache=True):
+    """
+    PCA to n_pca_components dimensions, then 2d t-SNE (Barnes-Hut). Both projections are cached, keyed by a hash of
+    hidden_reps and the parameters. Returns the (n_samples, 2) t-SNE coordinates.
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+
+    source_key = array_fingerprint(hidden_reps) if use_cache else None
+    # PCA is seeded too (its randomized solver is picked for large inputs), so the cached projection is reproducible.
+    pca_params = {'n_components': n_pca_components, 'seed': seed}
+    pca_results = cached_projection('pca', pca_params, source_key,
+                                    lambda: PCA(n_components=n_pca_components, random_state=seed).fit_transform(
+                                        np.asarray(hidden_reps)),
+                                    use_cache=use_cache)
+    tsne_params = {'pca': pca_params, 'perplexity': perplexity, 'seed': seed}
+    return cached_projection('tsne', tsne_params, source_key,
+                             lambda: TSNE(n_components=2, perplexity=perplexity, random_state=seed,
+                                          method='barnes_hut').fit_transform(pca_results),
+                             use_cache=use_cache)
+
+
+def plot_embedding(points, y, label_names, seed=0):
+    # One scatter call for all points, colored per class, drawn in random order so no class hides the others.
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+    import seaborn as sns
+
+    n_classes = len(label_names)
+    y = np.asarray(y)
     sns.set_palette("Set2", 10)
-    colors = sns.color_palette("cubehelix",len(label_names))
+    colors = np.asarray(sns.color_palette("cubehelix", n_classes))
+    draw_order = np.random.RandomState(seed).permutation(len(y))
+    _, offsets = group_by_class(y, n_classes)
+    present_classes = np.flatnonzero(np.diff(offsets))
 
     plt.figure(figsize=(6,6))
-    for label in xrange(n_classes):
-        points_0, points_1 = [], []
-        for i in xrange(len(dim_0)):
-            if y[i] == label:
-                points_0.append(dim_0[i])
-                points_1.append(dim_1[i])
-
-        plt.scatter(points_0, points_1, c=colors[label], label=label_names[label])
-    plt.legend(bbox_to_anchor=(1, 1), loc='upper left', ncol=1)
+    plt.scatter(points[draw_order, 0], points[draw_order, 1], c=colors[y[draw_order]], s=8, linewidths=0)
+    handles = [Line2D([], [], marker='o', linestyle='', color=colors[label], label=label_names[label])
+               for label in present_classes]
+    plt.legend(handles=handles, bbox_to_anchor=(1, 1), loc='upper left', ncol=1)
     plt.show()
+
+
+def visualize_embeddings_with_tsne(model_id, X, Y, label_names, model_client=None, max_samples=DEFAULT_MAX_SAMPLES,
+                                   use_cache=True, seed=0):
+    # Y: one-hot or dense labels
+    # model_client: optional model_server.ModelClient, to get the hidden reps from an already loaded model
+    # max_samples: number of samples to plot (stratified by class), None for all of them
+    n_classes = len(label_names)
+    Y = np.asarray(Y)
+    y = np.array(np.argmax(Y, axis=1) if Y.ndim == 2 else Y, dtype="int")
+
+    rows = stratified_subsample(y, n_classes, max_samples, seed=seed)
+    if len(rows) < len(y):
+        print("Plotting {} of {} samples.".format(len(rows), len(y)))
+        X, y = select_rows(X, rows), y[rows]
+
+    if model_client is not None:
+        hidden_reps = model_client.hidden_reps(model_id, X)
+    else:
+        # Reuses the hidden reps of earlier calls with the same checkpoint and X, see hidden_rep_cache.py.
+        hidden_reps = get_hidden_reps(model_id, X, n_classes=n_classes, use_cache=use_cache)
+
+    tsne_results = compute_tsne(hidden_reps, seed=seed, use_cache=use_cache)
+    plot_embedding(tsne_results, y, label_names, seed=seed)
@@ -1,8 +1,5 @@
-import simple_cnn
-import simple_cnn_extended_1
-import lenet_cnn
-import lenet_small_cnn
-import vggnet_cnn
-import joint_pyramid_cnn
-import cnn_rnn
-import cnn_rnn_end_to_end
\ No newline at end of file
+# Network modules are not imported with the package: each one pulls in tflearn and tensorflow, so
+# model_utils.load_network imports only the module a network_type needs. `from models import *` still
+# imports all of them.
+__all__ = ['simple_cnn', 'simple_cnn_extended_1', 'lenet_cnn', 'lenet_small_cnn', 'vggnet_cnn', 'joint_pyramid_cnn',
+           'cnn_rnn', 'cnn_rnn_end_to_end']
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized drop-in replacement for tflearn's ImageAugmentation.
+
+tflearn's ImageAugmentation loops over the batch in Python and rotates every
+image with scipy.ndimage. BatchImageAugmentation keeps the same interface
+(add_random_flip_leftright, add_random_rotation, add_random_crop), but
+transforms a whole NHWC batch at once:
+    - flips: one boolean mask and one reversed-index assignment
+    - rotations: the bilinear sampling grid of every angle is precomputed once
+      per image shape, so rotating a batch is four gathers and a weighted sum
+    - crops: one zero padding of the whole batch and one gather of the windows
+
+The random draws are the ones tflearn makes, from Python's random module in
+the same order (one getrandbits(1) per image to flip / rotate, randint for the
+crop offsets, uniform for the angle), so with the same random.seed flips and
+crops are identical to tflearn's.
+
+Rotations are an approximation of tflearn's, traded for speed:
+    - the angle is rounded to the nearest multiple of rotation_step degrees
+      (1 by default) instead of being used as drawn, so there is a finite set
+      of precomputed grids
+    - pixels are sampled bilinearly instead of with scipy's default cubic
+      spline (order=3), which would need a spline prefilter of every image
+With the same angle convention, rotation center and zero fill, a rotated image
+equals scipy.ndimage.rotate(image, rounded_angle, reshape=False, order=1),
+including the border, where output pixels whose source falls outside the
+image are 0. code/batch_augmentation_test.py checks all three augmentations.
+
+Models opt in with model_utils.BATCH_AUGMENTATION (off by default).
+
+Usage (in a model's build_network):
+    img_aug = BatchImageAugmentation()
+    img_aug.add_random_flip_leftright()
+    img_aug.add_random_rotation(max_angle=25.)
+    network = input_data(shape=[None, 32, 32, 3], data_augmentation=img_aug)
+"""
+from __future__ import division, print_function, absolute_import
+
+import random
+
+import numpy as np
+from tflearn.data_augmentation import ImageAugmentation
+
+
+class BatchImageAugmentation(ImageAugmentation):
+    def __init__(self, rotation_step=1.):
+        """
+        Args:
+            rotation_step: rotation angles are drawn uniformly from [-max_angle, max_angle] like tflearn's, then
+                rounded to the nearest multiple of rotation_step (degrees)
+        """
+        ImageAugmentation.__init__(self)
+        self.rotation_step = rotation_step
+        self._rotation_grids = {}
+
+    def apply(self, batch):
+        batch = np.asarray(batch)
+        if not batch.flags.writeable:
+            batch = batch.copy()
+        return ImageAugmentation.apply(self, batch)
+
+    def _random_flip_leftright(self, batch):
+        flip = np.array([bool(random.getrandbits(1)) for _ in range(len(batch))], dtype=bool)
+        batch[flip] = batch[flip][:, :, ::-1]
+        return batch
+
+    def get_rotation_grids(self, height, width, max_angle):
+        """
+        Returns (angles, indices, weights) for bilinear rotation of height x width images:
+            angles: (n_angles,) rotation angles in degrees
+            indices: (n_angles, 4, height * width) flat source pixel of each of the 4 bilinear neighbours
+            weights: (n_angles, 4, height * width) bilinear weights, all 0 for output pixels whose source
+                coordinates fall outside [0, height - 1] x [0, width - 1] (scipy's mode='constant' with cval=0)
+        """
+        key = (height, width, max_angle)
+        if key in self._rotation_grids:
+            return self._rotation_grids[key]
+
+        n_steps = int(np.floor(max_angle / self.rotation_step))
+        angles = np.arange(-n_steps, n_steps + 1) * self.rotation_step
+        rows, cols = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+        center_row, center_col = (height - 1) / 2., (width - 1) / 2.
+        d_rows, d_cols = (rows - center_row).ravel(), (cols - center_col).ravel()
+
+        indices = np.zeros((len(angles), 4, height * width), dtype=np.int64)
+        weights = np.zeros((len(angles), 4, height * width), dtype=np.float32)
+        for a, angle in enumerate(np.deg2rad(angles)):
+            # Same mapping from output to input coordinates as scipy.ndimage.rotate(image, angle, reshape=False).
+            src_rows = np.cos(angle) * d_rows + np.sin(angle) * d_cols + center_row
+            src_cols = -np.sin(angle) * d_rows + np.cos(angle) * d_cols + center_col
+            row0, col0 = np.floor(src_rows).astype(np.int64), np.floor(src_cols).astype(np.int64)
+            frac_row, frac_col = src_rows - row0, src_cols - col0
+            # scipy returns cval for these, it doesn't blend the in-image neighbours.
+            source_inside = (src_rows >= 0) & (src_rows <= height - 1) & (src_cols >= 0) & (src_cols <= width - 1)
+            neighbours = [(row0, col0, (1 - frac_row) * (1 - frac_col)), (row0, col0 + 1, (1 - frac_row) * frac_col),
+                          (row0 + 1, col0, frac_row * (1 - frac_col)), (row0 + 1, col0 + 1, frac_row * frac_col)]
+            for n, (r, c, w) in enumerate(neighbours):
+                inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+                indices[a, n] = np.where(inside, r * width + c, 0)
+                weights[a, n] = np.where(inside & source_inside, w, 0.)
+
+        self._rotation_grids[key] = (angles, indices, weights)
+        return self._rotation_grids[key]
+
+    def _random_rotation(self, batch, max_angle):
+        rotate, drawn_angles = [], []
+        for i in range(len(batch)):
+            if bool(random.getrandbits(1)):
+                rotate.append(i)
+                drawn_angles.append(random.uniform(-max_angle, max_angle))
+        if not rotate:
+            return batch
+        angles, _, _ = self.get_rotation_grids(batch.shape[1], batch.shape[2], max_angle)
+        angle_ids = self.nearest_angle_ids(angles, drawn_angles)
+        batch[rotate] = self.rotate_images(batch[rotate], angle_ids, max_angle)
+        return batch
+
+    def nearest_angle_ids(self, angles, drawn_angles):
+        # Index of the precomputed angle nearest to each drawn angle (angles are -n..n multiples of rotation_step).
+        angle_ids = np.round(np.asarray(drawn_angles) / self.rotation_step).astype(np.int64) + len(angles) // 2
+        return np.clip(angle_ids, 0, len(angles) - 1)
+
+    def rotate_images(self, images, angle_ids, max_angle):
+        # Rotates images (NHWC) by angles[angle_ids] of get_rotation_grids, returns float32 images.
+        n_images, height, width = images.shape[0], images.shape[1], images.shape[2]
+        _, indices, weights = self.get_rotation_grids(height, width, max_angle)
+        flat_images = images.reshape(n_images, height * width, -1)
+        image_ids = np.arange(n_images)[:, None]
+        rotated = np.zeros(flat_images.shape, dtype=np.float32)
+        for n in range(4):
+            rotated += weights[angle_ids, n][:, :, None] * flat_images[image_ids, indices[angle_ids, n]]
+        return rotated.reshape(images.shape)
+
+    def _random_crop(self, batch, crop_shape, padding=None):
+        n_images, height, width = batch.shape[0], batch.shape[1], batch.shape[2]
+        if padding:
+            batch = np.pad(batch, ((0, 0), (padding, padding), (padding, padding), (0, 0)), mode='constant')
+            height, width = height + 2 * padding, width + 2 * padding
+        offsets = np.array([(random.randint(0, height - crop_shape[0]), random.randint(0, width - crop_shape[1]))
+                            for _ in range(n_images)], dtype=np.int64).reshape(n_images, 2)
+        top, left = offsets[:, 0], offsets[:, 1]
+        rows = top[:, None] + np.arange(crop_shape[0])
+        cols = left[:, None] + np.arange(crop_shape[1])
+        return batch[np.arange(n_images)[:, None, None], rows[:, :, None], cols[:, None, :]]
@@ -13,12 +13,14 @@ from tflearn.layers.conv import conv_2d, max_pool_2d
 from tflearn.layers.estimator import regression
 from tflearn.data_preprocessing import ImagePreprocessing
 from tflearn.data_augmentation import ImageAugmentation
+
+from .batch_augmentation import BatchImageAugmentation
 import tensorflow as tf
 import tflearn.helpers.summarizer as tf_summarizer
 
 
 # Convolutional network building
-def build_network(n_classes, get_hidden_reps=False):
+def build_network(n_classes, get_hidden_reps=False, batch_augmentation=False):
     #assert n_output_units is not None, \
     #    "You need to specify how many tokens are in the output classification sequence."
     # n_classes represents the total number of classes
@@ -29,7 +31,8 @@ def build_network(n_classes, get_hidden_reps=False):
     single_output_token_size = (100 + 20 + 1)
 
     # Real-time data augmentation
-    img_aug = ImageAugmentation()
+    # batch_augmentation: vectorized augmentation of the whole batch, see batch_augmentation.py
+    img_aug = BatchImageAugmentation() if batch_augmentation else ImageAugmentation()
     img_aug.add_random_flip_leftright()
     img_aug.add_random_rotation(max_angle=25.)
 
@@ -14,9 +14,12 @@ from tflearn.layers.estimator import regression
 from tflearn.data_preprocessing import ImagePreprocessing
 from tflearn.data_augmentation import ImageAugmentation
 
+from .batch_augmentation import BatchImageAugmentation
+
 import tensorflow as tf
 # Convolutional network building
-def build_network(output_dims=[20, 100], get_hidden_reps=False, get_fc_softmax_activations=False):
+def build_network(output_dims=[20, 100], get_hidden_reps=False, get_fc_softmax_activations=False, batch_augmentation=False,
+                  get_trunk=False):
 
 
     assert (len(output_dims) == 2), "output_dims needs to be of length 2, containing coarse_dim and fine_dim."
@@ -24,7 +27,8 @@ def build_network(output_dims=[20, 100], get_hidden_reps=False, get_fc_softmax_a
 
     coarse_dim, fine_dim = tuple(output_dims)
     # Real-time data augmentation
-    img_aug = ImageAugmentation()
+    # batch_augmentation: vectorized augmentation of the whole batch, see batch_augmentation.py
+    img_aug = BatchImageAugmentation() if batch_augmentation else ImageAugmentation()
     img_aug.add_random_flip_leftright()
     img_aug.add_random_rotation(max_angle=25.)
 
@@ -61,6 +65,10 @@ def build_network(output_dims=[20, 100], get_hidden_reps=False, get_fc_softmax_a
         # return the last layer of the coarse and the fine branch.
         # needed so we can write a custom function which takes the activations, computes the confidence scores and
         # decides at what level of the hierarchy to predict.
+        # get_trunk: also return the output of the shared layers, so the branches can be evaluated separately on it
+        # (cascade inference, see PyramidWrapper.predict_cascade).
+        if get_trunk:
+            return (coarse_network, fine_network, network)
         return (coarse_network, fine_network)
 
     # coarse_confidence =
@@ -18,16 +18,22 @@ from tflearn.layers.estimator import regression
 from tflearn.data_preprocessing import ImagePreprocessing
 from tflearn.data_augmentation import ImageAugmentation
 
+from .batch_augmentation import BatchImageAugmentation
+
 
 # Convolutional network building
-def build_network(output_dims=None):
+def build_network(output_dims=None, batch_augmentation=False, featurewise_stats=None):
     # Real-time data preprocessing
+    # featurewise_stats: {'mean', 'std'} of the training data (see dataset_stats.get_featurewise_stats). If None,
+    # tflearn computes them from X on the first fit.
+    featurewise_stats = featurewise_stats or {}
     img_prep = ImagePreprocessing()
-    img_prep.add_featurewise_zero_center()
-    img_prep.add_featurewise_stdnorm()
+    img_prep.add_featurewise_zero_center(mean=featurewise_stats.get('mean'))
+    img_prep.add_featurewise_stdnorm(std=featurewise_stats.get('std'))
 
     # Real-time data augmentation
-    img_aug = ImageAugmentation()
+    # batch_augmentation: vectorized augmentation of the whole batch, see batch_augmentation.py
+    img_aug = BatchImageAugmentation() if batch_augmentation else ImageAugmentation()
     img_aug.add_random_flip_leftright()
     img_aug.add_random_rotation(max_angle=25.)
 
@@ -18,9 +18,11 @@ from tflearn.layers.estimator import regression
 from tflearn.data_preprocessing import ImagePreprocessing
 from tflearn.data_augmentation import ImageAugmentation
 
+from .batch_augmentation import BatchImageAugmentation
+
 
 # Convolutional network building
-def build_network(output_dims=None, get_hidden_reps=False):
+def build_network(output_dims=None, get_hidden_reps=False, batch_augmentation=False):
     # outputdims is a list of num_classes
     # Real-time data preprocessing
 
@@ -30,7 +32,8 @@ def build_network(output_dims=None, get_hidden_reps=False):
     # img_prep.add_featurewise_stdnorm()
 
     # Real-time data augmentation
-    img_aug = ImageAugmentation()
+    # batch_augmentation: vectorized augmentation of the whole batch, see batch_augmentation.py
+    img_aug = BatchImageAugmentation() if batch_augmentation else ImageAugmentation()
     img_aug.add_random_flip_leftright()
     img_aug.add_random_rotation(max_angle=25.)
 